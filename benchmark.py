@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# benchmark.py - Measure how long checks take and how they scale
+# Retooled for OMD/check-mk 2020
+#
+# benchmark.py generate builds a synthetic pnp4nagios perfdata tree: hosts x services x metrics, with one
+# rrd file per metric (the way check_mk stores them) holding weeks of data with daily and weekly
+# seasonality plus noise, and the matching service XML.
+#
+# benchmark.py run then checks every service in the tree with MetricPredict and records, for each
+# service, wall time, CPU time (including rrdtool child processes), forks, bytes read and the time
+# spent in the executor (the rrdtool graph/fetch calls). One JSON object per line is written, tagged
+# with --label, so runs of different versions, modes or executors can be compared. The kernel only
+# keeps the peak RSS of a whole process, so run_peak_rss_kb is the peak of the run up to and including
+# that check, not the check's own. Compare memory use with separate runs.
+#
+# A simple example would be:
+# benchmark.py generate --path /tmp/bench --hosts 2 --services 10 --metrics 8
+# benchmark.py run --path /tmp/bench --mode rpn --label baseline --output bench.jsonl
+
+
+import sys
+import os
+import math
+import time
+import json
+import random
+import resource
+import argparse
+import platform
+import subprocess
+import rrd_query
+import check_predicted
+
+def rrdtool_call(command, args):
+    '''
+    rrdtool_call runs an rrdtool command, in-process if the python rrd module is around.
+    '''
+    rrdtool = rrd_query.load_rrdtool()
+    if rrdtool is not None:
+        getattr(rrdtool, command)(*args)
+    else:
+        subprocess.check_call(['rrdtool', command] + list(args))
+
+def seasonal_value(timestamp, base, rand):
+    '''
+    seasonal_value makes up a sample: a daily cycle, a quieter weekend and some noise.
+    Once in a while the sample is left unknown.
+    '''
+    if rand.random() < 0.01:
+        return 'U'
+
+    day = math.sin(2 * math.pi * (timestamp % 86400) / 86400.0)
+    weekend = 0.6 if (timestamp // 86400 + 4) % 7 >= 5 else 1.0
+    return '{:.3f}'.format(base * weekend * (1.5 + day) + rand.gauss(0, base * 0.05))
+
+def write_service_xml(xml_path, metrics):
+    '''
+    write_service_xml writes the service XML that pnp4nagios would. metrics is a list of (name, rrd file).
+    '''
+    with open(xml_path, 'w') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<NAGIOS>\n')
+        for (index, (name, rrd_file)) in enumerate(metrics):
+            xml_file.write('  <DATASOURCE>\n')
+            xml_file.write('    <TEMPLATE>check_mk-benchmark</TEMPLATE>\n')
+            xml_file.write('    <RRDFILE>{}</RRDFILE>\n'.format(rrd_file))
+            xml_file.write('    <RRD_STORAGE_TYPE>MULTIPLE</RRD_STORAGE_TYPE>\n')
+            xml_file.write('    <RRD_HEARTBEAT>8460</RRD_HEARTBEAT>\n')
+            xml_file.write('    <IS_MULTI>0</IS_MULTI>\n')
+            xml_file.write('    <DS>1</DS>\n')
+            xml_file.write('    <NAME>{}</NAME>\n'.format(name))
+            xml_file.write('    <LABEL>{}</LABEL>\n'.format(name))
+            xml_file.write('  </DATASOURCE>\n')
+        xml_file.write('</NAGIOS>\n')
+
+def generate(args):
+    '''
+    generate builds the synthetic perfdata tree.
+    '''
+    rand = random.Random(args.seed)
+    end_time = int(time.time()) // args.step * args.step
+    start_time = end_time - args.weeks * 604800
+
+    for host_index in range(args.hosts):
+        host = 'host{:03d}'.format(host_index)
+        host_path = os.path.join(args.path, host)
+        if not os.path.isdir(host_path):
+            os.makedirs(host_path)
+
+        for service_index in range(args.services):
+            service_name = 'Interface_{}'.format(service_index + 1)
+            metrics = []
+
+            for metric_index in range(args.metrics):
+                name = 'metric{}'.format(metric_index)
+                rrd_file = os.path.join(host_path, '{}_{}.rrd'.format(service_name, name))
+                metrics.append((name, rrd_file))
+
+                # Full resolution for the whole history, plus the usual coarser archives
+                rows = args.weeks * 604800 // args.step
+                rrdtool_call('create', [rrd_file,
+                                        '--start', str(start_time - args.step),
+                                        '--step', str(args.step),
+                                        'DS:1:GAUGE:{}:U:U'.format(args.step * 2),
+                                        'RRA:AVERAGE:0.5:1:{}'.format(rows),
+                                        'RRA:AVERAGE:0.5:5:{}'.format(rows // 5),
+                                        'RRA:AVERAGE:0.5:30:{}'.format(rows // 30),
+                                        'RRA:MAX:0.5:1:{}'.format(rows),
+                                        'RRA:MIN:0.5:1:{}'.format(rows)])
+
+                base = rand.uniform(10, 1e6)
+                batch = []
+                for timestamp in range(start_time, end_time + 1, args.step):
+                    batch.append('{}:{}'.format(timestamp, seasonal_value(timestamp, base, rand)))
+                    if len(batch) == 1000:
+                        rrdtool_call('update', [rrd_file] + batch)
+                        batch = []
+                if batch:
+                    rrdtool_call('update', [rrd_file] + batch)
+
+            write_service_xml(os.path.join(host_path, '{}.xml'.format(service_name)), metrics)
+
+            if args.debug:
+                sys.stderr.write('Generated {} {}\n'.format(host, service_name))
+
+class TimedExecutor:
+    '''
+    TimedExecutor wraps an executor and adds up the time and number of graph, fetch and info calls.
+    '''
+
+    def __init__(self, executor):
+        self.executor   = executor
+        self.seconds    = 0.0
+        self.calls      = 0
+
+    def timed(self, method, args):
+        start = time.time()
+        try:
+            return getattr(self.executor, method)(args)
+        finally:
+            self.seconds += time.time() - start
+            self.calls += 1
+
+    def graph(self, args):
+        return self.timed('graph', args)
+
+    def fetch(self, args):
+        return self.timed('fetch', args)
+
+    def info(self, args):
+        return self.timed('info', args)
+
+def read_counters():
+    '''
+    read_counters takes a snapshot of the resource counters. Forks come from /proc/stat and are
+    system wide, so run benchmarks on a quiet machine. Bytes read include reaped child processes.
+    maxrss_kb is the peak RSS of this process or any reaped child since they started.
+    '''
+    counters = {'wall':time.time()}
+
+    times = os.times()
+    counters['cpu'] = times[0] + times[1] + times[2] + times[3]
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    counters['maxrss_kb'] = max(self_usage.ru_maxrss, child_usage.ru_maxrss)
+
+    counters['forks'] = None
+    try:
+        with open('/proc/stat') as stat_file:
+            for line in stat_file:
+                if line.startswith('processes '):
+                    counters['forks'] = int(line.split()[1])
+    except EnvironmentError:
+        pass
+
+    counters['rchar'] = None
+    counters['read_bytes'] = None
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                (name, value) = line.split(':')
+                if name in ('rchar', 'read_bytes'):
+                    counters[name] = int(value)
+    except EnvironmentError:
+        pass
+
+    return counters
+
+def counter_delta(before, after, name):
+    if before[name] is None or after[name] is None:
+        return None
+    return after[name] - before[name]
+
+def run(args):
+    '''
+    run checks every service in the tree and writes one JSON line per check.
+    '''
+    services = []
+    for host in sorted(os.listdir(args.path)):
+        host_path = os.path.join(args.path, host)
+        if os.path.isdir(host_path):
+            for file_name in sorted(os.listdir(host_path)):
+                if file_name.endswith('.xml'):
+                    services.append((host, file_name[:-len('.xml')]))
+
+    if args.output:
+        output = open(args.output, 'a')
+    else:
+        output = sys.stdout
+
+    try:
+        for repeat in range(args.repeat):
+            for (host, service_name) in services:
+                before = read_counters()
+
+                check = check_predicted.build_check(args, host, service_name)
+                predict_resource = check.resources[0]
+                executor = TimedExecutor(predict_resource.rrd_query.executor)
+                predict_resource.rrd_query.executor = executor
+                metrics = list(predict_resource.probe())
+
+                after = read_counters()
+
+                record = {'label':args.label,
+                          'time':int(before['wall']),
+                          'python':platform.python_version(),
+                          'host':host,
+                          'service':service_name,
+                          'repeat':repeat,
+                          'mode':args.mode,
+                          'executor':type(executor.executor).__name__,
+                          'metrics':len(predict_resource.label_dict),
+                          'results':len(metrics),
+                          'command_length':len(' '.join(predict_resource.rrd_query.command_list)),
+                          'wall_s':after['wall'] - before['wall'],
+                          'cpu_s':after['cpu'] - before['cpu'],
+                          'executor_s':executor.seconds,
+                          'executor_calls':executor.calls,
+                          'run_peak_rss_kb':after['maxrss_kb'],
+                          'forks':counter_delta(before, after, 'forks'),
+                          'rchar':counter_delta(before, after, 'rchar'),
+                          'read_bytes':counter_delta(before, after, 'read_bytes')}
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if args.output:
+            output.close()
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='benchmark.py options')
+    subParsers = cmdParser.add_subparsers(dest='command')
+
+    generateParser = subParsers.add_parser('generate', help='Generate a synthetic perfdata tree')
+    generateParser.add_argument('--path', dest='path', action='store', required=True,
+                                help='Directory to generate the perfdata tree in')
+    generateParser.add_argument('--hosts', dest='hosts', action='store', type=int, default=1,
+                                help='Number of hosts')
+    generateParser.add_argument('--services', dest='services', action='store', type=int, default=4,
+                                help='Number of services per host')
+    generateParser.add_argument('--metrics', dest='metrics', action='store', type=int, default=2,
+                                help='Number of metrics per service')
+    generateParser.add_argument('--weeks', dest='weeks', action='store', type=int, default=6,
+                                help='Weeks of history to generate')
+    generateParser.add_argument('--step', dest='step', action='store', type=int, default=60,
+                                help='rrd step in seconds')
+    generateParser.add_argument('--seed', dest='seed', action='store', type=int, default=1,
+                                help='Random seed')
+    generateParser.add_argument('--debug', dest='debug', action='store', type=int, default=0,
+                                help='Debug verbosity level')
+
+    runParser = subParsers.add_parser('run', help='Time checks over a perfdata tree')
+    runParser.add_argument('--label', dest='label', action='store', default='',
+                           help='Label to tag the results with (e.g. a version)')
+    runParser.add_argument('--repeat', dest='repeat', action='store', type=int, default=1,
+                           help='Number of times to check every service')
+    runParser.add_argument('--output', dest='output', action='store',
+                           help='JSON lines file to append to. Default is stdout')
+    check_predicted.add_predict_arguments(runParser)
+
+    args = cmdParser.parse_args()
+
+    if args.command == 'generate':
+        generate(args)
+    elif args.command == 'run':
+        run(args)
+    else:
+        cmdParser.print_help()
+
+if __name__ == '__main__':
+    main()
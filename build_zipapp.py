@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# build_zipapp.py - Package check_predicted as a single precompiled zipapp
+# Retooled for OMD/check-mk 2020
+#
+# A check that runs thousands of times a minute pays for finding, reading and compiling its modules
+# every time. build_zipapp.py puts the modules into one executable zip file along with their bytecode,
+# compiled ahead of time as unchecked hash based .pyc files so the interpreter loads them as they are,
+# without looking for or stat'ing the sources. The sources go in as well, for tracebacks.
+# Pure python dependencies (nagiosplugin) can be bundled in with --bundle so nothing has to be found
+# on sys.path at all. The archive is stored uncompressed unless --compress is given.
+#
+# A simple example would be:
+# build_zipapp.py --output $OMD_ROOT/local/lib/nagios/plugins/check_predicted --bundle nagiosplugin
+
+import os
+import sys
+import shutil
+import zipapp
+import argparse
+import tempfile
+import py_compile
+import importlib.util
+
+# The modules the checks can end up importing, one way or another
+modules = ['check_predicted', 'check_predicted_bulk', 'check_client', 'check_timing', 'rrd_query', 'rrdcached',
+           'rrd_mmap', 'service_index', 'result_cache', 'predict_math', 'predict_state', 'predict_numpy',
+           'predict_profile']
+
+main_template = '''import {0}
+{0}.main()
+'''
+
+def add_source(source_path, staging_dir, arc_name):
+    '''
+    add_source copies a source file into the staging directory under arc_name and compiles it
+    next to it as arc_name + 'c', the layout zipimport looks for.
+    '''
+    target = os.path.join(staging_dir, arc_name)
+    target_dir = os.path.dirname(target)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    shutil.copyfile(source_path, target)
+    py_compile.compile(target, cfile=target + 'c', dfile=arc_name, doraise=True,
+                       invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+def add_package(name, staging_dir):
+    '''
+    add_package copies the python files of an installed package into the staging directory.
+    '''
+    spec = importlib.util.find_spec(name)
+    if spec is None or not spec.submodule_search_locations:
+        raise SystemExit('Cannot find package {} to bundle'.format(name))
+
+    package_dir = list(spec.submodule_search_locations)[0]
+    for (dir_path, dir_names, file_names) in os.walk(package_dir):
+        dir_names[:] = [dir_name for dir_name in dir_names if dir_name not in ('__pycache__', 'tests')]
+        for file_name in file_names:
+            if file_name.endswith('.py'):
+                source_path = os.path.join(dir_path, file_name)
+                arc_name = os.path.join(name, os.path.relpath(source_path, package_dir))
+                add_source(source_path, staging_dir, arc_name)
+
+def build(output, entry='check_predicted', bundle=(), compress=False, interpreter='/usr/bin/env python3'):
+    '''
+    build writes the zipapp to output, running entry.main() when it is executed.
+    '''
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    staging_dir = tempfile.mkdtemp()
+    try:
+        for module in modules:
+            add_source(os.path.join(source_dir, module + '.py'), staging_dir, module + '.py')
+        for name in bundle:
+            add_package(name, staging_dir)
+
+        with open(os.path.join(staging_dir, '__main__.py'), 'w') as main_file:
+            main_file.write(main_template.format(entry))
+        py_compile.compile(os.path.join(staging_dir, '__main__.py'), dfile='__main__.py', doraise=True,
+                           cfile=os.path.join(staging_dir, '__main__.pyc'),
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+        zipapp.create_archive(staging_dir, output, interpreter=interpreter, compressed=compress)
+    finally:
+        shutil.rmtree(staging_dir)
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='build_zipapp.py options')
+    cmdParser.add_argument('--output', dest='output', action='store', default='check_predicted.pyz',
+                           help='zipapp file to write')
+    cmdParser.add_argument('--entry', dest='entry', action='store', default='check_predicted',
+                           choices=['check_predicted', 'check_client'], help='Module whose main() the zipapp runs')
+    cmdParser.add_argument('--bundle', dest='bundle', action='append', default=[],
+                           help='Pure python package to bundle in (e.g. nagiosplugin). Can be given more than once')
+    cmdParser.add_argument('--compress', dest='compress', action='store_true',
+                           help='Deflate the archive. Smaller, but slower to load')
+    cmdParser.add_argument('--python', dest='interpreter', action='store', default='/usr/bin/env python3',
+                           help='Interpreter for the #! line')
+    args = cmdParser.parse_args()
+
+    build(args.output, args.entry, args.bundle, args.compress, args.interpreter)
+    sys.stderr.write('Wrote {}\n'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# check_client.py - Thin client for check_server.py
+# Retooled for OMD/check-mk 2020
+#
+# Takes the same arguments as check_predicted.py, hands them to a running check_server.py and prints
+# whatever it answers with, exiting with the same code. It only imports what it needs to talk to
+# the socket so that it starts quickly. The socket path comes from $CHECK_PREDICTED_SOCKET, or the
+# server's default.
+#
+# A simple example would be:
+# check_client.py --host $HOST --servicename Interface_1
+
+
+import sys
+import os
+import json
+import socket
+import argparse
+
+def parse_timeout(argv):
+    '''
+    parse_timeout picks --timeout out of the check arguments the way the server's parser
+    reads it (see check_predicted.add_predict_arguments), in either the --timeout N or the
+    --timeout=N form.
+    '''
+    timeoutParser = argparse.ArgumentParser(add_help=False)
+    timeoutParser.add_argument('--timeout', dest='timeout', action='store', type=int, default=40)
+    (args, rest) = timeoutParser.parse_known_args(argv)
+    return args.timeout
+
+def main():
+    socket_path = os.environ.get('CHECK_PREDICTED_SOCKET',
+                                 '{}/tmp/run/check_predicted.sock'.format(os.environ.get('OMD_ROOT', '')))
+    argv = sys.argv[1:]
+
+    # The server doesn't enforce --timeout, so the client does
+    timeout = parse_timeout(argv)
+
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps({'argv':argv}) + '\n').encode('utf-8'))
+        reply = client.makefile('rb').readline()
+        client.close()
+        response = json.loads(reply.decode('utf-8'))
+    except socket.timeout:
+        sys.stdout.write('UNKNOWN: Timeout: check execution aborted after {}s\n'.format(timeout))
+        sys.exit(3)
+    except (socket.error, ValueError) as err:
+        sys.stdout.write('UNKNOWN: check server at {} is not answering: {}\n'.format(socket_path, err))
+        sys.exit(3)
+
+    sys.stdout.write(response['output'])
+    sys.exit(response['exitcode'])
+
+if __name__ == '__main__':
+    main()
@@ -17,21 +17,26 @@
 
 import sys
 import os
+import io
 import re
 import argparse
-import subprocess
 import logging
 import nagiosplugin
-import time
+import nagiosplugin.output
+import nagiosplugin.platform
 import rrd_query
-import datetime
-import shelve
-import xml.etree.ElementTree as ET
+import predict_math
+import service_index
+import check_timing
+
+# Modules only some code paths need (the XML parser, predict_state, result_cache, NumPy...) are
+# imported where they are used, so a plain check doesn't pay for loading them at start up.
 
 def load_XML(xml_path):
     '''
     load_XML loads the service XML file and returns the root node of the tree.
     '''
+    import xml.etree.ElementTree as ET
 
     tree = ET.parse(xml_path)
     return tree.getroot()
@@ -47,22 +52,46 @@ class MetricPredict(nagiosplugin.Resource):
     The default settings for MetricPredict are pretty good. 5 sample windows of 30 minutes with a week inbetween.
     '''
     
-    def __init__(self, rrd_query, invID, perfdata_path, service_name, ds_match, sample_time='now', count=-5, interval=604800, window=1800,debug=0):
+    def __init__(self, rrd_query, invID, perfdata_path, service_name, ds_match, sample_time='now', count=-5, interval=604800, window=1800,debug=0,
+                 mode='rpn', state_dir=None, verify=False, label_dict=None, flush=True, timer=None, profile_dir=None,
+                 cache=None):
         '''
         __init__ just stores a reference to the rrd_query structure and all of the arguments needed.
         Arguments are described further below in the ArgumentParser definition.
+        A label_dict from the service index can be passed in to skip reading the service XML.
+        Only the metrics matching the ds_match regex are checked.
+        flush=False skips flushing the rrd files through rrdcached, for when the caller already has.
+        timer is a check_timing.PhaseTimer to record the time spent in each phase in.
+        profile_dir is where profile mode finds the profiles built by predict_profile.py.
+        cache is a result_cache.ResultCache to reuse the results of identical checks from.
         '''
         
         self.rrd_query      = rrd_query
+        self.invID          = invID
+        self.service_name   = service_name
         self.ds_match       = ds_match
         self.sample_time    = sample_time
         self.count          = count
         self.interval       = interval
         self.window         = window
         self.debug          = debug
+        self.mode           = mode
+        self.state_dir      = state_dir
+        self.profile_dir    = profile_dir
+        self.cache          = cache
+        self.verify         = verify
+        self.flush          = flush
+        self.timer          = timer or check_timing.null_timer
+        # Results worked out ahead of time by a rrd_query.QueryCompiler (see use_output)
+        self.compiled_output = None
         self.submetric_list = ["avg_smooth", "avg_pred", "avg_sigma", "avg_diff"]
-        self.service_meta   = load_XML('{}/{}/{}.xml'.format(perfdata_path, invID, service_name))
-        self.label_dict     = self.build_label_dict()
+        if label_dict is None:
+            with self.timer.phase('load_xml'):
+                self.service_meta   = load_XML('{}/{}/{}.xml'.format(perfdata_path, invID, service_name))
+                label_dict          = self.build_label_dict()
+        else:
+            self.service_meta   = None
+        self.label_dict     = service_index.filter_labels(label_dict, ds_match)
     
     
     def build_label_dict(self):
@@ -83,28 +112,188 @@ class MetricPredict(nagiosplugin.Resource):
 
         return return_dict
         
+    def rrd_files(self):
+        '''
+        rrd_files returns the set of rrd files the check reads.
+        '''
+        return set([path for (path, ds_num) in self.label_dict.values()])
     
+    def metrics_by_file(self):
+        '''
+        metrics_by_file returns the metric names ordered by rrd file and data source, so that the
+        metrics of a file are fetched one after the other and can share the fetched rows
+        (see RRDQuery.fetch). That only helps when they are fetched over the same time range, which
+        incremental mode seldom does: each metric starts from the end of its own state.
+        '''
+        return sorted(self.label_dict.keys(), key=lambda metric: self.label_dict[metric])
+
+    def resolution(self, path, ds_num, span, end_time=None):
+        '''
+        resolution returns (resolution, step) for fetching a data source so the rows come out the way
+        the DEF of the rpn query reads them at sample_time (or end_time): fetched at resolution and
+        consolidated to step. span is how far back the mode reads, for --minrows (see RRDQuery.read_steps).
+        '''
+        if end_time is None:
+            end_time = self.sample_time
+        return self.rrd_query.read_steps(path, ds_num, end_time, self.window, self.interval, span)
+
     def probe(self):
         '''
-        probe builds the rrd query, calls the query, parses the output and generates metrics
+        probe works out the predictions with the selected mode and generates metrics
+        '''
         
-        Unfortunately, I wasn't able to get the python rrd module working for whatever reason
-        so I built my own rrd_query mechanism. It's ugly but gets the job done.
+        if self.compiled_output is not None:
+            # The query compiler hands on the error if the check's query failed
+            if isinstance(self.compiled_output, Exception):
+                raise self.compiled_output
+            rrd_output_map = self.compiled_output
+        else:
+            if self.flush:
+                with self.timer.phase('flush'):
+                    self.rrd_query.flush(self.rrd_files())
+
+            rrd_output_map = None
+            if self.cache is not None:
+                with self.timer.phase('cache'):
+                    cache_key = self.cache.key(self.invID, self.service_name, self.cache_params(), self.rrd_files())
+                    rrd_output_map = self.cache.get(cache_key)
+                self.timer.count('cache_hit', int(rrd_output_map is not None))
+
+            if rrd_output_map is None:
+                rrd_output_map = self.query()
+                if self.cache is not None:
+                    self.cache.put(cache_key, rrd_output_map)
+
+        self.timer.count('metrics', len(self.label_dict))
+        self.timer.write(self.invID, self.service_name, self.mode)
+
+        if self.timer.perfdata:
+            for name in self.timer.phases:
+                yield nagiosplugin.Metric('time_' + name, self.timer.seconds[name], 's', context='timing')
+
+        # Generate the output metrics
+        # Generally we just output the diffs, but if debug is on we output all metrics
+        for metric in self.label_dict.keys():
+            for submetric in self.submetric_list:
+                if(re.search('_diff$', submetric)):
+                    yield nagiosplugin.Metric(metric + submetric, rrd_output_map[metric + submetric])
+                else:
+                    if(self.debug):
+                        yield nagiosplugin.Metric(metric + submetric, rrd_output_map[metric + submetric])
+
+    def query(self):
+        '''
+        query works out the predictions with the selected mode and returns a dict that maps
+        metric + submetric to its value.
         '''
+        # Rows kept from an earlier check are out of date by now
+        self.rrd_query.forget_fetches()
+
+        if self.mode == 'incremental':
+            with self.timer.phase('incremental'):
+                rrd_output_map = self.query_incremental()
+        elif self.mode == 'points':
+            with self.timer.phase('points'):
+                rrd_output_map = self.query_points()
+        elif self.mode == 'numpy':
+            with self.timer.phase('numpy'):
+                rrd_output_map = self.query_numpy()
+        elif self.mode == 'profile':
+            with self.timer.phase('profile'):
+                rrd_output_map = self.query_profile()
+        else:
+            rrd_output_map = self.query_rpn()
+
+        if self.verify and self.mode != 'rpn':
+            self.verify_output(rrd_output_map)
+
+        return rrd_output_map
+
+    def cache_params(self):
+        '''
+        cache_params returns the check parameters the results depend on, for the result cache key.
+        '''
+        return [self.mode, self.sample_time, self.count, self.interval, self.window, self.rrd_query.min_rows,
+                sorted([[metric, path, ds_num] for (metric, (path, ds_num)) in self.label_dict.items()])]
+
+    def query_rpn(self):
+        '''
+        query_rpn builds the rrd query, calls the query and parses the output into a dict that maps
+        metric + submetric to its value.
         
+        The query is evaluated by whatever executor the rrd_query was set up with. That is the
+        python rrd module if it is installed, otherwise rrdtool gets run as a subprocess.
+        '''
+        
+        with self.timer.phase('build_query'):
+            self.define_query()
+
+        self.timer.count('command_length', len(' '.join(self.rrd_query.command_list)))
+        self.timer.count('cdefs', len([item for item in self.rrd_query.command_list if item.startswith('CDEF:')]))
+
+        # Run the query
+        with self.timer.phase('run_query'):
+            rrd_output_lines = self.rrd_query.run_query()
+
+        with self.timer.phase('parse_output'):
+            rrd_output = self.rrd_query.parse_values(rrd_output_lines)
+            rrd_output_map = self.parse_output(rrd_output)
+
+        if(self.debug):
+            for name in rrd_output.keys():
+                sys.stderr.write('{} = {}\n'.format(name, rrd_output[name]))
+            for metric in rrd_output_map.keys():
+                sys.stderr.write('{} = {}\n'.format(metric, rrd_output_map[metric]))
+
+        return rrd_output_map
+
+    def parse_output(self, rrd_output, prefix=''):
+        '''
+        parse_output maps the printed values of the query (see define_query) to metric + submetric.
+        Values printed for other checks sharing the query are left out.
+        '''
+        rrd_output_map = {}
+        vdef_prefix = 'curr_{}ds'.format(prefix)
+        for name in rrd_output.keys():
+            if name.startswith(vdef_prefix):
+                rrd_output_map[name[len(vdef_prefix):]] = rrd_output[name]
+
+        return rrd_output_map
+
+    def use_output(self, rrd_output_map):
+        '''
+        use_output hands the check results that were worked out along with other checks
+        (see rrd_query.QueryCompiler), so probe doesn't run a query of its own.
+        An exception is raised by probe instead.
+        '''
+        self.compiled_output = rrd_output_map
+
+    def define_query(self, query=None, prefix=''):
+        '''
+        define_query adds the DEF, CDEF, VDEF and PRINT statements for every metric to the rrd query.
+        query defaults to the check's own rrd query. prefix namespaces the tokens, so the statements
+        can share a query with those of other checks.
+        '''
+
+        if query is None:
+            query = self.rrd_query
+
         for metric in self.label_dict.keys():
             # I know there's a better way to do this.
             (path, ds_num) = self.label_dict[metric]
-            
+
             # Define rrd dataset for the metric
-            ds = self.rrd_query.define_dataset(path, ds_num, metric)
-        
+            # The dataset may already have been defined by another check, so name the rest after the metric
+            ds = query.define_dataset(path, ds_num, metric, prefix=prefix)
+            base = query.token_name(metric, prefix=prefix)
+
             # Define the prediction rrd stuff  (self, cdef, step=604800, step_count=-5, window=1800):
-            predict_tokens = self.rrd_query.define_prediction(cdef=ds,
-                                                              step=self.interval,
-                                                              step_count=self.count,
-                                                              window=self.window,
-                                                              )
+            predict_tokens = query.define_prediction(cdef=ds,
+                                                     step=self.interval,
+                                                     step_count=self.count,
+                                                     window=self.window,
+                                                     name=base,
+                                                     )
             
             # Define an moving window average to smooth out the current rate.
             # It is this average that we will compare to the predicted. That way there will be less chance
@@ -112,8 +301,8 @@ class MetricPredict(nagiosplugin.Resource):
             # We'll use rrd TRENDNAN for this purpose
             
             rdef_str = '{},{},TRENDNAN'.format(ds, (self.window)/2)
-            ds_smooth = '{}_smooth'.format(ds)
-            self.rrd_query.define_cdef(ds_smooth, rdef_str)
+            ds_smooth = '{}_smooth'.format(base)
+            query.define_cdef(ds_smooth, rdef_str)
             
             # Add this to the working tokens
             predict_tokens.append(ds_smooth)
@@ -128,9 +317,9 @@ class MetricPredict(nagiosplugin.Resource):
             # else:
             #     return abs(observed - predicted)/sigma
             
-            rdef_str = '{2},0,EQ,0,{0},{1},-,ABS,{2},/,IF'.format(ds_smooth, ds + '_pred', ds + '_sigma')
-            ds_diff = '{}_diff'.format(ds)
-            self.rrd_query.define_cdef(ds_diff, rdef_str)
+            rdef_str = '{2},0,EQ,0,{0},{1},-,ABS,{2},/,IF'.format(ds_smooth, base + '_pred', base + '_sigma')
+            ds_diff = '{}_diff'.format(base)
+            query.define_cdef(ds_diff, rdef_str)
             
             # Add this to the working tokens
             predict_tokens.append(ds_diff)
@@ -142,43 +331,406 @@ class MetricPredict(nagiosplugin.Resource):
             for token in predict_tokens:
                 vdef_name       = 'curr_{}'.format(token)
                 rdef_str        = '{},LAST'.format(token)
-                vdef_tokens.append(self.rrd_query.define_vdef(vdef_name, rdef_str))
+                vdef_tokens.append(query.define_vdef(vdef_name, rdef_str))
             
             if(self.debug):
                 for line in vdef_tokens:
                     sys.stderr.write('{}\n'.format(line))
             
             for token in vdef_tokens:
-                self.rrd_query.define_print(token)
-                       
-        # Run the query
-        rrd_output = self.rrd_query.run_query()
-        
+                query.define_print(token)
+
+    def query_incremental(self):
+        '''
+        query_incremental works out the predictions from state kept between runs (see predict_state.py).
+        Only the steps that arrived since the last run are fetched. The state is only saved when
+        sample_time is 'now', a check of some other point in time starts from scratch.
+        The returned dict is laid out like the one from query_rpn.
+        '''
+        import predict_state
+
+        rrd_output_map = {}
+        persist = (self.sample_time == 'now')
+
+        with predict_state.StateStore(self.state_dir, self.invID, self.service_name) as store:
+            for metric in self.metrics_by_file():
+                (path, ds_num) = self.label_dict[metric]
+                (resolution, step) = self.resolution(path, ds_num, abs(self.count) * self.interval)
+                key = predict_state.fingerprint(path, ds_num, self.interval, self.count, self.window, (resolution, step))
+
+                state = None
+                if persist:
+                    state = store.get(metric, key)
+                state = self.update_state(state, key, path, ds_num, resolution, step)
+                if persist:
+                    store.put(metric, state)
+
+                (pred, sigma) = state.predict(self.window)
+
+                # Like the LAST VDEFs, take smooth (and the diff with it) at the last step it is known
+                smooth_pos = state.last_smooth_pos(self.window / 2)
+                if smooth_pos is None:
+                    smooth = predict_math.nan
+                    diff = predict_math.nan
+                else:
+                    smooth = state.smooth(self.window / 2, smooth_pos)
+                    (smooth_pred, smooth_sigma) = state.predict(self.window, smooth_pos)
+                    diff = predict_math.difference(smooth, smooth_pred, smooth_sigma)
+
+                name = '{}avg'.format(metric)
+                rrd_output_map[name + '_smooth']    = smooth
+                rrd_output_map[name + '_pred']      = pred
+                rrd_output_map[name + '_sigma']     = sigma
+                rrd_output_map[name + '_diff']      = diff
+
         if(self.debug):
-            for line in rrd_output:
-                sys.stderr.write('{}\n'.format(line))
-        
-        # Parse the output and map it to metrics
+            for metric in rrd_output_map.keys():
+                sys.stderr.write('{} = {}\n'.format(metric, rrd_output_map[metric]))
+
+        return rrd_output_map
+
+    def query_points(self):
+        '''
+        query_points works out the predictions from just the sample windows PREDICT looks at.
+        Instead of evaluating the whole 6 week graph, the |count| windows of window seconds,
+        interval seconds apart, ending at sample_time are fetched one by one.
+        The returned dict is laid out like the one from query_rpn.
+        '''
         rrd_output_map = {}
-        output_parser = re.compile(r'^curr_ds(.*) = (.*)')
-        for line in rrd_output:
-            match = output_parser.match(line)
-            if match:
-                rrd_output_map[match.group(1)] = float(match.group(2))
-        
+
+        for metric in self.metrics_by_file():
+            (path, ds_num) = self.label_dict[metric]
+            (smooth, pred, sigma, diff) = self.predict_points(path, ds_num)
+
+            name = '{}avg'.format(metric)
+            rrd_output_map[name + '_smooth']    = smooth
+            rrd_output_map[name + '_pred']      = pred
+            rrd_output_map[name + '_sigma']     = sigma
+            rrd_output_map[name + '_diff']      = diff
+
         if(self.debug):
             for metric in rrd_output_map.keys():
                 sys.stderr.write('{} = {}\n'.format(metric, rrd_output_map[metric]))
 
-        # Generate the output metrics
-        # Generally we just output the diffs, but if debug is on we output all metrics
-        for metric in self.label_dict.keys():
-            for submetric in self.submetric_list:
-                if(re.search('_diff$', submetric)):
-                    yield nagiosplugin.Metric(metric + submetric, rrd_output_map[metric + submetric])
+        return rrd_output_map
+
+    def predict_points(self, path, ds_num):
+        '''
+        predict_points fetches the sample windows for one data source and returns (smooth, pred, sigma, diff).
+        The windows are read at the step the rpn query's DEF reads (see resolution). The newest one ends
+        where the DEF does. If rrdtool can only serve one of the others from a coarser archive, all of
+        the windows are fetched again at that resolution.
+        Like the LAST VDEFs, each of them is taken at the last step it is known (see predict_last). The
+        windows are fetched half a window longer for that, as the newest step is still being filled in.
+        If that isn't enough, as the data source has been unknown for a while, the whole graph is read.
+        '''
+        span = (abs(self.count) - 1) * self.interval + 2 * self.window
+        (resolution, step) = self.resolution(path, ds_num, span)
+
+        while True:
+            locstep         = predict_math.steps(self.window, step)
+            shiftstep       = predict_math.steps(self.interval, step)
+            smooth_steps    = predict_math.steps(self.window / 2, step)
+
+            # A step more than needed, the first one can come out unknown when the rows are consolidated
+            (start, slice_step, values) = self.rrd_query.fetch(path, ds_num,
+                                                               'end-{}s'.format((locstep + 2 * smooth_steps + 1) * step),
+                                                               self.sample_time,
+                                                               resolution=resolution, consolidate=step)
+            if slice_step == step:
+                last_pos = start // step + len(values)
+                samples = dict(zip(range(start // step + 1, last_pos + 1), values))
+
+                for shift in range(1, abs(self.count)):
+                    slice_end = last_pos - shift * shiftstep
+                    (start, slice_step, values) = self.rrd_query.fetch(path, ds_num,
+                                                                       (slice_end - locstep - smooth_steps - 1) * step,
+                                                                       slice_end * step,
+                                                                       resolution=resolution, consolidate=step)
+                    if slice_step != step:
+                        break
+                    # rrd_fetch runs on a step past slice_end, which is partly covered once consolidated
+                    for (index, value) in enumerate(values[:slice_end - start // step]):
+                        samples[start // step + 1 + index] = value
                 else:
-                    if(self.debug):
-                        yield nagiosplugin.Metric(metric + submetric, rrd_output_map[metric + submetric])
+                    break
+
+            if self.debug:
+                sys.stderr.write('Refetching {} at {}s resolution\n'.format(path, slice_step))
+            (resolution, step) = (slice_step, slice_step)
+
+        (smooth, pred, sigma, diff) = self.predict_last(samples, last_pos - smooth_steps, last_pos,
+                                                        locstep, shiftstep, smooth_steps)
+
+        graph_span = self.rrd_query.graph_span()
+        if graph_span and any([predict_math.isnan(value) for value in (smooth, pred, sigma, diff)]):
+            # The LAST VDEFs look back as far as the graph goes for a known value, so read all of it
+            (start, slice_step, values) = self.rrd_query.fetch(path, ds_num, 'end-{}s'.format(graph_span),
+                                                               self.sample_time, resolution=resolution,
+                                                               consolidate=step)
+            if slice_step == step:
+                first_pos = start // step + 1
+                samples = dict(zip(range(first_pos, first_pos + len(values)), values))
+                # PREDICT leaves out the first row of the graph, TRENDNAN the positions less than a window in
+                del samples[first_pos]
+                (smooth, pred, sigma, diff) = self.predict_last(samples, first_pos + smooth_steps, last_pos,
+                                                                locstep, shiftstep, smooth_steps)
+
+        return (smooth, pred, sigma, diff)
+
+    def predict_last(self, samples, first_pos, last_pos, locstep, shiftstep, smooth_steps):
+        '''
+        predict_last returns (smooth, pred, sigma, diff) the way the LAST VDEFs pick them: each is its
+        value at the last position from last_pos back to first_pos where it is known. samples is a dict of
+        position to value holding the rows those positions are worked out from.
+        '''
+        last = [predict_math.nan] * 4
+        for pos in range(last_pos, first_pos - 1, -1):
+            (pred, sigma) = self.predict_samples(samples, pos, locstep, shiftstep)
+            smooth = predict_math.trend_nan([samples.get(pos - offset, predict_math.nan)
+                                             for offset in reversed(range(smooth_steps))], smooth_steps)
+            diff = predict_math.difference(smooth, pred, sigma)
+
+            last = [new if predict_math.isnan(old) else old for (old, new) in zip(last, (smooth, pred, sigma, diff))]
+            if not any([predict_math.isnan(value) for value in last]):
+                break
+
+        return tuple(last)
+
+    def predict_samples(self, samples, pos, locstep, shiftstep):
+        '''
+        predict_samples returns (pred, sigma) at position pos from samples, a dict of position to value
+        holding the |count| sample windows of locstep + 1 steps, shiftstep steps apart.
+        '''
+        total = 0.0
+        total2 = 0.0
+        count = 0
+        for shift in range(abs(self.count)):
+            for offset in range(locstep + 1):
+                value = samples.get(pos - shift * shiftstep - offset, predict_math.nan)
+                if not predict_math.isnan(value):
+                    total += value
+                    total2 += value * value
+                    count += 1
+
+        return predict_math.predict(total, total2, count)
+
+    def query_numpy(self):
+        '''
+        query_numpy fetches the raw series and works out the predictions for all of the metrics at
+        once with NumPy (see predict_numpy.py) instead of with rrd CDEFs. The series are read at the
+        step the rpn query's DEFs read (see resolution).
+        Series that came back with the same time range and resolution are stacked and computed together.
+        Series that have been unknown for a while are read further back, up to the start of the graph,
+        until their last known values are the ones the graph would find (see predict_numpy.predict_last_settled).
+        The returned dict is laid out like the one from query_rpn.
+        '''
+        import predict_numpy
+
+        # Enough history for the oldest window, plus the window itself
+        span = (abs(self.count) - 1) * self.interval + 2 * self.window
+        graph_span = self.rrd_query.graph_span()
+
+        steps = {}
+        spans = {}
+        for metric in self.metrics_by_file():
+            (path, ds_num) = self.label_dict[metric]
+            steps[metric] = self.resolution(path, ds_num, span)
+            spans[metric] = span
+
+        rrd_output_map = {}
+        while spans:
+            groups = {}
+            for metric in self.metrics_by_file():
+                if metric not in spans:
+                    continue
+                (path, ds_num) = self.label_dict[metric]
+                (resolution, step) = steps[metric]
+                # A step more, the first one can come out unknown when the rows are consolidated
+                fetch_span = spans[metric] + step
+                if graph_span:
+                    fetch_span = min(fetch_span, graph_span)
+                (start, step, values) = self.rrd_query.fetch(path, ds_num, 'end-{}s'.format(fetch_span), self.sample_time,
+                                                             resolution=resolution, consolidate=step)
+                groups.setdefault((start, step, len(values)), []).append((metric, values))
+
+            for (start, step, length) in groups.keys():
+                metrics = [metric for (metric, values) in groups[(start, step, length)]]
+                data = [values for (metric, values) in groups[(start, step, length)]]
+
+                (smooth, pred, sigma, diff, settled) = predict_numpy.predict_last_settled(data, step,
+                                                                                          interval=self.interval,
+                                                                                          count=self.count,
+                                                                                          window=self.window)
+
+                for (index, metric) in enumerate(metrics):
+                    # The LAST VDEFs look back as far as the graph goes for a known value
+                    if not settled[index] and graph_span and spans[metric] + step < graph_span:
+                        spans[metric] *= 2
+                        continue
+                    del spans[metric]
+
+                    name = '{}avg'.format(metric)
+                    rrd_output_map[name + '_smooth']    = float(smooth[index])
+                    rrd_output_map[name + '_pred']      = float(pred[index])
+                    rrd_output_map[name + '_sigma']     = float(sigma[index])
+                    rrd_output_map[name + '_diff']      = float(diff[index])
+
+        if(self.debug):
+            for metric in rrd_output_map.keys():
+                sys.stderr.write('{} = {}\n'.format(metric, rrd_output_map[metric]))
+
+        return rrd_output_map
+
+    def query_profile(self):
+        '''
+        query_profile works out the predictions from the past sample windows precomputed by
+        predict_profile.py, so only the current window gets fetched. Metrics without a usable
+        profile are worked out from their sample windows instead (see query_points).
+        The returned dict is laid out like the one from query_rpn.
+        '''
+        import predict_profile
+
+        profile = predict_profile.load_profile(self.profile_dir, self.invID, self.service_name)
+        if profile is not None and not profile.matches(self.interval, self.count, self.window):
+            profile = None
+
+        rrd_output_map = {}
+        for metric in self.metrics_by_file():
+            (path, ds_num) = self.label_dict[metric]
+
+            result = None
+            if profile is not None:
+                result = self.predict_profile(profile, metric, path, ds_num)
+            if result is None:
+                if self.debug:
+                    sys.stderr.write('No usable profile for {}, working it out\n'.format(metric))
+                result = self.predict_points(path, ds_num)
+            (smooth, pred, sigma, diff) = result
+
+            name = '{}avg'.format(metric)
+            rrd_output_map[name + '_smooth']    = smooth
+            rrd_output_map[name + '_pred']      = pred
+            rrd_output_map[name + '_sigma']     = sigma
+            rrd_output_map[name + '_diff']      = diff
+
+        if(self.debug):
+            for metric in rrd_output_map.keys():
+                sys.stderr.write('{} = {}\n'.format(metric, rrd_output_map[metric]))
+
+        return rrd_output_map
+
+    def predict_profile(self, profile, metric, path, ds_num):
+        '''
+        predict_profile fetches the current sample window of one data source and adds it to the
+        profile's sums for its slot. It returns (smooth, pred, sigma, diff), or None if the profile
+        doesn't cover the data source at the current time.
+        Like predict_points, smooth and diff are taken at the last step smooth is known.
+        '''
+        import predict_state
+
+        if metric not in profile.meta['metrics']:
+            return None
+        span = (abs(self.count) - 1) * self.interval + 2 * self.window
+        (resolution, step) = self.resolution(path, ds_num, span)
+        locstep = predict_math.steps(self.window, step)
+        smooth_steps = predict_math.steps(self.window / 2, step)
+
+        (start, fetch_step, values) = self.rrd_query.fetch(path, ds_num,
+                                                           'end-{}s'.format(self.window + (smooth_steps + 2) * step),
+                                                           self.sample_time, resolution=resolution, consolidate=step)
+        first_pos = start // fetch_step + 1
+        last_pos = first_pos + len(values) - 1
+        # The profile's fingerprint went through JSON, so the steps are a list
+        key = predict_state.fingerprint(path, ds_num, self.interval, self.count, self.window, [resolution, step])
+
+        def sample(pos):
+            if first_pos <= pos <= last_pos:
+                return values[pos - first_pos]
+            return predict_math.nan
+
+        def predict_at(pos):
+            sums = profile.lookup(metric, key, fetch_step, pos)
+            if sums is None:
+                return None
+            (center, total, total2, count) = sums
+            for offset in range(locstep + 1):
+                value = sample(pos - offset)
+                if not predict_math.isnan(value):
+                    total += value - center
+                    total2 += (value - center) * (value - center)
+                    count += 1
+            (pred, sigma) = predict_math.predict(total, total2, count)
+            return (pred + center, sigma)
+
+        result = predict_at(last_pos)
+        if result is None:
+            return None
+        (pred, sigma) = result
+
+        smooth = predict_math.nan
+        diff = predict_math.nan
+        for pos in range(last_pos, last_pos - 2 * smooth_steps, -1):
+            if not predict_math.isnan(sample(pos)):
+                smooth_pos = min(last_pos, pos + smooth_steps - 1)
+                smooth = predict_math.trend_nan([sample(smooth_pos - offset)
+                                                 for offset in reversed(range(smooth_steps))], smooth_steps)
+                result = predict_at(smooth_pos)
+                if result is None:
+                    return None
+                diff = predict_math.difference(smooth, result[0], result[1])
+                break
+
+        return (smooth, pred, sigma, diff)
+
+    def verify_output(self, rrd_output_map):
+        '''
+        verify_output reruns the check as a regular rrd query and reports any values that
+        differ from rrd_output_map by more than the rrd print precision. It is meant for
+        checking the other modes against rrdtool.
+        '''
+        reference = self.query_rpn()
+
+        for name in sorted(rrd_output_map.keys()):
+            value = rrd_output_map[name]
+            expected = reference.get(name, predict_math.nan)
+            if predict_math.isnan(value) and predict_math.isnan(expected):
+                continue
+            if predict_math.isnan(value) or predict_math.isnan(expected) or abs(value - expected) > 0.005:
+                sys.stderr.write('verify: {} {}={} rpn={}\n'.format(name, self.mode, value, expected))
+            elif self.debug:
+                sys.stderr.write('verify: {} ok\n'.format(name))
+
+    def update_state(self, state, key, path, ds_num, resolution=None, step=None):
+        '''
+        update_state brings a PredictState up to sample_time. If there is no usable state
+        (none stored, or the rrd went backwards) a new one is built from the full history.
+        The rows are fetched at resolution and consolidated to step (see resolution). Both are
+        part of the key, so a state built for another step or --minrows isn't handed in.
+        '''
+        span = abs(self.count) * self.interval
+
+        if state is not None:
+            # Refetch the trailing window as well, the newest steps may not have been filled in last time
+            rewind = predict_math.steps(self.window, state.step) + 1
+            (start, fetch_step, values) = self.rrd_query.fetch(path, ds_num,
+                                                               (state.last_pos - rewind) * state.step,
+                                                               self.sample_time,
+                                                               resolution=resolution, consolidate=state.step)
+            if fetch_step == state.step and start // fetch_step + len(values) >= state.last_pos:
+                state.absorb(start, fetch_step, values)
+                return state
+
+            if self.debug:
+                sys.stderr.write('Rebuilding prediction state for {}\n'.format(path))
+
+        (start, step, values) = self.rrd_query.fetch(path, ds_num, 'end-{}s'.format(span), self.sample_time,
+                                                     resolution=resolution, consolidate=step)
+        import predict_state
+        state = predict_state.PredictState(key, step, self.interval, self.count)
+        state.absorb(start, step, values)
+
+        return state
 
 class PredictSummary(nagiosplugin.Summary):
     '''
@@ -192,24 +744,27 @@ class PredictSummary(nagiosplugin.Summary):
 
 #    def problem(self, results):
 
-@nagiosplugin.guarded
-def main():
-    # Come up with a decent default perfdata path that accounts for OMD
+def default_perfdata_path():
+    '''
+    default_perfdata_path comes up with a decent default perfdata path that accounts for OMD
+    '''
     if os.environ.get('OMD_ROOT', ''):
-       perfdata_path = "{}/var/pnp4nagios/perfdata".format(os.environ.get('OMD_ROOT', ''))
+       return "{}/var/pnp4nagios/perfdata".format(os.environ.get('OMD_ROOT', ''))
     else:
-       perfdata_path = "/usr/local/pnp4nagios/perfdata"
-    # Setup argparse to parse the command line.
-    cmdParser = argparse.ArgumentParser(description='check_predicted.py options')
-    cmdParser.add_argument('-H ', '--host', dest='host', action='store',
-                           help='hostname to query')
+       return "/usr/local/pnp4nagios/perfdata"
+
+def add_predict_arguments(cmdParser):
+    '''
+    add_predict_arguments adds the options that control how a service is predicted and alerted on.
+    These are shared between check_predicted.py and the bulk runner.
+    '''
     cmdParser.add_argument('--path', dest='path', action='store',
-                           default=perfdata_path,
+                           default=default_perfdata_path(),
                            help='Path to perfdata directory')
-    cmdParser.add_argument('--servicename', dest='service_name', action='store',
-                           default='Interface_1', help='service to query')
     cmdParser.add_argument('--sm', dest='ds_name', action='store',
-                           default='out', help='specific submetric to query')
+                           default=None, help='Regex of the metrics to check. Default is all of them')
+    cmdParser.add_argument('--index', dest='index', action='store',
+                           help='Service metadata index directory. Default is to parse the service XML every time')
     cmdParser.add_argument('-w', '--warn', dest='warn_coeff', action='store',
                            default=1, help='sigma coefficient variation before warn - higher is less sensitive')
     cmdParser.add_argument('-c', '--crit', dest='crit_coeff', action='store',
@@ -224,34 +779,98 @@ def main():
                            default=604800, help='Interval between samples (In seconds)')
     cmdParser.add_argument('--samplewindow', dest='sample_window', action='store', type=int,
                            default=1800, help='Size of sample window (In seconds)')
-    cmdParser.add_argument('--debug', dest='debug', action='store', type=int, choices=xrange(0, 2),
+    cmdParser.add_argument('--executor', dest='executor', action='store',
+                           choices=['auto'] + sorted(rrd_query.executor_dict.keys()),
+                           default='auto', help='How to run rrd queries. auto uses librrd if available')
+    cmdParser.add_argument('--daemon', dest='daemon', action='store',
+                           help='rrdcached address to flush the rrd files through, all in one batch, before reading them')
+    cmdParser.add_argument('--mode', dest='mode', action='store', choices=['rpn', 'incremental', 'points', 'numpy', 'profile'],
+                           default='rpn', help='How to work out predictions. incremental keeps state between runs, points only fetches the sample windows, numpy computes with NumPy, profile uses the profiles built by predict_profile.py')
+    cmdParser.add_argument('--statedir', dest='state_dir', action='store',
+                           default='{}/tmp/check_predicted'.format(os.environ.get('OMD_ROOT', '')),
+                           help='Directory for the incremental prediction state')
+    cmdParser.add_argument('--profiledir', dest='profile_dir', action='store',
+                           default='{}/var/check_predicted/profiles'.format(os.environ.get('OMD_ROOT', '')),
+                           help='Directory of the profiles built by predict_profile.py')
+    cmdParser.add_argument('--cachedir', dest='cache_dir', action='store',
+                           help='Directory to cache results in, so rechecks on unchanged data are free. Default is no cache')
+    cmdParser.add_argument('--cachettl', dest='cache_ttl', action='store', type=int,
+                           default=60, help='Seconds a cached result is good for')
+    cmdParser.add_argument('--cachesize', dest='cache_size', action='store', type=int,
+                           default=10000, help='Number of results to keep in the cache')
+    cmdParser.add_argument('--minrows', dest='min_rows', action='store', type=int,
+                           default=0, help='Read the coarsest archive with at least this many rows per sample window whose step divides the step the rpn query reads at. The results are those of the rpn query, except where more than the xff of the rows in an archive step are unknown. Default 0 reads the archive the rpn query reads')
+    cmdParser.add_argument('--verify', dest='verify', action='store_true',
+                           help='Compare the selected mode against a regular rrd query and report differences')
+    cmdParser.add_argument('--timing', dest='timing', action='store_true',
+                           help='Report the time spent in each phase of the check as perfdata')
+    cmdParser.add_argument('--trace', dest='trace_file', action='store',
+                           help='JSON lines file to append the phase timings of each check to')
+    cmdParser.add_argument('--promdir', dest='prom_dir', action='store',
+                           help='Directory to write the phase timings to as Prometheus textfiles')
+    cmdParser.add_argument('--debug', dest='debug', action='store', type=int, choices=range(0, 2),
                            default=0, help='Debug verbosity level')
-    args = cmdParser.parse_args()
-    
-    # Initialize the rrd query
+
+def build_query(args, host, executor):
+    '''
+    build_query sets up an empty rrd query for the time range the check options ask for.
+    '''
     # I know start_time is a kludge. Will fix.
+    return rrd_query.RRDQuery(out_file='/tmp/{}'.format(host),
+                              start_time='end-6w',
+                              end_time=args.sample_time,
+                              debug=args.debug,
+                              executor=executor,
+                              daemon=args.daemon,
+                              min_rows=args.min_rows)
 
-#invID=args.host,
-#    perfdata_path=args.path,
-#        service_name=args.service_name,
-#
+def build_check(args, host, service_name, flush=True, executor=None, label_dict=None):
+    '''
+    build_check sets up the rrd query, the MetricPredict resource and the nagiosplugin Check
+    object (with its contexts) for one host/service pair. args is the parsed argparse namespace.
+    flush is passed on to MetricPredict. A long running caller can pass in its own executor
+    and an already looked up label_dict.
+    '''
+    if executor is None:
+        executor = rrd_query.get_executor(args.executor)
 
-    predict_query = rrd_query.RRDQuery(out_file='/tmp/{}'.format(args.host),
-                                       start_time='end-6w',
-                                       end_time=args.sample_time,
-                                       debug=args.debug)
+    # Initialize the rrd query
+    predict_query = build_query(args, host, executor)
     
+    # Only time the phases if something is going to look at the timings
+    timer = None
+    if args.timing or args.trace_file or args.prom_dir:
+        timer = check_timing.PhaseTimer(perfdata=args.timing, trace_file=args.trace_file, prom_dir=args.prom_dir)
+
+    cache = None
+    if args.cache_dir:
+        import result_cache
+        cache = result_cache.ResultCache(args.cache_dir, args.cache_ttl, args.cache_size)
+
+    # Look the metrics up in the index if there is one
+    if label_dict is None and args.index:
+        with (timer or check_timing.null_timer).phase('load_xml'):
+            label_dict = service_index.ServiceIndex(args.index, args.path).lookup(host, service_name)
+
     # Initialize the resource
     predict_resource = MetricPredict(predict_query,
-                                     invID=args.host,
+                                     invID=host,
                                      perfdata_path=args.path,
-                                     service_name=args.service_name,
+                                     service_name=service_name,
                                      ds_match=args.ds_name,
                                      sample_time=args.sample_time,
                                      count=args.sample_count,
                                      interval=args.sample_interval,
                                      window=args.sample_window,
-                                     debug=args.debug)
+                                     debug=args.debug,
+                                     mode=args.mode,
+                                     state_dir=args.state_dir,
+                                     verify=args.verify,
+                                     label_dict=label_dict,
+                                     flush=flush,
+                                     timer=timer,
+                                     profile_dir=args.profile_dir,
+                                     cache=cache)
     
     # Initialize the nagios plugin Check object
     check = nagiosplugin.Check(predict_resource, PredictSummary())
@@ -265,6 +884,43 @@ def main():
                 if(args.debug):
                     check.add(nagiosplugin.ScalarContext(metric + submetric, None, None))
 
+    if args.timing:
+        check.add(nagiosplugin.ScalarContext('timing', None, None))
+
+    return check
+
+def run_check(check, verbose=0, timeout=None):
+    '''
+    run_check runs the check without exiting and returns a tuple of the exit code and the
+    plugin output, formatted the same way nagiosplugin's Check.main() would print it.
+    A nagiosplugin.Timeout is raised if the check takes longer than timeout seconds.
+    '''
+    if timeout:
+        nagiosplugin.platform.with_timeout(timeout, check)
+    else:
+        check()
+    output = nagiosplugin.output.Output(logging.StreamHandler(io.StringIO()), verbose)
+    output.add(check)
+    return (check.exitcode, str(output))
+
+def build_parser():
+    '''
+    build_parser sets up argparse to parse the check_predicted.py command line.
+    '''
+    cmdParser = argparse.ArgumentParser(description='check_predicted.py options')
+    cmdParser.add_argument('-H ', '--host', dest='host', action='store',
+                           help='hostname to query')
+    cmdParser.add_argument('--servicename', dest='service_name', action='store',
+                           default='Interface_1', help='service to query')
+    add_predict_arguments(cmdParser)
+    return cmdParser
+
+@nagiosplugin.guarded
+def main():
+    # Setup argparse to parse the command line.
+    args = build_parser().parse_args()
+    
+    check = build_check(args, args.host, args.service_name)
 
     check.main(args.debug, args.timeout)
     
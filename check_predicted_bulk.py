@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# check_predicted_bulk.py
+# Runs check_predicted over a whole pnp4nagios perfdata tree in one go.
+#
+# Instead of check_mk launching one check_predicted.py per service, this walks <path>/<host>/<service>.xml
+# (or reads a list of host/service pairs), checks every service with a pool of worker processes and
+# writes the results out in one shot. The results can go to a check_mk agent spool file (as piggyback
+# local checks) or to the monitoring core's command pipe as passive check results.
+#
+# The warn/crit options mean exactly the same thing they do for check_predicted.py.
+# In rpn mode, the queries of all the services in a batch are merged into as few rrdtool runs as
+# the command length allows, and batches never span hosts, so a switch's interfaces get checked together.
+#
+# A simple example would be:
+# check_predicted_bulk.py --services '^Interface_' --output spool --spoolfile /var/lib/check_mk_agent/spool/900_check_predicted
+
+
+import sys
+import os
+import re
+import time
+import argparse
+import multiprocessing
+import nagiosplugin
+import check_predicted
+import service_index
+import rrdcached
+import rrd_query
+
+def find_services(perfdata_path, host_match=None, service_match=None):
+    '''
+    find_services walks the perfdata tree and returns a list of (host, service) tuples
+    for every <host>/<service>.xml found. host_match and service_match are optional regexes.
+    '''
+    services = []
+
+    for host in sorted(os.listdir(perfdata_path)):
+        host_path = os.path.join(perfdata_path, host)
+        if not os.path.isdir(host_path):
+            continue
+        if host_match and not re.search(host_match, host):
+            continue
+
+        for file_name in sorted(os.listdir(host_path)):
+            if not file_name.endswith('.xml'):
+                continue
+            service_name = file_name[:-len('.xml')]
+            if service_match and not re.search(service_match, service_name):
+                continue
+            services.append((host, service_name))
+
+    return services
+
+def read_service_list(list_path):
+    '''
+    read_service_list reads a file of "host service" lines and returns a list of (host, service) tuples.
+    Blank lines and lines starting with # are skipped.
+    '''
+    services = []
+
+    with open(list_path) as list_file:
+        for line in list_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            (host, service_name) = line.split(None, 1)
+            services.append((host, service_name))
+
+    return services
+
+def unknown_result(host, service_name, err):
+    '''
+    unknown_result turns an exception into an UNKNOWN result.
+    '''
+    if isinstance(err, nagiosplugin.Timeout):
+        return (host, service_name, 3, 'UNKNOWN - Timeout: check execution aborted after {}'.format(err), [])
+    return (host, service_name, 3, 'UNKNOWN - {}: {}'.format(type(err).__name__, err), [])
+
+def check_services(job):
+    '''
+    check_services runs a batch of checks in a worker process. job is a tuple of (args, services)
+    where services is a list of (host, service) tuples. When rrdcached is in use, the rrd files of
+    the whole batch are flushed together before any of them are read. In rpn mode the queries of the
+    whole batch are compiled into as few rrdtool runs as possible, which together get the --timeout
+    of one check.
+    A list of (host, service, exitcode, status line, perfdata list) tuples is returned. Anything that goes
+    wrong is turned into an UNKNOWN result so that one broken service doesn't take out the whole run.
+    '''
+    (args, services) = job
+    results = []
+    checks = []
+
+    try:
+        executor = rrd_query.get_executor(args.executor)
+    except rrd_query.RRDQueryError as err:
+        return [unknown_result(host, service_name, err) for (host, service_name) in services]
+
+    try:
+        for (host, service_name) in services:
+            try:
+                checks.append((host, service_name, check_predicted.build_check(args, host, service_name, flush=False,
+                                                                               executor=executor)))
+            except Exception as err:
+                results.append(unknown_result(host, service_name, err))
+
+        if args.daemon:
+            paths = set()
+            for (host, service_name, check) in checks:
+                for resource in check.resources:
+                    paths.update(resource.rrd_files())
+            try:
+                rrdcached.flush(args.daemon, sorted(paths))
+            except rrdcached.RRDCachedError as err:
+                return results + [unknown_result(host, service_name, err) for (host, service_name, check) in checks]
+
+        if args.mode == 'rpn' and checks:
+            compiler = rrd_query.QueryCompiler(lambda: check_predicted.build_query(args, checks[0][0], executor),
+                                               max_command_length=args.max_command_length,
+                                               debug=args.debug)
+            for (host, service_name, check) in checks:
+                for resource in check.resources:
+                    compiler.add(resource, resource.define_query, resource.parse_output)
+            try:
+                # The merged queries get the same timeout a check does, so a slow batch can't hang the run
+                outputs = {}
+                nagiosplugin.platform.with_timeout(args.timeout, lambda: outputs.update(compiler.run()))
+                for (resource, rrd_output_map) in outputs.items():
+                    resource.use_output(rrd_output_map)
+            except Exception as err:
+                results.extend([unknown_result(host, service_name, err) for (host, service_name, check) in checks])
+                checks = []
+
+        for (host, service_name, check) in checks:
+            try:
+                (exitcode, output) = check_predicted.run_check(check, timeout=args.timeout)
+                status = output.split('\n')[0].split(' | ')[0]
+                results.append((host, service_name, exitcode, status, check.perfdata))
+            except Exception as err:
+                results.append(unknown_result(host, service_name, err))
+
+        return results
+    finally:
+        # Don't leave a coprocess behind in the worker, however the batch went
+        if hasattr(executor, 'close'):
+            executor.close()
+
+def batch_services(services, batch_size):
+    '''
+    batch_services splits the list of (host, service) tuples into batches of at most batch_size
+    services, each of a single host.
+    '''
+    hosts = {}
+    for (host, service_name) in services:
+        hosts.setdefault(host, []).append((host, service_name))
+
+    batches = []
+    for host in sorted(hosts.keys()):
+        host_services = hosts[host]
+        for index in range(0, len(host_services), batch_size):
+            batches.append(host_services[index:index + batch_size])
+
+    return batches
+
+def write_spool(results, spool_file, service_prefix):
+    '''
+    write_spool writes the results to a check_mk agent spool file. Each host gets a piggyback
+    section holding a local check per service. The file is replaced atomically so the agent
+    never sees a half written file.
+    '''
+    hosts = {}
+    for (host, service_name, exitcode, status, perfdata) in results:
+        hosts.setdefault(host, []).append((service_name, exitcode, status, perfdata))
+
+    tmp_file = '{}.{}.tmp'.format(spool_file, os.getpid())
+    with open(tmp_file, 'w') as spool:
+        for host in sorted(hosts.keys()):
+            spool.write('<<<<{}>>>>\n'.format(host))
+            spool.write('<<<local>>>\n')
+            for (service_name, exitcode, status, perfdata) in hosts[host]:
+                spool.write('{} {}{} {} {}\n'.format(exitcode,
+                                                     service_prefix,
+                                                     service_name,
+                                                     '|'.join(perfdata) or '-',
+                                                     status))
+            spool.write('<<<<>>>>\n')
+
+    os.rename(tmp_file, spool_file)
+
+def write_passive(results, cmd_file, service_prefix):
+    '''
+    write_passive submits the results as passive service check results through the
+    nagios/icinga external command file.
+    '''
+    now = int(time.time())
+
+    with open(cmd_file, 'a') as cmd_pipe:
+        for (host, service_name, exitcode, status, perfdata) in results:
+            output = status
+            if perfdata:
+                output += ' | ' + ' '.join(perfdata)
+            cmd_pipe.write('[{}] PROCESS_SERVICE_CHECK_RESULT;{};{}{};{};{}\n'.format(now,
+                                                                                    host,
+                                                                                    service_prefix,
+                                                                                    service_name,
+                                                                                    exitcode,
+                                                                                    output))
+
+def build_parser():
+    '''
+    build_parser sets up argparse to parse the check_predicted_bulk.py command line.
+    '''
+    cmdParser = argparse.ArgumentParser(description='check_predicted_bulk.py options')
+    cmdParser.add_argument('--servicelist', dest='service_list', action='store',
+                           help='File of "host service" lines to check. Default is to walk --path')
+    cmdParser.add_argument('--hosts', dest='host_match', action='store',
+                           help='Only check hosts matching this regex')
+    cmdParser.add_argument('--services', dest='service_match', action='store',
+                           help='Only check services matching this regex')
+    cmdParser.add_argument('--workers', dest='workers', action='store', type=int,
+                           default=multiprocessing.cpu_count(), help='Number of worker processes')
+    cmdParser.add_argument('--batchsize', dest='batch_size', action='store', type=int,
+                           default=64, help='Number of services of a host a worker takes at a time (and flushes and queries together)')
+    cmdParser.add_argument('--maxcommand', dest='max_command_length', action='store', type=int,
+                           default=131072, help='Longest rrdtool command a batch of rpn queries is merged into')
+    cmdParser.add_argument('--output', dest='output', action='store', choices=['spool', 'passive'],
+                           default='spool', help='Where to send the results')
+    cmdParser.add_argument('--spoolfile', dest='spool_file', action='store',
+                           default='/var/lib/check_mk_agent/spool/900_check_predicted',
+                           help='check_mk agent spool file to write')
+    cmdParser.add_argument('--cmdfile', dest='cmd_file', action='store',
+                           default='{}/tmp/run/nagios.cmd'.format(os.environ.get('OMD_ROOT', '')),
+                           help='External command file for passive results')
+    cmdParser.add_argument('--serviceprefix', dest='service_prefix', action='store',
+                           default='Predicted_', help='Prefix for the service names the results are reported under')
+    check_predicted.add_predict_arguments(cmdParser)
+    return cmdParser
+
+def main():
+    # Setup argparse to parse the command line.
+    args = build_parser().parse_args()
+
+    if args.service_list:
+        services = read_service_list(args.service_list)
+    elif args.index:
+        # Bring the index up to date once, so the workers only ever get hits
+        services = [(host, service_name)
+                    for (host, service_name) in service_index.ServiceIndex(args.index, args.path).refresh()
+                    if (not args.host_match or re.search(args.host_match, host))
+                    and (not args.service_match or re.search(args.service_match, service_name))]
+    else:
+        services = find_services(args.path, args.host_match, args.service_match)
+
+    if args.debug:
+        sys.stderr.write('Checking {} services with {} workers\n'.format(len(services), args.workers))
+
+    jobs = [(args, batch) for batch in batch_services(services, args.batch_size)]
+
+    # Bounded pool of workers. Results come back in whatever order they finish.
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        results = []
+        for batch in pool.imap_unordered(check_services, jobs):
+            results.extend(batch)
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.output == 'spool':
+        write_spool(results, args.spool_file, args.service_prefix)
+    else:
+        write_passive(results, args.cmd_file, args.service_prefix)
+
+    if args.debug:
+        for (host, service_name, exitcode, status, perfdata) in results:
+            sys.stderr.write('{} {} {} {}\n'.format(host, service_name, exitcode, status))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# check_server.py - Keep check_predicted resident and answer checks over a unix socket
+# Retooled for OMD/check-mk 2020
+#
+# Every run of check_predicted.py pays for starting python, importing nagiosplugin and friends,
+# parsing the service XML and starting rrdtool. check_server.py does all of that once and then
+# answers check requests from check_client.py over a unix socket. It keeps the service metadata in
+# memory and a pool of 'rrdtool -' coprocesses (rrdtool's remote control mode) running. Each request
+# gets the same exit code and output check_predicted.py would have produced.
+#
+# Requests are a JSON line {"argv": [...]} holding the check_predicted.py arguments, the reply a
+# JSON line {"exitcode": n, "output": "..."}. --executor mmap requests read the files directly,
+# everything else goes through the coprocess pool. The --timeout of a request is enforced by the client.
+#
+# A simple example would be:
+# check_server.py --socket $OMD_ROOT/tmp/run/check_predicted.sock --workers 8
+
+
+import os
+import json
+import argparse
+import traceback
+import rrd_query
+import service_index
+import check_predicted
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def default_socket_path():
+    '''
+    default_socket_path puts the socket in the OMD site's run directory if there is one.
+    '''
+    return '{}/tmp/run/check_predicted.sock'.format(os.environ.get('OMD_ROOT', ''))
+
+class CheckHandler(socketserver.StreamRequestHandler):
+    '''
+    CheckHandler answers one check request.
+    '''
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            (exitcode, output) = self.server.run(request['argv'])
+        except (ValueError, KeyError, TypeError) as err:
+            (exitcode, output) = (3, 'UNKNOWN: Bad request to check server: {}\n'.format(err))
+
+        self.wfile.write((json.dumps({'exitcode':exitcode, 'output':output}) + '\n').encode('utf-8'))
+
+class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    CheckServer runs every request in its own thread. The number of checks running rrdtool at
+    the same time is bounded by the size of the coprocess pool.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=4, debug=0):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, CheckHandler)
+
+        self.debug          = debug
+        self.labels         = service_index.MemoryIndex()
+        self.parser         = check_predicted.build_parser()
+        self.executors      = queue.Queue()
+        for index in range(workers):
+            self.executors.put(rrd_query.PipeExecutor())
+        self.mmap_executor  = None
+
+    def run(self, argv):
+        '''
+        run runs one check with the check_predicted.py arguments argv and returns (exitcode, output).
+        '''
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit:
+            return (3, 'UNKNOWN: Invalid arguments: {}\n'.format(' '.join(argv)))
+
+        if args.executor == 'mmap':
+            if self.mmap_executor is None:
+                self.mmap_executor = rrd_query.MmapExecutor()
+            executor = self.mmap_executor
+            pooled = False
+        else:
+            executor = self.executors.get()
+            pooled = True
+
+        # Errors are reported the way nagiosplugin's runtime would: before the check runs with a
+        # traceback, while it runs with the check name and a traceback only in debug mode
+        check = None
+        try:
+            label_dict = self.labels.lookup(args.path, args.host, args.service_name)
+            check = check_predicted.build_check(args, args.host, args.service_name,
+                                                executor=executor, label_dict=label_dict)
+            return check_predicted.run_check(check, verbose=args.debug)
+        except Exception as err:
+            output = 'UNKNOWN: {}\n'.format(traceback.format_exception_only(type(err), err)[0].strip())
+            if check is not None:
+                output = '{} {}'.format(check.name.upper(), output)
+            if check is None or args.debug:
+                output += traceback.format_exc()
+            return (3, output)
+        finally:
+            if pooled:
+                self.executors.put(executor)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        while not self.executors.empty():
+            self.executors.get().close()
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='check_server.py options')
+    cmdParser.add_argument('--socket', dest='socket_path', action='store',
+                           default=default_socket_path(), help='Unix socket to listen on')
+    cmdParser.add_argument('--workers', dest='workers', action='store', type=int,
+                           default=4, help='Number of rrdtool coprocesses to keep running')
+    cmdParser.add_argument('--debug', dest='debug', action='store', type=int,
+                           default=0, help='Debug verbosity level')
+    args = cmdParser.parse_args()
+
+    server = CheckServer(args.socket_path, args.workers, args.debug)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket_path)
+
+if __name__ == '__main__':
+    main()
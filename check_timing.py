@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# check_timing.py - Per phase timing of a check
+# Retooled for OMD/check-mk 2020
+#
+# PhaseTimer records how long each phase of a check took (loading the service metadata, building
+# the query, running it, parsing the output...) along with a few counters like the command length
+# and the number of metrics and CDEFs. The results can be written as a JSON line to a trace file
+# and as a Prometheus textfile, and MetricPredict can hand them back as perfdata.
+#
+# When timing is off, null_timer is used instead. Its phase() hands back the same do-nothing
+# context manager every time, so leaving the instrumentation in the hot path costs next to nothing.
+
+import os
+import re
+import json
+import time
+
+def prom_label(value):
+    '''
+    prom_label escapes a label value for the Prometheus text format. A stray quote, backslash or
+    newline would make node_exporter drop the whole file.
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class NullPhase:
+    '''
+    NullPhase is a context manager that does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class NullTimer:
+    '''
+    NullTimer has the same interface as PhaseTimer but records nothing.
+    '''
+    enabled     = False
+    perfdata    = False
+    null_phase  = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def count(self, name, value):
+        pass
+
+    def write(self, host, service_name, mode):
+        pass
+
+null_timer = NullTimer()
+
+class Phase:
+    '''
+    Phase times one phase of a PhaseTimer. Time spent in a phase that is entered more than once is added up.
+    '''
+
+    def __init__(self, timer, name):
+        self.timer  = timer
+        self.name   = name
+        self.start  = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+class PhaseTimer:
+    '''
+    PhaseTimer records phase durations (in seconds) and counters for one check.
+    Data structures maintained include:
+    phases -        A list of phase names in the order they were first entered
+    seconds -       A dict mapping phase names to the time spent in them
+    counters -      A dict of counters (command_length, metrics, cdefs...)
+    perfdata -      Whether MetricPredict should report the timings as perfdata
+    trace_file -    JSON lines file to append a record to, or None
+    prom_dir -      Directory to write a Prometheus textfile to, or None
+    '''
+    enabled = True
+
+    def __init__(self, perfdata=False, trace_file=None, prom_dir=None):
+        self.phases     = []
+        self.seconds    = {}
+        self.counters   = {}
+        self.perfdata   = perfdata
+        self.trace_file = trace_file
+        self.prom_dir   = prom_dir
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        if name not in self.seconds:
+            self.phases.append(name)
+            self.seconds[name] = 0.0
+        self.seconds[name] += seconds
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def write(self, host, service_name, mode):
+        '''
+        write appends the timings to the trace file and writes the Prometheus textfile,
+        whichever of them are set up.
+        '''
+        if self.trace_file:
+            record = {'time':int(time.time()),
+                      'host':host,
+                      'service':service_name,
+                      'mode':mode,
+                      'phases':self.seconds,
+                      'counters':self.counters}
+            # One write per record, so lines from concurrent checks don't get mixed up
+            with open(self.trace_file, 'a') as trace:
+                trace.write(json.dumps(record, sort_keys=True) + '\n')
+
+        if self.prom_dir:
+            self.write_prom(host, service_name, mode)
+
+    def write_prom(self, host, service_name, mode):
+        '''
+        write_prom writes a textfile for the node_exporter textfile collector, one per host/service.
+        The file is replaced atomically.
+        '''
+        labels = 'host="{}",service="{}",mode="{}"'.format(prom_label(host), prom_label(service_name), prom_label(mode))
+        lines = ['# HELP check_predicted_phase_seconds Time spent in each phase of the check',
+                 '# TYPE check_predicted_phase_seconds gauge']
+        for name in self.phases:
+            lines.append('check_predicted_phase_seconds{{{},phase="{}"}} {}'.format(labels, name, self.seconds[name]))
+        for name in sorted(self.counters.keys()):
+            lines.append('# TYPE check_predicted_{} gauge'.format(name))
+            lines.append('check_predicted_{}{{{}}} {}'.format(name, labels, self.counters[name]))
+
+        file_name = 'check_predicted_{}.prom'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', '{}_{}'.format(host, service_name)))
+        prom_file = os.path.join(self.prom_dir, file_name)
+        tmp_file = '{}.{}.tmp'.format(prom_file, os.getpid())
+        with open(tmp_file, 'w') as prom:
+            prom.write('\n'.join(lines) + '\n')
+        os.rename(tmp_file, prom_file)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# fleet_score.py - Score many hosts and services at once
+# Retooled for OMD/check-mk 2020
+#
+# When something upstream goes wrong, hundreds of services go off at once, each checked on its own with
+# its own rrdtool run. fleet_score.py takes every (host, service, metric) series matching the host,
+# service and metric regexes (say every Interface_ service of a host group), fetches them all and works
+# out the d/s ratios as one matrix operation with NumPy (see predict_numpy.score_samples). It then reports
+# across the fleet: how many series are above the -w and -c coefficients, what share that is of the
+# series with a known ratio, and the --top most anomalous series. --series writes every score out as
+# JSON lines as well.
+#
+# Use --executor mmap (or librrd) so the series are read without running rrdtool at all.
+#
+# A simple example would be:
+# fleet_score.py --hosts '^core-' --services '^Interface_' --sm '^(in|out)$' --executor mmap --top 20
+
+import sys
+import json
+import argparse
+import numpy
+import rrd_query
+import predict_numpy
+import service_index
+import check_predicted
+import check_predicted_bulk
+
+def find_series(args, services):
+    '''
+    find_series returns a list of (host, service, metric, path, ds_num) tuples for the metrics of
+    services (a list of (host, service) tuples) that match the --sm regex, ordered by rrd file.
+    Services whose metadata can't be read are skipped with a message on stderr.
+    '''
+    if args.index:
+        index = service_index.ServiceIndex(args.index, args.path)
+    else:
+        index = service_index.MemoryIndex()
+
+    series = []
+    for (host, service_name) in services:
+        try:
+            if args.index:
+                label_dict = index.lookup(host, service_name, args.ds_name)
+            else:
+                label_dict = index.lookup(args.path, host, service_name, args.ds_name)
+        except Exception as err:
+            sys.stderr.write('{} {}: {}: {}\n'.format(host, service_name, type(err).__name__, err))
+            continue
+        for (metric, (path, ds_num)) in label_dict.items():
+            series.append((host, service_name, metric, path, ds_num))
+
+    series.sort(key=lambda item: (item[3], item[4]))
+    return series
+
+def score_series(query, series, sample_time='now', interval=604800, count=-5, window=1800):
+    '''
+    score_series fetches every series and returns a list of (host, service, metric, smooth, pred,
+    sigma, diff) tuples. The series are read at the step the check would read them at (see
+    rrd_query.RRDQuery.read_steps), and like the check further back for series that have been unknown
+    for a while (see predict_numpy.end_settled). Series that came back with the same time range and
+    resolution are stacked into one matrix and scored together. A series that can't be fetched gets
+    NaN scores.
+    '''
+    # Enough history for the oldest window, plus the window itself
+    span = (abs(count) - 1) * interval + 2 * window
+
+    graph_span = query.graph_span()
+
+    groups = {}
+    scores = []
+    for (host, service_name, metric, path, ds_num) in series:
+        try:
+            # Read at the step the check's DEFs read, a step more as the first one can come out unknown
+            (resolution, step) = query.read_steps(path, ds_num, sample_time, window, interval, span)
+            fetch_span = span + step
+            while True:
+                if graph_span:
+                    fetch_span = min(fetch_span, graph_span)
+                (start, step, values) = query.fetch(path, ds_num, 'end-{}s'.format(fetch_span), sample_time, as_array=True,
+                                                    resolution=resolution, consolidate=step)
+                # The LAST VDEFs look back as far as the graph goes for a known value
+                if not graph_span or fetch_span >= graph_span or \
+                   predict_numpy.end_settled(values, step, interval, count, window):
+                    break
+                fetch_span *= 2
+        except rrd_query.RRDQueryError as err:
+            sys.stderr.write('{} {} {}: {}\n'.format(host, service_name, metric, err))
+            scores.append((host, service_name, metric, numpy.nan, numpy.nan, numpy.nan, numpy.nan))
+            continue
+        # Only the columns the check looks at are kept, so the matrices stay small
+        (samples, recent, current) = predict_numpy.end_samples(values, step, interval, count, window)
+        groups.setdefault((start, step, len(values)), []).append(((host, service_name, metric), samples, recent, current))
+
+    for key in groups.keys():
+        names = [item[0] for item in groups[key]]
+        samples = numpy.array([item[1] for item in groups[key]])
+        recent = numpy.array([item[2] for item in groups[key]])
+        current = numpy.array([item[3] for item in groups[key]])
+
+        (smooth, pred, sigma, diff) = predict_numpy.score_samples(samples, recent, current)
+
+        for (row, (host, service_name, metric)) in enumerate(names):
+            scores.append((host, service_name, metric,
+                           float(smooth[row]), float(pred[row]), float(sigma[row]), float(diff[row])))
+
+    return scores
+
+def summarize(scores, warn, crit, top=10):
+    '''
+    summarize returns a dict of fleet wide statistics over the scores from score_series: the number
+    of series, how many had a known d/s ratio, how many (and what share of the known ones) were above
+    warn and crit, and the top most anomalous series.
+    '''
+    diffs = numpy.array([score[6] for score in scores], dtype=float)
+    known = ~numpy.isnan(diffs)
+    known_count = int(known.sum())
+    above_warn = int((diffs[known] > warn).sum())
+    above_crit = int((diffs[known] > crit).sum())
+
+    # Highest d/s ratio first, unknowns never make the list
+    order = [index for index in numpy.argsort(-numpy.where(known, diffs, -numpy.inf), kind='stable')
+             if known[index]][:top]
+
+    return {'series': len(scores),
+            'known': known_count,
+            'above_warn': above_warn,
+            'above_crit': above_crit,
+            'share_above_warn': float(above_warn) / known_count if known_count else None,
+            'share_above_crit': float(above_crit) / known_count if known_count else None,
+            'top': [score_record(scores[index]) for index in order]}
+
+def score_record(score):
+    '''
+    score_record turns a score tuple into a dict for JSON output. JSON has no NaN, so unknowns become None.
+    '''
+    record = dict(zip(['host', 'service', 'metric', 'smooth', 'pred', 'sigma', 'diff'], score))
+    for name in record.keys():
+        if record[name] != record[name]:
+            record[name] = None
+    return record
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='fleet_score.py options')
+    cmdParser.add_argument('--servicelist', dest='service_list', action='store',
+                           help='File of "host service" lines to score. Default is to walk --path')
+    cmdParser.add_argument('--hosts', dest='host_match', action='store',
+                           help='Only score hosts matching this regex')
+    cmdParser.add_argument('--services', dest='service_match', action='store',
+                           help='Only score services matching this regex')
+    cmdParser.add_argument('--top', dest='top', action='store', type=int, default=10,
+                           help='Number of most anomalous series to report')
+    cmdParser.add_argument('--series', dest='series_file', action='store',
+                           help='JSON lines file to write the scores of every series to')
+    check_predicted.add_predict_arguments(cmdParser)
+    args = cmdParser.parse_args()
+
+    if args.service_list:
+        services = check_predicted_bulk.read_service_list(args.service_list)
+    else:
+        services = check_predicted_bulk.find_services(args.path, args.host_match, args.service_match)
+
+    series = find_series(args, services)
+
+    query = rrd_query.RRDQuery(end_time=args.sample_time,
+                               debug=args.debug,
+                               executor=rrd_query.get_executor(args.executor),
+                               daemon=args.daemon,
+                               min_rows=args.min_rows)
+    query.flush([path for (host, service_name, metric, path, ds_num) in series])
+
+    scores = score_series(query, series, args.sample_time, args.sample_interval, args.sample_count, args.sample_window)
+
+    if args.series_file:
+        with open(args.series_file, 'w') as series_file:
+            for score in scores:
+                series_file.write(json.dumps(score_record(score), sort_keys=True) + '\n')
+
+    summary = summarize(scores, float(args.warn_coeff), float(args.crit_coeff), args.top)
+    sys.stdout.write(json.dumps(summary, indent=2, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# predict_math.py - rrdtool's prediction math in plain python
+# Retooled for OMD/check-mk 2020
+#
+# These functions mirror what rrdtool's PREDICT, PREDICTSIGMA and TRENDNAN RPN operators and the
+# difference/sigma CDEF in check_predicted.py compute, so that the results can be worked out
+# outside of an rrdtool graph query. The odd corners (NaN handling, window rounding) follow rrdtool.
+
+import math
+
+nan = float('nan')
+
+def isnan(value):
+    '''
+    isnan returns True if value is NaN.
+    '''
+    return value != value
+
+def steps(seconds, step):
+    '''
+    steps converts a duration in seconds to a number of rrd steps, rounding up like rrdtool does.
+    '''
+    return int(math.ceil(float(seconds) / float(step)))
+
+def predict(total, total2, count):
+    '''
+    predict returns (prediction, sigma) from the sum, the sum of squares and the number of
+    known values found in the sample windows.
+    As with PREDICT, the prediction is NaN when there are no values. As with PREDICTSIGMA, sigma
+    is the sample standard deviation, and NaN when there are fewer than two values.
+    '''
+    pred = nan
+    sigma = nan
+
+    if count > 0:
+        pred = total / count
+
+    if count > 1:
+        variance = count * total2 - total * total
+        if variance >= 0:
+            sigma = math.sqrt(variance / (count * (count - 1.0)))
+
+    return (pred, sigma)
+
+def trend_nan(values, count):
+    '''
+    trend_nan averages the known values among the last count values (TRENDNAN).
+    '''
+    total = 0.0
+    known = 0
+
+    for value in values[-count:]:
+        if not isnan(value):
+            total += value
+            known += 1
+
+    if known:
+        return total / known
+    else:
+        return nan
+
+def difference(smooth, pred, sigma):
+    '''
+    difference returns abs(smooth - pred) / sigma, or 0 if sigma is 0.
+    Like the rrd IF it is computed with, an unknown sigma gives an unknown result.
+    '''
+    if isnan(sigma):
+        return nan
+    if sigma == 0:
+        return 0.0
+
+    return abs(smooth - pred) / sigma
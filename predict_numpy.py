@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# predict_numpy.py - rrdtool's prediction math vectorized with NumPy
+# Retooled for OMD/check-mk 2020
+#
+# The functions here work on 2d arrays of shape (series, steps), one row per data source, so the
+# predictions for every metric of a service (or many services) come out of one pass instead of a
+# PREDICT/PREDICTSIGMA/TRENDNAN CDEF per metric. NaN handling follows rrdtool (see predict_math.py):
+# unknown values are skipped, PREDICT needs one known value, PREDICTSIGMA needs two, and values from
+# before the start of the data simply aren't there.
+
+import warnings
+import numpy
+import predict_math
+
+def window_sums(data, length):
+    '''
+    window_sums returns (sum, sum of squares, count) of the known values in the trailing window of
+    length steps ending at every step. data should already be centered (see predict_series).
+    Each window is added up on its own, like rrdtool does, rather than as the difference of running
+    sums, whose rounding grows with the length of the series.
+    '''
+    known = ~numpy.isnan(data)
+    values = numpy.where(known, data, 0.0)
+    squares = values * values
+
+    total = numpy.zeros(data.shape)
+    total2 = numpy.zeros(data.shape)
+    count = numpy.zeros(data.shape)
+    for offset in range(min(length, data.shape[-1])):
+        total += shift(values, offset)
+        total2 += shift(squares, offset)
+        count += shift(known, offset)
+
+    return (total, total2, count)
+
+def shift(series, steps):
+    '''
+    shift moves series steps to the right along the time axis, filling with zeros.
+    '''
+    if steps == 0:
+        return series
+    shifted = numpy.zeros(series.shape)
+    if steps < series.shape[-1]:
+        shifted[..., steps:] = series[..., :-steps]
+    return shifted
+
+def predict_series(data, step, interval=604800, count=-5, window=1800, newest_unknown=False):
+    '''
+    predict_series returns (pred, sigma) arrays the same shape as data, holding what
+    step,count,window,ds,PREDICT and PREDICTSIGMA would give at every step.
+    With newest_unknown, each step is worked out as if its own value were unknown, the way the
+    newest step of a graph whose rows are consolidated is (see rrd_query.reduce_rows).
+    '''
+    data = numpy.asarray(data, dtype=float)
+
+    # Center every series on its mean before summing. It doesn't change sigma, but keeps the
+    # sum of squares from swamping the variance for large values (e.g. bytes per second).
+    # A series without any known values has no mean, and nanmean warns about it
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        center = numpy.nanmean(data, axis=-1, keepdims=True)
+    center = numpy.where(numpy.isnan(center), 0.0, center)
+
+    locstep = predict_math.steps(window, step)
+    shiftstep = predict_math.steps(interval, step)
+    (window_sum, window_sum2, window_count) = window_sums(data - center, locstep + 1)
+
+    total = numpy.zeros(data.shape)
+    total2 = numpy.zeros(data.shape)
+    known = numpy.zeros(data.shape)
+    for loop in range(abs(count)):
+        total += shift(window_sum, loop * shiftstep)
+        total2 += shift(window_sum2, loop * shiftstep)
+        known += shift(window_count, loop * shiftstep)
+
+    if newest_unknown:
+        current = numpy.where(numpy.isnan(data), 0.0, data - center)
+        total -= current
+        total2 -= current * current
+        known -= ~numpy.isnan(data)
+
+    with numpy.errstate(all='ignore'):
+        pred = numpy.where(known > 0, total / known, numpy.nan) + center
+        # The centered values round where rrdtool's sums of a window of equal values come out exact,
+        # so a variance within rounding of 0 is 0
+        variance = known * total2 - total * total
+        variance = numpy.where(variance <= 1e-12 * known * total2, 0.0, variance)
+        sigma = numpy.where(known > 1,
+                            numpy.sqrt(variance / (known * (known - 1.0))),
+                            numpy.nan)
+
+    return (pred, sigma)
+
+def trend_nan_series(data, step, seconds, newest_unknown=False):
+    '''
+    trend_nan_series returns what ds,seconds,TRENDNAN would give at every step. Like rrdtool,
+    steps without a full window of history behind them are NaN. newest_unknown is as for predict_series.
+    '''
+    data = numpy.asarray(data, dtype=float)
+    length = predict_math.steps(seconds, step)
+    (window_sum, window_sum2, window_count) = window_sums(data, length)
+    if newest_unknown:
+        window_sum -= numpy.where(numpy.isnan(data), 0.0, data)
+        window_count -= ~numpy.isnan(data)
+
+    with numpy.errstate(all='ignore'):
+        smooth = numpy.where(window_count > 0, window_sum / window_count, numpy.nan)
+    smooth[..., :length - 1] = numpy.nan
+
+    return smooth
+
+def difference_series(smooth, pred, sigma):
+    '''
+    difference_series returns abs(smooth - pred) / sigma, or 0 where sigma is 0 (see predict_math.difference).
+    '''
+    with numpy.errstate(all='ignore'):
+        return numpy.where(sigma == 0, 0.0, numpy.abs(smooth - pred) / sigma)
+
+def last_index(series):
+    '''
+    last_index returns the index of the last known value of every row, or -1 for rows with no
+    known values.
+    '''
+    known = ~numpy.isnan(numpy.asarray(series, dtype=float))
+    index = known.shape[-1] - 1 - numpy.argmax(known[..., ::-1], axis=-1)
+    return numpy.where(known.any(axis=-1), index, -1)
+
+def fill_forward(series, carry):
+    '''
+    fill_forward returns series with every unknown value replaced by the last known one before it,
+    the value a LAST VDEF of a graph ending there picks. carry holds a value per row for the steps
+    before the first known one.
+    '''
+    series = numpy.asarray(series, dtype=float)
+    known = ~numpy.isnan(series)
+    index = numpy.maximum.accumulate(numpy.where(known, numpy.arange(series.shape[-1]), -1), axis=-1)
+    filled = numpy.take_along_axis(series, numpy.maximum(index, 0), axis=-1)
+    return numpy.where(index >= 0, filled, numpy.asarray(carry, dtype=float)[..., numpy.newaxis])
+
+def last_valid(series):
+    '''
+    last_valid returns the last known value of every row, like a LAST VDEF. Rows with no
+    known values give NaN.
+    '''
+    series = numpy.asarray(series, dtype=float)
+    index = last_index(series)
+    values = numpy.take_along_axis(series, numpy.maximum(index, 0)[..., numpy.newaxis], axis=-1)[..., 0]
+    return numpy.where(index >= 0, values, numpy.nan)
+
+def predict_last(data, step, interval=604800, count=-5, window=1800):
+    '''
+    predict_last works out the whole check for every row of data and returns a tuple of
+    (smooth, pred, sigma, diff) arrays, one value per row, the same values the LAST VDEFs
+    in check_predicted.py would print.
+    '''
+    return predict_last_settled(data, step, interval, count, window)[:4]
+
+def predict_last_settled(data, step, interval=604800, count=-5, window=1800):
+    '''
+    predict_last_settled returns what predict_last does, plus an array telling for every row whether
+    those values are settled: the last known value of each series only depends on rows of data after
+    the first one. Otherwise the LAST VDEFs of a graph reaching further back can come out different.
+    The first row is left out as rrdtool leaves it out of PREDICT, and it can be consolidated from
+    part of a step (see rrd_query.reduce_rows).
+    '''
+    data = numpy.asarray(data, dtype=float)
+    (pred, sigma) = predict_series(data, step, interval, count, window)
+    smooth_steps = predict_math.steps(window / 2, step)
+    smooth = trend_nan_series(data, step, window / 2)
+    diff = difference_series(smooth, pred, sigma)
+
+    # The steps PREDICT reaches back over, besides the one it is at
+    reach = (abs(count) - 1) * predict_math.steps(interval, step) + predict_math.steps(window, step)
+    settled = last_index(smooth) >= smooth_steps
+    for series in [pred, sigma, diff]:
+        settled &= last_index(series) > reach
+
+    return (last_valid(smooth), last_valid(pred), last_valid(sigma), last_valid(diff), settled)
+
+def take_columns(data, columns):
+    '''
+    take_columns picks columns (an array of column indexes per row, broadcast against the rows of data)
+    out of data. Columns before the start of the data come back as NaN.
+    '''
+    columns = numpy.broadcast_to(columns, data.shape[:-1] + columns.shape[-1:])
+    if data.shape[-1] == 0:
+        return numpy.full(columns.shape, numpy.nan)
+
+    picked = numpy.take_along_axis(data, numpy.clip(columns, 0, data.shape[-1] - 1), axis=-1)
+    return numpy.where(columns >= 0, picked, numpy.nan)
+
+def end_samples(data, step, interval=604800, count=-5, window=1800):
+    '''
+    end_samples picks out of data the columns the check at the end of the data looks at. It returns a
+    tuple of (samples, recent, current): the values in the |count| sample windows at the last step (for
+    pred and sigma), the last half window for TRENDNAN, and the sample windows at the end of that half
+    window (for the diff). Like the LAST VDEFs, recent ends at the last step smooth is known, which is
+    usually not the last step: rrd_fetch returns the step still being filled in as well.
+    '''
+    data = numpy.asarray(data, dtype=float)
+    length = data.shape[-1]
+    locstep = predict_math.steps(window, step)
+    shiftstep = predict_math.steps(interval, step)
+    smooth_steps = predict_math.steps(window / 2, step)
+
+    anchor = end_anchor(data, smooth_steps)[..., numpy.newaxis]
+
+    offsets = numpy.array([loop * shiftstep + offset for loop in range(abs(count)) for offset in range(locstep + 1)])
+    samples = take_columns(data, length - 1 - offsets)
+    current = take_columns(data, anchor - offsets)
+
+    # Like TRENDNAN, no smooth without a full half window of history
+    recent = take_columns(data, anchor - numpy.arange(smooth_steps)[::-1])
+    recent = numpy.where(anchor < smooth_steps - 1, numpy.nan, recent)
+
+    return (samples, recent, current)
+
+def end_anchor(data, smooth_steps):
+    '''
+    end_anchor returns for every row of data the last column smooth is known at, the column the LAST
+    VDEF of smooth finds: a half window past the last known value, at most the last column.
+    '''
+    length = data.shape[-1]
+    known = ~numpy.isnan(data)
+    last_known = numpy.where(known.any(axis=-1), length - 1 - numpy.argmax(known[..., ::-1], axis=-1), length - 1)
+    return numpy.asarray(numpy.minimum(length - 1, last_known + smooth_steps - 1))
+
+def end_settled(data, step, interval=604800, count=-5, window=1800):
+    '''
+    end_settled returns an array telling for every row of data whether the columns end_samples picks
+    are all past the first one, like the settled array of predict_last_settled. Rows that aren't settled,
+    or have no known value at all, can come out different when read further back.
+    '''
+    data = numpy.asarray(data, dtype=float)
+    shiftstep = predict_math.steps(interval, step)
+    smooth_steps = predict_math.steps(window / 2, step)
+
+    # The steps PREDICT reaches back over, besides the one it is at
+    reach = (abs(count) - 1) * shiftstep + predict_math.steps(window, step)
+    known = ~numpy.isnan(data)
+    return known.any(axis=-1) & (end_anchor(data, smooth_steps) - max(reach, smooth_steps - 1) >= 1)
+
+def sample_stats(samples):
+    '''
+    sample_stats returns (pred, sigma) arrays, one value per row, over the known values of samples.
+    '''
+    # Center on the mean of the samples, like predict_series, to keep the variance accurate
+    known = ~numpy.isnan(samples)
+    known_count = known.sum(axis=-1)
+    with numpy.errstate(all='ignore'):
+        center = numpy.where(known_count > 0, numpy.where(known, samples, 0.0).sum(axis=-1) / known_count, 0.0)
+        values = numpy.where(known, samples - center[..., numpy.newaxis], 0.0)
+        total = values.sum(axis=-1)
+        total2 = (values * values).sum(axis=-1)
+
+        pred = numpy.where(known_count > 0, total / known_count, numpy.nan) + center
+        variance = known_count * total2 - total * total
+        sigma = numpy.where((known_count > 1) & (variance >= 0),
+                            numpy.sqrt(variance / (known_count * (known_count - 1.0))),
+                            numpy.nan)
+
+    return (pred, sigma)
+
+def score_samples(samples, recent, current):
+    '''
+    score_samples works out (smooth, pred, sigma, diff) arrays, one value per row, from the columns
+    picked out by end_samples. Rows from different series can be stacked and scored together.
+    '''
+    (pred, sigma) = sample_stats(samples)
+    (current_pred, current_sigma) = sample_stats(current)
+
+    # TRENDNAN over the last half window
+    recent_known = ~numpy.isnan(recent)
+    with numpy.errstate(all='ignore'):
+        smooth = numpy.where(recent_known.any(axis=-1),
+                             numpy.where(recent_known, recent, 0.0).sum(axis=-1) / recent_known.sum(axis=-1),
+                             numpy.nan)
+
+    return (smooth, pred, sigma, difference_series(smooth, current_pred, current_sigma))
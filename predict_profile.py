@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# predict_profile.py - Precompute the seasonal history of the predictions
+# Retooled for OMD/check-mk 2020
+#
+# The prediction for a time of week only changes when new history arrives, yet every check works it
+# out from the raw data again. PREDICT at position p adds up the sample windows ending at p, p - interval,
+# ... p - (|count| - 1) * interval. For every position in the interval after the build, all but the first
+# of those windows lie in the past, so build_profile adds them up ahead of time (sum, sum of squares and
+# count for every slot) with NumPy and saves them as a flat .npy array, with a JSON file describing it,
+# per host/service. A check in profile mode then only fetches the current window, adds it to its slot
+# and is done, however long the history is.
+#
+# A profile is good for one interval after it was built, so rebuild them more often than that (nightly
+# from cron is fine). Metrics without a usable profile (missing, stale, rrd file recreated, other
+# parameters) fall back to working out the prediction from the sample windows (see --mode points).
+#
+# A simple example would be:
+# predict_profile.py --services '^Interface_' --profiledir $OMD_ROOT/var/check_predicted/profiles
+
+import os
+import sys
+import json
+import argparse
+import numpy
+import predict_math
+import predict_numpy
+import predict_state
+import check_predicted
+import check_predicted_bulk
+
+def profile_path(profile_dir, host, service_name):
+    '''
+    profile_path returns the path of the JSON file describing the profile of a host/service.
+    '''
+    return os.path.join(profile_dir, host, service_name + '.json')
+
+def build_metric(predict_resource, path, ds_num):
+    '''
+    build_metric fetches the history of one data source and returns a tuple of (entry, sums) where
+    sums is an array of shape (3, slots) holding the sum, sum of squares and count of the known values
+    in the past sample windows for each of the slots positions after the end of the data. The values
+    are centered on their mean first (see predict_numpy.predict_series), entry records the center.
+    '''
+    count = abs(predict_resource.count)
+    interval = predict_resource.interval
+    window = predict_resource.window
+
+    # Enough history for the oldest window of the first slot
+    span = (count - 1) * interval + 2 * window
+    (resolution, read_step) = predict_resource.resolution(path, ds_num, span)
+    (start, step, values) = predict_resource.rrd_query.fetch(path, ds_num, 'end-{}s'.format(span + read_step),
+                                                             predict_resource.sample_time,
+                                                             resolution=resolution, consolidate=read_step)
+    data = numpy.array(values, dtype=float)
+    first_pos = start // step + 1
+    end_pos = first_pos + len(data) - 1
+
+    with numpy.errstate(all='ignore'):
+        center = numpy.nanmean(data) if len(data) else numpy.nan
+    if numpy.isnan(center):
+        center = 0.0
+
+    locstep = predict_math.steps(window, step)
+    slots = predict_math.steps(interval, step)
+    window_sums = predict_numpy.window_sums(data - center, locstep + 1)
+
+    # The window for slot m, count back loop intervals, ends at end_pos + 1 + m - loop * slots
+    sums = numpy.zeros((3, slots))
+    for loop in range(1, count):
+        index = end_pos + 1 - loop * slots - first_pos + numpy.arange(slots)
+        known = (index >= 0) & (index < len(data))
+        for row in range(3):
+            sums[row] += numpy.where(known, window_sums[row][numpy.clip(index, 0, max(len(data) - 1, 0))], 0.0)
+
+    entry = {'fingerprint': list(predict_state.fingerprint(path, ds_num, interval, predict_resource.count, window,
+                                                           [resolution, read_step])),
+             'step': int(step),
+             'first_pos': int(end_pos + 1),
+             'slots': slots,
+             'center': float(center)}
+
+    return (entry, sums)
+
+def build_profile(predict_resource, profile_dir):
+    '''
+    build_profile builds the profile of every metric of predict_resource (a MetricPredict) and saves it
+    under profile_dir. The array is written under a new name and the JSON file replaced last, so a check
+    never sees a half written profile.
+    '''
+    host_dir = os.path.join(profile_dir, predict_resource.invID)
+    if not os.path.isdir(host_dir):
+        os.makedirs(host_dir)
+    json_path = profile_path(profile_dir, predict_resource.invID, predict_resource.service_name)
+
+    metrics = {}
+    blocks = []
+    offset = 0
+    for metric in predict_resource.metrics_by_file():
+        (path, ds_num) = predict_resource.label_dict[metric]
+        (entry, sums) = build_metric(predict_resource, path, ds_num)
+        entry['offset'] = offset
+        metrics[metric] = entry
+        blocks.append(sums.ravel())
+        offset += sums.size
+
+    data_name = '{}.{}.npy'.format(predict_resource.service_name, os.getpid())
+    numpy.save(os.path.join(host_dir, data_name), numpy.concatenate(blocks) if blocks else numpy.zeros(0))
+
+    tmp_file = '{}.{}.tmp'.format(json_path, os.getpid())
+    with open(tmp_file, 'w') as profile_file:
+        json.dump({'interval': predict_resource.interval,
+                   'count': predict_resource.count,
+                   'window': predict_resource.window,
+                   'data': data_name,
+                   'metrics': metrics}, profile_file)
+    os.rename(tmp_file, json_path)
+
+    # Clear out the arrays of earlier builds
+    prefix = predict_resource.service_name + '.'
+    for file_name in os.listdir(host_dir):
+        if file_name.startswith(prefix) and file_name.endswith('.npy') and file_name != data_name:
+            if file_name[len(prefix):-len('.npy')].isdigit():
+                os.remove(os.path.join(host_dir, file_name))
+
+    return len(metrics)
+
+class Profile:
+    '''
+    Profile is a loaded profile of one host/service. The sums are memory mapped, so only the
+    pages of the slots looked up get read.
+    '''
+
+    def __init__(self, json_path):
+        with open(json_path) as profile_file:
+            self.meta = json.load(profile_file)
+        self.sums = numpy.load(os.path.join(os.path.dirname(json_path), self.meta['data']), mmap_mode='r')
+
+    def matches(self, interval, count, window):
+        '''
+        matches tells whether the profile was built with these prediction parameters.
+        '''
+        return (self.meta['interval'], self.meta['count'], self.meta['window']) == (interval, count, window)
+
+    def lookup(self, metric, fingerprint, step, pos):
+        '''
+        lookup returns (center, sum, sum of squares, count) of the past sample windows for position pos
+        of metric, or None if the profile has nothing usable for it.
+        '''
+        entry = self.meta['metrics'].get(metric)
+        if entry is None or entry['fingerprint'] != list(fingerprint) or entry['step'] != step:
+            return None
+
+        slot = pos - entry['first_pos']
+        if not 0 <= slot < entry['slots']:
+            return None
+
+        base = entry['offset'] + slot
+        return (entry['center'],
+                float(self.sums[base]),
+                float(self.sums[base + entry['slots']]),
+                int(self.sums[base + 2 * entry['slots']]))
+
+def load_profile(profile_dir, host, service_name):
+    '''
+    load_profile returns the Profile of a host/service, or None if there isn't one (or it was
+    replaced while being opened).
+    '''
+    try:
+        return Profile(profile_path(profile_dir, host, service_name))
+    except (EnvironmentError, ValueError, KeyError):
+        return None
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='predict_profile.py options')
+    cmdParser.add_argument('--servicelist', dest='service_list', action='store',
+                           help='File of "host service" lines to build profiles for. Default is to walk --path')
+    cmdParser.add_argument('--hosts', dest='host_match', action='store',
+                           help='Only build profiles for hosts matching this regex')
+    cmdParser.add_argument('--services', dest='service_match', action='store',
+                           help='Only build profiles for services matching this regex')
+    check_predicted.add_predict_arguments(cmdParser)
+    args = cmdParser.parse_args()
+
+    if args.service_list:
+        services = check_predicted_bulk.read_service_list(args.service_list)
+    else:
+        services = check_predicted_bulk.find_services(args.path, args.host_match, args.service_match)
+
+    failed = 0
+    for (host, service_name) in services:
+        try:
+            check = check_predicted.build_check(args, host, service_name)
+            for predict_resource in check.resources:
+                predict_resource.rrd_query.flush(predict_resource.rrd_files())
+                metric_count = build_profile(predict_resource, args.profile_dir)
+            if args.debug:
+                sys.stderr.write('Built profile of {} metrics for {} {}\n'.format(metric_count, host, service_name))
+        except Exception as err:
+            failed += 1
+            sys.stderr.write('{} {}: {}: {}\n'.format(host, service_name, type(err).__name__, err))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# predict_scan.py - Replay the check over a range of time
+# Retooled for OMD/check-mk 2020
+#
+# Tuning the -w/-c sigma coefficients means knowing what the d/s ratio did over the past weeks.
+# Rather than rerunning check_predicted.py with --sampletime for every point in time, scan() works out
+# _smooth, _pred, _sigma and _diff for every step in a range in one go with NumPy (see predict_numpy.py)
+# and streams them out as CSV or JSON lines. The row for time t holds what --sampletime t would give. The range is processed in chunks, and each chunk only
+# fetches the steps that are new, reusing the history already loaded for the previous one.
+#
+# At the end it reports, for each threshold given (the -w and -c values by default), how many steps
+# were above it and how many alerts (crossings from below to above) it would have raised.
+#
+# A simple example would be:
+# predict_scan.py --host $HOST --servicename Interface_1 --start end-30d --end now -w 2 -c 3 --thresholds 1,1.5 --output scan.csv
+
+
+import sys
+import json
+import argparse
+import numpy
+import rrd_mmap
+import rrd_query
+import predict_numpy
+import check_predicted
+
+def scan(predict_resource, start, end, chunk=86400):
+    '''
+    scan is a generator that evaluates the check of predict_resource (a MetricPredict) for every
+    step boundary t after start up to and including end (both epoch seconds). It yields tuples of
+    (t, metric, smooth, pred, sigma, diff), in time order, chunk seconds at a time. Each holds what
+    the check with --sampletime t prints: the rows are read at the step the rpn graph ending at t
+    reads (see MetricPredict.resolution), and each value is the last one known up to t, like the
+    LAST VDEFs pick them. A metric that was unknown since before the history loaded for the first
+    step of the scan comes out NaN, where the graph would look further back.
+    '''
+    count = predict_resource.count
+    interval = predict_resource.interval
+    window = predict_resource.window
+    query = predict_resource.rrd_query
+
+    # Enough history for the oldest window of the first step, plus the window itself
+    history = (abs(count) - 1) * interval + 2 * window
+    buffers = {}
+    # The last known smooth, pred, sigma and diff of every metric so far
+    carry = {}
+
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(end, chunk_start + chunk)
+
+        # Only fetch what's new since the last chunk, the history is carried over
+        groups = {}
+        for metric in predict_resource.metrics_by_file():
+            (path, ds_num) = predict_resource.label_dict[metric]
+            (resolution, step) = predict_resource.resolution(path, ds_num, history, end_time=chunk_end)
+            # The check at t reads up to the step after it
+            last_pos = chunk_end // step + 1
+
+            buffer = buffers.get(metric)
+            if buffer is not None and buffer[1:3] == (resolution, step):
+                (data_start, resolution, step, data) = buffer
+                data_end = data_start + len(data) * step
+                (fetch_start, fetch_step, values) = query.fetch(path, ds_num, data_end, last_pos * step,
+                                                               resolution=resolution, consolidate=step)
+                if fetch_step != step or fetch_start != data_end:
+                    buffer = None
+                else:
+                    data = numpy.concatenate((data, numpy.array(values, dtype=float)))
+            if buffer is None:
+                # New, or the graph reads another archive from here on
+                (data_start, fetch_step, values) = query.fetch(path, ds_num, (chunk_start // step) * step - history,
+                                                               last_pos * step, resolution=resolution, consolidate=step)
+                if fetch_step != step:
+                    (resolution, step) = (fetch_step, fetch_step)
+                    last_pos = chunk_end // step + 1
+                data = numpy.array(values, dtype=float)
+
+            # rrd_fetch runs on past the end, and consolidated rows there are only partly covered
+            data = data[:last_pos - data_start // step]
+            consolidated = resolution < step
+            groups.setdefault((data_start, step, len(data), consolidated), []).append((metric, resolution, data))
+
+        rows = []
+        for (data_start, step, length, consolidated) in groups.keys():
+            entries = groups[(data_start, step, length, consolidated)]
+            metrics = [metric for (metric, resolution, data) in entries]
+            data = numpy.array([data for (metric, resolution, data) in entries])
+
+            (pred, sigma) = predict_numpy.predict_series(data, step, interval, count, window)
+            smooth = predict_numpy.trend_nan_series(data, step, window / 2)
+            diff = predict_numpy.difference_series(smooth, pred, sigma)
+
+            # The step boundaries after chunk_start up to chunk_end, and the index in data of the step
+            # after each, the newest one the check there reads
+            labels = numpy.arange(chunk_start // step + 1, chunk_end // step + 1)
+            newest = labels - data_start // step
+            if consolidated:
+                # That step is there to read now, but rrd_fetch only runs a fine step past t, so once
+                # consolidated it is only partly covered and unknown
+                (newest_pred, newest_sigma) = predict_numpy.predict_series(data, step, interval, count, window,
+                                                                           newest_unknown=True)
+                newest_smooth = predict_numpy.trend_nan_series(data, step, window / 2, newest_unknown=True)
+                newest_diff = predict_numpy.difference_series(newest_smooth, newest_pred, newest_sigma)
+                complete = newest - 1
+            else:
+                complete = newest
+
+            results = []
+            for (part, series) in enumerate([smooth, pred, sigma, diff]):
+                for metric in metrics:
+                    carry.setdefault(metric, [numpy.nan] * 4)
+                filled = predict_numpy.fill_forward(series[:, complete], [carry[metric][part] for metric in metrics])
+                if len(labels):
+                    for (row, metric) in enumerate(metrics):
+                        carry[metric][part] = filled[row, -1]
+                if consolidated:
+                    newest_series = [newest_smooth, newest_pred, newest_sigma, newest_diff][part][:, newest]
+                    filled = numpy.where(numpy.isnan(newest_series), filled, newest_series)
+                results.append(filled)
+
+            for (row, metric) in enumerate(metrics):
+                for index in range(len(labels)):
+                    rows.append((int(labels[index] * step), metric) + tuple([float(result[row, index]) for result in results]))
+
+            # Keep just the history the next chunk needs
+            keep = min(length, history // step + 1)
+            for (row, (metric, resolution, values)) in enumerate(entries):
+                buffers[metric] = (data_start + (length - keep) * step, resolution, step, data[row, length - keep:])
+
+        rows.sort()
+        for row in rows:
+            yield row
+
+        chunk_start = chunk_end
+
+class AlertCounter:
+    '''
+    AlertCounter counts, for each threshold, the steps whose d/s ratio was above it and the
+    number of alerts that would have been raised (a metric going from below to above).
+    Unknown ratios never alert.
+    '''
+
+    def __init__(self, thresholds):
+        self.thresholds = thresholds
+        self.steps_above = dict([(threshold, 0) for threshold in thresholds])
+        self.alerts = dict([(threshold, 0) for threshold in thresholds])
+        self.above = {}
+
+    def add(self, metric, diff):
+        for threshold in self.thresholds:
+            above = diff > threshold
+            if above:
+                self.steps_above[threshold] += 1
+                if not self.above.get((metric, threshold)):
+                    self.alerts[threshold] += 1
+            self.above[(metric, threshold)] = above
+
+    def summary(self):
+        return [{'threshold':threshold,
+                 'steps_above':self.steps_above[threshold],
+                 'alerts':self.alerts[threshold]} for threshold in self.thresholds]
+
+def main():
+    # Setup argparse to parse the command line.
+    cmdParser = argparse.ArgumentParser(description='predict_scan.py options')
+    cmdParser.add_argument('-H ', '--host', dest='host', action='store',
+                           help='hostname to query')
+    cmdParser.add_argument('--servicename', dest='service_name', action='store',
+                           default='Interface_1', help='service to query')
+    cmdParser.add_argument('--start', dest='start', action='store', default='end-30d',
+                           help='Start of the scan. Epoch seconds, now or end-<offset>')
+    cmdParser.add_argument('--end', dest='end', action='store', default='now',
+                           help='End of the scan. Epoch seconds or now')
+    cmdParser.add_argument('--chunk', dest='chunk', action='store', type=int, default=86400,
+                           help='Seconds of the range to work on at a time')
+    cmdParser.add_argument('--thresholds', dest='thresholds', action='store',
+                           help='Comma separated d/s ratios to count alerts for. Default is the -w and -c values')
+    cmdParser.add_argument('--format', dest='format', action='store', choices=['csv', 'jsonl'],
+                           default='csv', help='Output format')
+    cmdParser.add_argument('--output', dest='output', action='store',
+                           help='File to write to. Default is stdout')
+    check_predicted.add_predict_arguments(cmdParser)
+    args = cmdParser.parse_args()
+
+    end = rrd_mmap.parse_time(args.end)
+    start = rrd_mmap.parse_time(args.start, end)
+
+    if args.thresholds:
+        thresholds = [float(threshold) for threshold in args.thresholds.split(',')]
+    else:
+        thresholds = [float(args.warn_coeff), float(args.crit_coeff)]
+    counter = AlertCounter(thresholds)
+
+    check = check_predicted.build_check(args, args.host, args.service_name)
+    predict_resource = check.resources[0]
+    predict_resource.rrd_query.flush(predict_resource.rrd_files())
+
+    if args.output:
+        output = open(args.output, 'w')
+    else:
+        output = sys.stdout
+
+    try:
+        if args.format == 'csv':
+            output.write('time,metric,smooth,pred,sigma,diff\n')
+
+        for (timestamp, metric, smooth, pred, sigma, diff) in scan(predict_resource, start, end, args.chunk):
+            counter.add(metric, diff)
+            if args.format == 'csv':
+                output.write('{},{},{},{},{},{}\n'.format(timestamp, metric, smooth, pred, sigma, diff))
+            else:
+                record = {'time':timestamp, 'metric':metric, 'smooth':smooth, 'pred':pred, 'sigma':sigma, 'diff':diff}
+                # JSON has no NaN
+                for name in record.keys():
+                    if record[name] != record[name]:
+                        record[name] = None
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if args.output:
+            output.close()
+
+    sys.stderr.write(json.dumps({'alerts':counter.summary()}) + '\n')
+
+if __name__ == '__main__':
+    main()
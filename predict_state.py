@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+# predict_state.py - Keep prediction state between check runs
+# Retooled for OMD/check-mk 2020
+#
+# Every PREDICT in an rrd query rescans the whole history even though only the newest few steps
+# changed since the last run. PredictState keeps the last |count| intervals of samples for a metric
+# in a ring, along with the running sum, sum of squares and count for every slot of the interval.
+# A run then only has to fetch the steps that arrived since the previous run, fold them in and
+# add up the handful of slots that make up the sample window.
+#
+# The states are kept in a shelve per host/service under a state directory, guarded by a lock file
+# so that concurrent checks don't trample each other. Only the small header of each state goes in the
+# shelve. The ring and the sums (a few hundred KB with 60s steps over five weeks) are kept in a file
+# of doubles per metric, which is mapped into memory and updated in place, so a run only writes the
+# pages the new steps land on instead of pickling the whole ring again.
+
+import os
+import mmap
+import fcntl
+import shelve
+import predict_math
+from urllib.parse import quote
+
+class PredictState:
+    '''
+    PredictState holds the sample ring and per-slot running sums for one metric.
+    A slot is one rrd step within the sample interval. Position pos (timestamp / step) lands in
+    slot pos % slots of ring row (pos // slots) % periods, so every slot always holds the values
+    from the last |count| intervals, which is exactly what PREDICT looks at.
+    fingerprint identifies the rrd file and parameters the state was built for.
+    '''
+
+    def __init__(self, fingerprint, step, interval, count):
+        self.fingerprint    = fingerprint
+        self.step           = step
+        self.slots          = predict_math.steps(interval, step)
+        self.periods        = abs(count)
+        self.last_pos       = None
+        self.ring           = None
+        self.cells          = None
+        self.attach(bytearray(self.ring_size()))
+        for cell in range(self.slots * self.periods):
+            self.cells[cell] = predict_math.nan
+
+    def ring_size(self):
+        '''
+        ring_size returns the number of bytes the ring and the sums take up: the values of every cell,
+        then the sum, the sum of squares and the count of every slot, all as doubles.
+        '''
+        return (self.slots * self.periods + 3 * self.slots) * 8
+
+    def attach(self, buffer):
+        '''
+        attach makes the state keep its ring and sums in buffer (see ring_size), a bytearray or an mmap.
+        '''
+        self.ring = memoryview(buffer)
+        self.cells = self.ring.cast('d')
+        self.sum_offset = self.slots * self.periods
+        self.sum2_offset = self.sum_offset + self.slots
+        self.count_offset = self.sum2_offset + self.slots
+
+    def release(self):
+        '''
+        release lets go of the buffer, so an mmap behind it can be closed.
+        '''
+        if self.cells is not None:
+            self.cells.release()
+            self.ring.release()
+        self.ring = None
+        self.cells = None
+
+    def __getstate__(self):
+        # The ring is kept apart from the pickled header (see StateStore)
+        state = self.__dict__.copy()
+        state['ring'] = None
+        state['cells'] = None
+        return state
+
+    def span(self):
+        '''
+        span returns the number of seconds of history the ring holds.
+        '''
+        return self.slots * self.periods * self.step
+
+    def add(self, pos, value):
+        '''
+        add stores the value for position pos, replacing whatever was in its cell
+        (the same position from an earlier fetch or the one a full ring ago) in the slot sums.
+        '''
+        slot = pos % self.slots
+        cell = ((pos // self.slots) % self.periods) * self.slots + slot
+        cells = self.cells
+
+        old = cells[cell]
+        if not predict_math.isnan(old):
+            cells[self.sum_offset + slot]   -= old
+            cells[self.sum2_offset + slot]  -= old * old
+            cells[self.count_offset + slot] -= 1
+
+        cells[cell] = value
+        if not predict_math.isnan(value):
+            cells[self.sum_offset + slot]   += value
+            cells[self.sum2_offset + slot]  += value * value
+            cells[self.count_offset + slot] += 1
+
+        if self.last_pos is None or pos > self.last_pos:
+            self.last_pos = pos
+
+    def absorb(self, start, step, values):
+        '''
+        absorb folds in the values returned by RRDQuery.fetch. Positions skipped over since the
+        previous run are cleared so that no stale values linger in the ring.
+        '''
+        first_pos = start // step + 1
+
+        if self.last_pos is not None and first_pos > self.last_pos + 1:
+            for pos in range(self.last_pos + 1, min(first_pos, self.last_pos + 1 + self.slots * self.periods)):
+                self.add(pos, predict_math.nan)
+
+        for (index, value) in enumerate(values):
+            self.add(first_pos + index, value)
+
+    def value(self, pos):
+        '''
+        value returns the sample stored for position pos.
+        '''
+        return self.cells[((pos // self.slots) % self.periods) * self.slots + pos % self.slots]
+
+    def predict(self, window, pos=None):
+        '''
+        predict returns (prediction, sigma) at position pos (default the last one), the same as
+        PREDICT and PREDICTSIGMA with a window of window seconds would. pos should be within a
+        sample window of the last position, older slots have been overwritten since.
+        '''
+        if pos is None:
+            pos = self.last_pos
+
+        total = 0.0
+        total2 = 0.0
+        count = 0
+
+        for offset in range(predict_math.steps(window, self.step) + 1):
+            slot = (pos - offset) % self.slots
+            total   += self.cells[self.sum_offset + slot]
+            total2  += self.cells[self.sum2_offset + slot]
+            count   += int(self.cells[self.count_offset + slot])
+
+        return predict_math.predict(total, total2, count)
+
+    def smooth(self, window, pos=None):
+        '''
+        smooth returns the TRENDNAN average over the window seconds ending at position pos
+        (default the last one).
+        '''
+        if pos is None:
+            pos = self.last_pos
+
+        count = predict_math.steps(window, self.step)
+        values = [self.value(pos - offset) for offset in range(count)]
+        return predict_math.trend_nan(values, count)
+
+    def last_smooth_pos(self, window):
+        '''
+        last_smooth_pos returns the last position with a known smooth value over window seconds,
+        the one a LAST VDEF over TRENDNAN picks. The newest step rrd_fetch returns is still being
+        filled in, so with a short window (or a coarse step) that is usually an earlier position.
+        It returns None if no value is known within an interval.
+        '''
+        count = predict_math.steps(window, self.step)
+        for pos in range(self.last_pos, max(self.last_pos - self.slots, -1), -1):
+            if not predict_math.isnan(self.value(pos)):
+                return min(self.last_pos, pos + count - 1)
+        return None
+
+class StateStore:
+    '''
+    StateStore is a shelve of PredictState headers for one host/service, opened under an exclusive lock,
+    with the ring of each in a file of its own next to it (see PredictState.ring_size).
+    Use it as a context manager so the lock is always released and the rings are written back.
+    '''
+
+    def __init__(self, state_dir, host, service_name):
+        host_dir = os.path.join(state_dir, host)
+        if not os.path.isdir(host_dir):
+            os.makedirs(host_dir)
+        self.path = os.path.join(host_dir, service_name)
+        self.ring_dir = self.path + '.rings'
+        self.lock_file = None
+        self.shelf = None
+        # The states handed out with their rings mapped from a file, with the mmap of each
+        self.mapped = []
+
+    def __enter__(self):
+        self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.shelf = shelve.open(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for (state, ring_map) in self.mapped:
+            state.release()
+            ring_map.close()
+        self.mapped = []
+        self.shelf.close()
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+    def ring_path(self, metric):
+        return os.path.join(self.ring_dir, quote(metric, safe=''))
+
+    def get(self, metric, fingerprint):
+        '''
+        get returns the stored state for metric, or None if there isn't one or it was built
+        for a different file or different parameters. The ring of the state is mapped from its file,
+        so whatever is added to it is written back in place.
+        '''
+        state = self.shelf.get(metric)
+        if state is None or state.fingerprint != fingerprint:
+            return None
+
+        try:
+            with open(self.ring_path(metric), 'r+b') as ring_file:
+                if os.fstat(ring_file.fileno()).st_size != state.ring_size():
+                    return None
+                ring_map = mmap.mmap(ring_file.fileno(), 0)
+        except OSError:
+            # No ring file, as with a header pickled before the rings were kept apart
+            return None
+
+        state.attach(ring_map)
+        self.mapped.append((state, ring_map))
+        return state
+
+    def put(self, metric, state):
+        '''
+        put stores the header of state for metric. A state that didn't come from get, with its ring
+        in memory, has the ring written out to a new file first.
+        '''
+        if not isinstance(state.ring.obj, mmap.mmap):
+            if not os.path.isdir(self.ring_dir):
+                os.makedirs(self.ring_dir)
+            path = self.ring_path(metric)
+            with open(path + '.tmp', 'wb') as ring_file:
+                ring_file.write(state.ring)
+            os.replace(path + '.tmp', path)
+        self.shelf[metric] = state
+
+def fingerprint(path, ds_num, interval, count, window, resolution=None):
+    '''
+    fingerprint identifies an rrd file and the prediction parameters. A recreated rrd file
+    gets a new inode, and changed parameters change the tuple, either way invalidating the state.
+    resolution is the (resolution, step) the rows are read at (see MetricPredict.resolution).
+    '''
+    stat = os.stat(path)
+    return (path, ds_num, stat.st_dev, stat.st_ino, interval, count, window, resolution)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# result_cache.py - Share check results between retries and rechecks
+# Retooled for OMD/check-mk 2020
+#
+# check_mk retries soft states and reschedules checks well within one rrd step, and every time the same
+# prediction gets worked out again from the same data. ResultCache keeps the results on disk, keyed by
+# host, service, check parameters and the inode and modification time of every rrd file read, so a
+# result is only reused while the data behind it is unchanged.
+#
+# Each entry is a small JSON file, written to a temporary file and renamed into place, so any number
+# of check processes can share the cache without locking. Entries expire ttl seconds after they were
+# written, however often they are hit: a host that stops reporting leaves its rrd files (and so the key)
+# unchanged, and its last result must not be served forever. A hit sets the access time of its entry,
+# so the least recently used ones go first when the cache is pruned back to max_entries.
+# Pruning happens at most once every ttl seconds, by whichever process gets the lock first. The others
+# don't wait for it.
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+
+class ResultCache:
+    '''
+    ResultCache is a directory of cached check results (dicts of metric + submetric to value).
+    '''
+
+    def __init__(self, cache_dir, ttl=60, max_entries=10000):
+        self.cache_dir      = cache_dir
+        self.ttl            = ttl
+        self.max_entries    = max_entries
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another check got there first
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def key(self, host, service_name, params, paths):
+        '''
+        key works out the cache key for a check of host/service with params (anything JSON can
+        encode) that reads the rrd files in paths.
+        '''
+        files = []
+        for path in sorted(paths):
+            stat = os.stat(path)
+            files.append((path, stat.st_ino, stat.st_mtime))
+
+        key_str = json.dumps([host, service_name, params, files], sort_keys=True)
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        '''
+        get returns the cached results for key, or None if there are none or they have expired.
+        '''
+        entry_path = self.entry_path(key)
+        now = time.time()
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+            if now - entry['created'] > self.ttl:
+                return None
+            # Only the access time, the modification time is when the entry was written
+            os.utime(entry_path, (now, os.stat(entry_path).st_mtime))
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            return None
+
+        return entry['results']
+
+    def put(self, key, results):
+        '''
+        put stores the results for key, and prunes the cache if it is due.
+        '''
+        entry_path = self.entry_path(key)
+        tmp_file = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_file, 'w') as entry_file:
+            json.dump({'created':time.time(), 'results':results}, entry_file)
+        os.rename(tmp_file, entry_path)
+
+        self.prune()
+
+    def prune(self):
+        '''
+        prune removes the expired entries and then the least recently used ones (by access time) until at most
+        max_entries are left. It does nothing if the cache was pruned less than ttl seconds ago,
+        or if another process is pruning it right now.
+        '''
+        now = time.time()
+        stamp_path = os.path.join(self.cache_dir, '.pruned')
+        try:
+            if now - os.stat(stamp_path).st_mtime < self.ttl:
+                return
+        except OSError:
+            pass
+
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+
+            try:
+                with open(stamp_path, 'a'):
+                    os.utime(stamp_path, None)
+
+                entries = []
+                for file_name in os.listdir(self.cache_dir):
+                    if not file_name.endswith(('.json', '.tmp')):
+                        continue
+                    entry_path = os.path.join(self.cache_dir, file_name)
+                    try:
+                        stat = os.stat(entry_path)
+                    except OSError:
+                        continue
+                    # Left over temporary files are removed along with the expired entries
+                    if now - stat.st_mtime > self.ttl:
+                        self.remove(entry_path)
+                    elif file_name.endswith('.json'):
+                        entries.append((stat.st_atime, entry_path))
+
+                entries.sort()
+                for (atime, entry_path) in entries[:max(0, len(entries) - self.max_entries)]:
+                    self.remove(entry_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+# rrd_mmap.py - Read rrd files straight out of memory mapped pages
+# Retooled for OMD/check-mk 2020
+#
+# RRDFile parses the rrd header (data sources, archives and the circular buffer pointers) and exposes
+# each RRA as a NumPy array that is a view over the mapped file, so nothing gets copied or read until
+# it is actually looked at. The page cache serves the reads, and checks running in parallel against
+# the same host share the same pages.
+#
+# Only the native layout written by rrdtool on the machine doing the reading is understood (which is
+# what rrdtool itself requires). The float cookie in the header is checked to make sure of that.
+
+import os
+import re
+import mmap
+import time
+import struct
+import numpy
+
+FLOAT_COOKIE    = 8.642135E130
+UNIVAL_SIZE     = 8
+PAR_SIZE        = 10 * UNIVAL_SIZE
+
+# Sizes of the structures in rrd_format.h
+STAT_HEAD_SIZE  = 48 + PAR_SIZE                 # cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step, par
+DS_DEF_SIZE     = 40 + PAR_SIZE                 # ds_nam[20], dst[20], par
+RRA_DEF_SIZE    = 40 + PAR_SIZE                 # cf_nam[20] (padded to 24), row_cnt, pdp_cnt, par
+PDP_PREP_SIZE   = 32 + PAR_SIZE                 # last_ds[30] (padded to 32), scratch
+CDP_PREP_SIZE   = PAR_SIZE                      # scratch
+RRA_PTR_SIZE    = 8                             # cur_row
+
+class RRDFileError (Exception):
+    '''
+    Standard class exception.
+    '''
+    pass
+
+def c_string(data):
+    '''
+    c_string turns a nul terminated char array into a str.
+    '''
+    return data.split(b'\0', 1)[0].decode('ascii', 'replace')
+
+class RRA:
+    '''
+    RRA describes one round robin archive in an RRDFile.
+    data is the raw ring of rows (row_cnt x ds_cnt) as a NumPy view over the mapped file.
+    '''
+
+    def __init__(self, index, cf, row_cnt, pdp_cnt, step, data):
+        self.index      = index
+        self.cf         = cf
+        self.row_cnt    = row_cnt
+        self.pdp_cnt    = pdp_cnt
+        self.step       = step
+        self.data       = data
+
+class RRDFile:
+    '''
+    RRDFile memory maps an rrd file and parses its header.
+    Data structures maintained include:
+    ds_names -  The data source names, in column order
+    step -      The base (pdp) step in seconds
+    rras -      A list of RRA objects
+    The live header (last update time and the ring pointers) is read from the mapping every time
+    it is used, so updates made by rrdtool while the file is open are seen.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as rrd_file:
+            self.stat = os.fstat(rrd_file.fileno())
+            self.map = mmap.mmap(rrd_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step) = struct.unpack_from('4s5s7xdLLL', self.map, 0)
+        if cookie != b'RRD\0':
+            raise RRDFileError('{} is not an rrd file'.format(path))
+        if float_cookie != FLOAT_COOKIE:
+            raise RRDFileError('{} was not written on this architecture'.format(path))
+
+        self.version    = int(c_string(version))
+        self.step       = pdp_step
+        offset          = STAT_HEAD_SIZE
+
+        self.ds_names   = []
+        self.ds_types   = []
+        for index in range(ds_cnt):
+            (ds_nam, dst) = struct.unpack_from('20s20s', self.map, offset)
+            self.ds_names.append(c_string(ds_nam))
+            self.ds_types.append(c_string(dst))
+            offset += DS_DEF_SIZE
+
+        rra_defs = []
+        for index in range(rra_cnt):
+            (cf_nam, row_cnt, pdp_cnt) = struct.unpack_from('20s4xLL', self.map, offset)
+            rra_defs.append((c_string(cf_nam), row_cnt, pdp_cnt))
+            offset += RRA_DEF_SIZE
+
+        # Versions before 0003 don't keep the microseconds of the last update
+        self.live_head_offset = offset
+        if self.version < 3:
+            offset += 8
+        else:
+            offset += 16
+
+        offset += ds_cnt * PDP_PREP_SIZE
+        offset += rra_cnt * ds_cnt * CDP_PREP_SIZE
+
+        self.rra_ptr_offset = offset
+        offset += rra_cnt * RRA_PTR_SIZE
+
+        # The rows of every rra follow, one after the other
+        self.rras = []
+        for (index, (cf, row_cnt, pdp_cnt)) in enumerate(rra_defs):
+            data = numpy.ndarray(shape=(row_cnt, ds_cnt), dtype=numpy.float64, buffer=self.map, offset=offset)
+            self.rras.append(RRA(index, cf, row_cnt, pdp_cnt, pdp_cnt * pdp_step, data))
+            offset += row_cnt * ds_cnt * 8
+
+        if offset > len(self.map):
+            raise RRDFileError('{} is truncated'.format(path))
+
+    def close(self):
+        '''
+        close drops the archive views and unmaps the file. If views handed out by fetch or
+        rras are still around, the mapping goes away when the last of them does.
+        '''
+        self.rras = []
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+    def last_update(self):
+        '''
+        last_update returns the time of the last update to the file.
+        '''
+        return struct.unpack_from('l', self.map, self.live_head_offset)[0]
+
+    def cur_row(self, rra):
+        '''
+        cur_row returns the index of the newest row in the ring of rra.
+        '''
+        return struct.unpack_from('L', self.map, self.rra_ptr_offset + rra.index * RRA_PTR_SIZE)[0]
+
+    def choose_rra(self, cf, start, end, resolution=1):
+        '''
+        choose_rra picks the archive to fetch from the way rrd_fetch does. Of the archives with a
+        matching consolidation function that reach back to start, the one with the step closest to
+        resolution wins. If none reach back far enough, the one that covers the most of the fetch
+        up to end does.
+        '''
+        last_update = self.last_update()
+        best_full = None
+        best_partial = None
+
+        for rra in self.rras:
+            if rra.cf != cf:
+                continue
+            cal_end = last_update - last_update % rra.step
+            cal_start = cal_end - rra.step * rra.row_cnt
+            step_diff = abs(resolution - rra.step)
+
+            if cal_start <= start:
+                if best_full is None or step_diff < best_full[0]:
+                    best_full = (step_diff, rra)
+            else:
+                match = end - cal_start
+                if best_partial is None or match > best_partial[0] or (match == best_partial[0] and step_diff < best_partial[1]):
+                    best_partial = (match, step_diff, rra)
+
+        if best_full:
+            return best_full[1]
+        if best_partial:
+            return best_partial[2]
+
+        raise RRDFileError('No {} archive in {}'.format(cf, self.path))
+
+    def fetch(self, cf, start, end, resolution=1):
+        '''
+        fetch returns ((start, end, step), ds_names, rows) like rrdtool fetch, where row i covers the
+        step ending at start + (i + 1) * step. rows is a (steps x ds) NumPy array with NaN for unknown.
+        Only the rows that were asked for are copied out of the ring.
+        '''
+        rra = self.choose_rra(cf, start, end, resolution)
+        step = rra.step
+
+        # rrd_fetch moves end on to the next step even when it is already on a step boundary
+        start = start - start % step
+        end += step - end % step
+
+        last_update = self.last_update()
+        newest = last_update - last_update % step
+        times = numpy.arange(start + step, end + step, step)
+        age = (newest - times) // step
+        valid = (age >= 0) & (age < rra.row_cnt)
+
+        rows = numpy.full((len(times), len(self.ds_names)), numpy.nan)
+        rows[valid] = rra.data[(self.cur_row(rra) - age[valid]) % rra.row_cnt]
+
+        return ((start, end, step), tuple(self.ds_names), rows)
+
+# Files stay mapped between fetches. A recreated file gets mapped again.
+open_files = {}
+
+def open_rrd(path):
+    '''
+    open_rrd returns an RRDFile for path, reusing an existing mapping if the file hasn't been replaced.
+    '''
+    stat = os.stat(path)
+    rrd = open_files.get(path)
+
+    if rrd is None or (rrd.stat.st_dev, rrd.stat.st_ino) != (stat.st_dev, stat.st_ino):
+        if rrd is not None:
+            rrd.close()
+        rrd = RRDFile(path)
+        open_files[path] = rrd
+
+    return rrd
+
+time_units = {'s':1, 'sec':1, 'seconds':1,
+              'min':60, 'minutes':60,
+              'h':3600, 'hours':3600,
+              'd':86400, 'days':86400,
+              'w':604800, 'weeks':604800}
+
+time_parser = re.compile(r'^(now|end|e|start|s|\d+)?((?:[-+]\d+[a-z]*)*)$')
+offset_parser = re.compile(r'([-+])(\d+)([a-z]*)')
+
+def parse_time(spec, reference=None):
+    '''
+    parse_time understands the subset of rrd AT-STYLE times used in this code: epoch seconds,
+    'now', and 'end'/'start' relative to reference, each optionally followed by offsets like -6w or +30min.
+    '''
+    match = time_parser.match(str(spec).strip())
+    if not match:
+        raise RRDFileError('Unsupported time specification {}'.format(spec))
+
+    (base, offsets) = match.groups()
+    if base is None or base == 'now':
+        when = int(time.time())
+    elif base.isdigit():
+        when = int(base)
+    elif reference is None:
+        raise RRDFileError('{} needs a reference time'.format(spec))
+    else:
+        when = reference
+
+    for (sign, amount, unit) in offset_parser.findall(offsets):
+        if unit not in time_units and unit != '':
+            raise RRDFileError('Unsupported time unit in {}'.format(spec))
+        seconds = int(amount) * time_units.get(unit, 1)
+        if sign == '-':
+            when -= seconds
+        else:
+            when += seconds
+
+    return when
@@ -10,9 +10,34 @@
 # I put this together because I was having problems getting the python rrd module working
 
 import sys
-import rrdtool
 import re
-import subprocess
+import shlex
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# The python rrd module is optional. If it is not around we fall back to running rrdtool as a subprocess.
+# It is only imported once an executor needs it (see load_rrdtool), as are subprocess and rrdcached,
+# so that importing this module stays cheap.
+rrdtool = None
+rrdtool_error = Exception
+
+def load_rrdtool():
+    '''
+    load_rrdtool imports the python rrd module the first time it is needed and returns it,
+    or None if it isn't installed.
+    '''
+    global rrdtool, rrdtool_error
+    if rrdtool is None:
+        try:
+            import rrdtool as rrdtool_module
+        except ImportError:
+            return None
+        rrdtool_error = getattr(rrdtool_module, 'OperationalError', getattr(rrdtool_module, 'error', Exception))
+        rrdtool = rrdtool_module
+    return rrdtool
 
 cf_dict = {'avg':'AVERAGE','min':'MINIMUM','max':'MAXIMUM'}
 
@@ -22,6 +47,404 @@ class RRDQueryError (Exception):
     '''
     pass
 
+class SubprocessExecutor:
+    '''
+    SubprocessExecutor runs rrdtool graph as a child process and returns the PRINT lines.
+    This is the original way of doing things and is kept around as a fallback for when the
+    python rrd module isn't installed. It no longer goes through the shell.
+    '''
+
+    def __init__(self, rrdtool_path='rrdtool'):
+        self.rrdtool_path = rrdtool_path
+
+    def graph(self, args):
+        '''
+        graph runs 'rrdtool graph' with the argument list args (output file first) and returns
+        a list of PRINT lines.
+        '''
+        import subprocess
+
+        process = subprocess.Popen([self.rrdtool_path, 'graph'] + list(args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        (stdout, stderr) = process.communicate()
+
+        if process.returncode != 0:
+            raise RRDQueryError('rrdtool graph failed: {}'.format(stderr.strip()))
+
+        output = stdout.split('\n')
+
+        # Pop the first and last items on output - they are useless
+        output.pop(0)
+        output.pop()
+
+        return output
+
+    def fetch(self, args):
+        '''
+        fetch runs 'rrdtool fetch' with the argument list args (file and CF first) and returns
+        ((start, end, step), ds_names, rows) the same way the python rrd module does.
+        Unknown values come back as None.
+        '''
+        import subprocess
+
+        process = subprocess.Popen([self.rrdtool_path, 'fetch'] + list(args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        (stdout, stderr) = process.communicate()
+
+        if process.returncode != 0:
+            raise RRDQueryError('rrdtool fetch failed: {}'.format(stderr.strip()))
+
+        return parse_fetch_output(stdout.split('\n'), fetch_resolution(args))
+
+    def info(self, args):
+        '''
+        info runs 'rrdtool info' on the file in args and returns its archives (see parse_info).
+        '''
+        import subprocess
+
+        process = subprocess.Popen([self.rrdtool_path, 'info'] + list(args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        (stdout, stderr) = process.communicate()
+
+        if process.returncode != 0:
+            raise RRDQueryError('rrdtool info failed: {}'.format(stderr.strip()))
+
+        return parse_info(parse_info_output(stdout.split('\n')))
+
+def parse_info_output(lines):
+    '''
+    parse_info_output turns the 'key = value' lines printed by 'rrdtool info' into a dict, the same
+    way the python rrd module returns it.
+    '''
+    info = {}
+    for line in lines:
+        if ' = ' not in line:
+            continue
+        (key, value) = line.split(' = ', 1)
+        if value.startswith('"'):
+            info[key] = value.strip('"')
+        elif value == 'NaN':
+            info[key] = None
+        else:
+            try:
+                info[key] = int(value)
+            except ValueError:
+                info[key] = float(value)
+
+    return info
+
+def parse_info(info):
+    '''
+    parse_info picks the archive layout out of an rrd info dict. It returns a dict with the base
+    step of the file, the time of its last update and a list of (CF, step, rows) tuples, one per RRA.
+    '''
+    rras = []
+    index = 0
+    while 'rra[{}].cf'.format(index) in info:
+        rras.append((info['rra[{}].cf'.format(index)],
+                     int(info['step']) * int(info['rra[{}].pdp_per_row'.format(index)]),
+                     int(info['rra[{}].rows'.format(index)])))
+        index += 1
+
+    return {'step': int(info['step']), 'last_update': int(info['last_update']), 'rras': rras}
+
+def choose_archive(info, cf, start, end, step):
+    '''
+    choose_archive returns the step of the archive rrd_fetch reads for a fetch from start to end asking
+    for step, given the archives of the file (see parse_info). Of the archives with the consolidation
+    function cf that reach back to start, the one with the step closest to step wins. If none reach
+    back far enough, the one that covers the most of the fetch does. None means there is no cf archive.
+    '''
+    last_update = info['last_update']
+    best_full = None
+    best_partial = None
+
+    for (rra_cf, rra_step, rows) in info['rras']:
+        if rra_cf != cf:
+            continue
+        cal_end = last_update - last_update % rra_step
+        cal_start = cal_end - rra_step * rows
+        step_diff = abs(step - rra_step)
+
+        if cal_start <= start:
+            if best_full is None or step_diff < best_full[0]:
+                best_full = (step_diff, rra_step)
+        else:
+            match = end - cal_start
+            if best_partial is None or match > best_partial[0] or (match == best_partial[0] and step_diff < best_partial[1]):
+                best_partial = (match, step_diff, rra_step)
+
+    if best_full:
+        return best_full[1]
+    if best_partial:
+        return best_partial[2]
+    return None
+
+def reduce_rows(start, step, values, new_step):
+    '''
+    reduce_rows consolidates values fetched at step (see RRDQuery.fetch) to new_step, the way rrdtool graph
+    does when the archive it reads is finer than the step it asked for (reduce_data in rrd_graph.c):
+    new_step is rounded up to a multiple of step, each new row is the average of the known values in it,
+    and the rows at either end that the fetched values only partly cover are unknown.
+    It returns (start, new_step, values) laid out like RRDQuery.fetch returns them.
+    '''
+    factor = -(-new_step // step)
+    new_step = factor * step
+    end = start + len(values) * step
+    new_start = start - start % new_step
+    new_end = end - end % new_step + (new_step if end % new_step else 0)
+
+    reduced = []
+    for row_start in range(new_start, new_end, new_step):
+        index = (row_start - start) // step
+        if index < 0 or index + factor > len(values):
+            reduced.append(float('nan'))
+            continue
+        known = [value for value in values[index:index + factor] if value == value]
+        reduced.append(sum(known) / len(known) if known else float('nan'))
+
+    return (new_start, new_step, reduced)
+
+def fetch_resolution(args):
+    '''
+    fetch_resolution returns the --resolution asked for in the 'rrdtool fetch' argument list args, or None.
+    '''
+    if '--resolution' in args:
+        return int(args[list(args).index('--resolution') + 1])
+    return None
+
+def parse_fetch_output(lines, resolution=None):
+    '''
+    parse_fetch_output turns the lines printed by 'rrdtool fetch' into
+    ((start, end, step), ds_names, rows). Unknown values come back as None.
+    rrdtool doesn't print the step, so it is taken from the timestamps of the rows. With fewer than
+    two rows it is taken to be resolution, the one fetched at. An RRDQueryError is raised if there is
+    no resolution or the rows aren't on its steps (rrdtool read another archive).
+    '''
+    ds_names = tuple(lines[0].split())
+    times = []
+    rows = []
+    for line in lines[1:]:
+        if ':' not in line:
+            continue
+        (timestamp, values) = line.split(':', 1)
+        row = []
+        for value in values.split():
+            value = float(value)
+            if value != value:
+                value = None
+            row.append(value)
+        times.append(int(timestamp))
+        rows.append(tuple(row))
+
+    if len(times) > 1:
+        step = times[1] - times[0]
+    elif resolution and not [timestamp for timestamp in times if timestamp % resolution]:
+        step = resolution
+    else:
+        raise RRDQueryError('Cannot tell the step of {} fetched row(s) at resolution {}'.format(len(times), resolution))
+
+    # The timestamp on each row is the end of its interval
+    if times:
+        return ((times[0] - step, times[-1], step), ds_names, rows)
+    else:
+        return ((0, 0, step), ds_names, rows)
+
+class PipeExecutor:
+    '''
+    PipeExecutor keeps an 'rrdtool -' coprocess around and sends it commands over a pipe (rrdtool's
+    remote control mode), so a long running process only pays for starting rrdtool once.
+    A PipeExecutor runs one command at a time. Give each thread its own.
+    '''
+
+    def __init__(self, rrdtool_path='rrdtool'):
+        self.rrdtool_path = rrdtool_path
+        self.process = None
+
+    def start(self):
+        import subprocess
+
+        self.process = subprocess.Popen([self.rrdtool_path, '-'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except EnvironmentError:
+                pass
+            self.process = None
+
+    def command(self, command, args):
+        '''
+        command sends one command to the coprocess (starting it if need be) and returns its output
+        lines up to the closing OK line. An ERROR reply is raised as an RRDQueryError.
+        '''
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        # rrdtool splits the line on white space, but honours double quotes
+        line = ' '.join([command] + [('"{}"'.format(arg) if re.search(r'\s', arg) else arg) for arg in args])
+
+        output = []
+        try:
+            self.process.stdin.write(line + '\n')
+            self.process.stdin.flush()
+            while True:
+                reply = self.process.stdout.readline()
+                if not reply:
+                    raise RRDQueryError('rrdtool coprocess went away')
+                if reply.startswith('OK '):
+                    break
+                if reply.startswith('ERROR'):
+                    raise RRDQueryError('rrdtool {} failed: {}'.format(command, reply.strip()))
+                output.append(reply.rstrip('\n'))
+        except EnvironmentError as err:
+            self.close()
+            raise RRDQueryError('rrdtool coprocess failed: {}'.format(err))
+
+        return output
+
+    def graph(self, args):
+        '''
+        graph runs graph in the coprocess and returns a list of PRINT lines.
+        '''
+        output = self.command('graph', args)
+
+        # The first line is the image size
+        return output[1:]
+
+    def fetch(self, args):
+        '''
+        fetch runs fetch in the coprocess and returns ((start, end, step), ds_names, rows).
+        '''
+        return parse_fetch_output(self.command('fetch', args), fetch_resolution(args))
+
+    def info(self, args):
+        '''
+        info runs info in the coprocess and returns the archives of the file (see parse_info).
+        '''
+        return parse_info(parse_info_output(self.command('info', args)))
+
+class LibrrdExecutor:
+    '''
+    LibrrdExecutor evaluates the query in-process with the python rrd module (librrd).
+    graphv is used with '-' as the output file, so nothing is written to disk, and since the
+    queries built here have no graphing elements rrdtool doesn't render an image at all.
+    '''
+
+    def __init__(self):
+        if load_rrdtool() is None:
+            raise RRDQueryError('The python rrdtool module is not installed')
+
+    def graph(self, args):
+        '''
+        graph runs rrdtool.graphv on the argument list args and returns a list of PRINT lines,
+        in the order they were defined.
+        '''
+        try:
+            result = rrdtool.graphv(*args)
+        except rrdtool_error as err:
+            raise RRDQueryError('rrdtool graphv failed: {}'.format(err))
+
+        # graphv hands the PRINT output back as print[0], print[1]...
+        prints = []
+        index = 0
+        while 'print[{}]'.format(index) in result:
+            prints.append(result['print[{}]'.format(index)])
+            index += 1
+
+        return prints
+
+    def fetch(self, args):
+        '''
+        fetch runs rrdtool.fetch on the argument list args (file and CF first) and returns
+        ((start, end, step), ds_names, rows).
+        '''
+        try:
+            return rrdtool.fetch(*args)
+        except rrdtool_error as err:
+            raise RRDQueryError('rrdtool fetch failed: {}'.format(err))
+
+    def info(self, args):
+        '''
+        info runs rrdtool.info on the file in args and returns its archives (see parse_info).
+        '''
+        try:
+            return parse_info(rrdtool.info(*args))
+        except rrdtool_error as err:
+            raise RRDQueryError('rrdtool info failed: {}'.format(err))
+
+class MmapExecutor:
+    '''
+    MmapExecutor reads rrd files directly through memory maps (see rrd_mmap.py) without rrdtool at all.
+    It can only fetch, so it is meant for the prediction modes that work from raw data. Graph queries
+    need one of the other executors.
+    '''
+
+    def __init__(self):
+        import rrd_mmap
+        self.rrd_mmap = rrd_mmap
+
+    def graph(self, args):
+        raise RRDQueryError('The mmap executor cannot run graph queries')
+
+    def fetch(self, args):
+        '''
+        fetch takes the same argument list as the other executors (file, CF and then --start, --end
+        and --resolution) and returns ((start, end, step), ds_names, rows) with rows as a NumPy array.
+        '''
+        path = args[0]
+        cf = args[1]
+        options = dict(zip(args[2::2], args[3::2]))
+
+        try:
+            end = self.rrd_mmap.parse_time(options.get('--end', 'now'))
+            start = self.rrd_mmap.parse_time(options.get('--start', 'end-1d'), end)
+            resolution = int(options.get('--resolution', 1))
+            return self.rrd_mmap.open_rrd(path).fetch(cf, start, end, resolution)
+        except (self.rrd_mmap.RRDFileError, EnvironmentError) as err:
+            raise RRDQueryError('mmap fetch failed: {}'.format(err))
+
+    def info(self, args):
+        '''
+        info reads the archive layout straight from the header of the file in args (see parse_info).
+        '''
+        try:
+            rrd = self.rrd_mmap.open_rrd(args[0])
+        except (self.rrd_mmap.RRDFileError, EnvironmentError) as err:
+            raise RRDQueryError('mmap info failed: {}'.format(err))
+
+        return {'step': rrd.step, 'last_update': rrd.last_update(),
+                'rras': [(rra.cf, rra.step, rra.row_cnt) for rra in rrd.rras]}
+
+# Executors by name. 'auto' picks librrd when the python rrd module is importable.
+executor_dict = {'librrd':LibrrdExecutor, 'subprocess':SubprocessExecutor, 'mmap':MmapExecutor, 'pipe':PipeExecutor}
+
+def get_executor(name='auto'):
+    '''
+    get_executor returns an executor instance for the given name.
+    '''
+    if name == 'auto':
+        if load_rrdtool() is not None:
+            name = 'librrd'
+        else:
+            name = 'subprocess'
+
+    if name not in executor_dict:
+        raise RRDQueryError('Unknown rrd executor {}'.format(name))
+
+    return executor_dict[name]()
+
 class RRDQuery:
     '''
     RRDQuery is meant to provide an interface for putting together complex or repetitive rrd queries.
@@ -40,33 +463,69 @@ class RRDQuery:
                  end_time='now',                                                    # Actual end time to graph
                  print_format='%6.2lf',
                  debug=0,
+                 executor=None,                                                     # Executor that evaluates the query (see get_executor)
+                 daemon=None,                                                       # rrdcached address to flush files through
+                 min_rows=0,                                                        # Rows per sample window for choose_resolution (0 is off)
                  ):                                   
         '''
         __init__ initializes the main data structures
         The rest of the rrdquery is put together using various commands, and then the actual query is made with the query command.
         '''
         self.debug          = debug
+        # The in-process executor doesn't need an output file at all
+        if executor is None:
+            executor = get_executor()
+        self.executor       = executor
+        self.daemon         = daemon
+        if isinstance(executor, LibrrdExecutor):
+            out_file = '-'
+        self.header_args    = [out_file,
+                               '--width', str(graph_width),
+                               '--step', str(graph_step),
+                               '--start', start_time,
+                               '--end', end_time]
+        self.header         = 'rrdtool graph ' + ' '.join([quote(arg) for arg in self.header_args])
+        self.graph_width    = graph_width
+        self.graph_step     = graph_step
+        self.start_time     = start_time
+        self.min_rows       = min_rows
+        # The archives of each rrd file looked at by choose_resolution
+        self.rra_info       = {}
         # command_list is the bread and butter of this. It has all of the rrd commands that will finally be run.
-        self.header         = 'rrdtool graph --width {} --step {} {} --start \'{}\' --end \'{}\''.format(str(graph_width),
-                                                                                                         str(graph_step),
-                                                                                                         out_file,
-                                                                                                         start_time,
-                                                                                                         end_time)
         self.command_list   = []
         self.tokens         = {}
+        # Maps (path, ds_num, consol_funct) to the name it was defined under, so each is only read once
+        self.datasets       = {}
+        # The rows fetched from the most recently read rrd file, by fetch arguments (see fetch)
+        self.fetch_path     = None
+        self.fetch_cache    = {}
         self.print_format   = print_format
 
-    def define_dataset(self, path, ds_num, metric_name, consol_funct='avg'):
+    def token_name(self, metric_name, consol_funct='avg', prefix=''):
+        '''
+        token_name returns the name define_dataset gives a metric. prefix namespaces the name
+        when several checks share one query.
+        '''
+        return '{}ds{}{}'.format(prefix, metric_name, consol_funct)
+
+    def define_dataset(self, path, ds_num, metric_name, consol_funct='avg', prefix=''):
         '''
         define_dataset will generate rrd DEF commands and add them to the rrd query command list.
         If name is specified, it will only define datasets whose label (in label_dict) matches name.
         The function will return a list of tokens that have been defined as datasets.
+        A data source that is already defined in the query isn't defined again, the name it
+        was first defined under is returned instead.
         '''
         
         if self.debug:
             sys.stderr.write('Metric {} in {}\n'.format(metric_name, path))
         
-        ds_name = 'ds{}{}'.format(metric_name, consol_funct)
+        key = (path, ds_num, consol_funct)
+        if key in self.datasets:
+            return self.datasets[key]
+
+        ds_name = self.token_name(metric_name, consol_funct, prefix)
+        self.datasets[key] = ds_name
         cmd_str = 'DEF:{2}={0}:{1}:{3}'.format(path, ds_num, ds_name, cf_dict[consol_funct])
         self.command_list.append(cmd_str)
         if self.debug:
@@ -107,7 +566,7 @@ class RRDQuery:
         else:
             format_str = '{} = {}'.format(vdef, self.print_format)
             
-        cmd_str = 'PRINT:{0}:\"{1}\"'.format(vdef, format_str)
+        cmd_str = 'PRINT:{0}:{1}'.format(vdef, format_str)
         self.command_list.append(cmd_str)
         if self.debug:
             sys.stderr.write('{}\n'.format(cmd_str))
@@ -148,7 +607,7 @@ class RRDQuery:
         ds_smooth = '{}_smooth'.format(name)
         return self.define_cdef(ds_smooth, rdef_str)
         
-    def define_prediction(self, cdef, step=604800, step_count=-5, window=1800):
+    def define_prediction(self, cdef, step=604800, step_count=-5, window=1800, name=None):
         '''
         generate_prediction will generate the necessary rrd statements to make predictions based on history
         and adds them to the query command list.
@@ -156,13 +615,16 @@ class RRDQuery:
         step is the amount of time between samples in seconds. 1 week is default.
         step_count is the number of windowed samples to take. Default -5 is 5 samples back.
         window is the number of seconds in the window to sample. 1/2 hour default.
+        name is the base name of the cdefs created. It defaults to the name of cdef.
         A list of cdef tokens created by the function is returned.
         '''
         
+        if name is None:
+            name = cdef
         tokens = []
         basis_str   = '{},{},{},{}'.format(str(step),str(step_count),str(window),cdef)
-        pred_name   = '{}_pred'.format(cdef)
-        sig_name    = '{}_sigma'.format(cdef)
+        pred_name   = '{}_pred'.format(name)
+        sig_name    = '{}_sigma'.format(name)
         
         
         tokens.append(self.define_cdef(pred_name, '{},PREDICT'.format(basis_str,cdef)))
@@ -170,6 +632,217 @@ class RRDQuery:
         
         return tokens
     
+    def graph_span(self):
+        '''
+        graph_span returns the number of seconds the graph query covers, or None if the start time
+        isn't relative to the end (end-<count><unit>).
+        '''
+        match = re.match(r'^end-(\d+)(s|min|h|d|w)$', self.start_time)
+        if not match:
+            return None
+        units = {'s':1, 'min':60, 'h':3600, 'd':86400, 'w':604800}
+        return int(match.group(1)) * units[match.group(2)]
+
+    def pixel_step(self):
+        '''
+        pixel_step returns the step rrdtool graph asks the DEFs of the query for: graph_step, unless
+        that is less than the time one pixel of the graph covers, which rrdtool uses instead.
+        '''
+        span = self.graph_span()
+        if span is None:
+            return self.graph_step
+        return max(self.graph_step, span // self.graph_width)
+
+    def archive_info(self, path):
+        '''
+        archive_info returns the archives of path (see parse_info), or None if they can't be read.
+        They are only read once per file.
+        '''
+        if path not in self.rra_info:
+            info = None
+            if hasattr(self.executor, 'info'):
+                try:
+                    info = self.executor.info([path])
+                except RRDQueryError as err:
+                    if self.debug:
+                        sys.stderr.write('Cannot read the archives of {}: {}\n'.format(path, err))
+            self.rra_info[path] = info
+
+        return self.rra_info[path]
+
+    def graph_resolution(self, info, end, consol_funct='avg'):
+        '''
+        graph_resolution returns (resolution, step) for a DEF of the graph query ending at end (epoch
+        seconds) on a file with the archives info: rrdtool graph asks rrd_fetch for the pixel step,
+        rrd_fetch reads the archive with step resolution, and rows finer than the pixel step get
+        consolidated to step (see reduce_rows).
+        '''
+        pixel = self.pixel_step()
+        span = self.graph_span()
+        resolution = None
+        if span is not None:
+            resolution = choose_archive(info, cf_dict[consol_funct], end - span, end, pixel)
+        if resolution is None:
+            return (pixel, pixel)
+
+        return (resolution, resolution * -(-pixel // resolution))
+
+    def read_steps(self, path, ds_num, end_time, window, interval, span, consol_funct='avg'):
+        '''
+        read_steps returns (resolution, step) for fetching a data source of path so the rows come out the
+        way a DEF of the graph query ending at end_time reads them: fetch at resolution and consolidate
+        to step (see fetch). With min_rows, the coarser archive choose_resolution picks for the sample
+        window and span seconds back is read instead, one whose step divides the one of the DEF so
+        the rows consolidate to the same ones. It is only read if its newest row comes out the same
+        as well: the DEF's newest row is unknown if the rows it consolidates only partly cover it, the
+        archive's is unknown until it has been written.
+        If the archives of the file can't be read, the pixel step is asked for and rrd_fetch is left to
+        pick the archive, which only matches the graph when the archive it picks reaches back as far.
+        '''
+        info = self.archive_info(path)
+        if info is None:
+            pixel = self.pixel_step()
+            return (pixel, pixel)
+
+        # The archive rrd_fetch reads depends on how far back the graph starts, so find out where it ends.
+        # That is within a base step of end_time, which is as close as it gets for times like 'now'.
+        pixel = self.pixel_step()
+        (start, base_step, values) = self.fetch(path, ds_num, 'end-{}s'.format(pixel), end_time, consol_funct,
+                                                resolution=info['step'])
+        end = start + len(values) * base_step
+        (resolution, step) = self.graph_resolution(info, end, consol_funct)
+
+        coarse = self.choose_resolution(path, window, interval, span, consol_funct, limit=step)
+        if coarse and coarse > resolution:
+            fetched_end = end - end % resolution + (resolution if end % resolution else 0)
+            row_end = end - end % step + (step if end % step else 0)
+            if (fetched_end < row_end) != (row_end <= info['last_update']):
+                return (coarse, step)
+            if self.debug:
+                sys.stderr.write('Not using the {}s archive of {}, its newest row differs\n'.format(coarse, path))
+        return (resolution, step)
+
+    def choose_resolution(self, path, window, interval, span, consol_funct='avg', limit=None):
+        '''
+        choose_resolution picks the coarsest archive in path with the consolidation function for
+        consol_funct that still has min_rows rows per sample window of window seconds, whose step
+        divides interval (so the shifted windows line up with its rows) and that reaches back span
+        seconds. With limit, its step also has to divide limit: averages of its rows over limit seconds
+        are then those of the finest archive, unless more than its xff of the finer rows are unknown.
+        It returns the step of that archive, to fetch at. None means the finest archive, as before:
+        min_rows is 0, nothing coarser will do, or the file's archives can't be read.
+        '''
+        if not self.min_rows or not span:
+            return None
+
+        info = self.archive_info(path)
+        if info is None:
+            return None
+
+        best = None
+        for (cf, step, rows) in info['rras']:
+            if cf != cf_dict[consol_funct] or step * self.min_rows > window or interval % step:
+                continue
+            if limit is not None and limit % step:
+                continue
+            if step * rows < span:
+                continue
+            if best is None or step > best[1]:
+                best = (cf, step, rows)
+
+        if best is None or best[1] <= info['step']:
+            return None
+
+        if self.debug:
+            sys.stderr.write('Using the {} archive with {}s steps ({} rows) of {}\n'.format(best[0], best[1], best[2], path))
+
+        return best[1]
+
+    def flush(self, paths):
+        '''
+        flush has rrdcached write out pending updates for the rrd files in paths, in one batch,
+        so that the query doesn't read stale data. Nothing happens if no daemon address was given.
+        '''
+        if not self.daemon:
+            return
+        import rrdcached
+
+        paths = sorted(set(paths))
+        try:
+            errors = rrdcached.flush(self.daemon, paths)
+        except rrdcached.RRDCachedError as err:
+            raise RRDQueryError(str(err))
+
+        if self.debug:
+            sys.stderr.write('Flushed {} files through {}\n'.format(len(paths), self.daemon))
+            for (path, error) in errors:
+                sys.stderr.write('Flush of {} failed: {}\n'.format(path, error))
+
+    def forget_fetches(self):
+        '''
+        forget_fetches drops the rows kept by fetch. Times like 'now' move on, so a query that lives
+        on between checks has to forget them before each check.
+        '''
+        self.fetch_path = None
+        self.fetch_cache = {}
+
+    def fetch(self, path, ds_num, start_time, end_time, consol_funct='avg', resolution=None, as_array=False,
+              consolidate=None):
+        '''
+        fetch pulls the raw values of one data source out of an rrd file, bypassing the graph
+        query entirely. start_time and end_time can be anything rrdtool understands.
+        It returns a tuple of (start, step, values) where values[i] covers the step ending at
+        start + (i + 1) * step. Unknown values are NaN.
+        A fetch returns every data source of the file, so the rows are kept for fetches of the other
+        data sources of the same file over the same time range. Only the most recently read file is
+        kept, fetch the metrics of a file one after the other to have them all read in one go.
+        The rows are kept until forget_fetches is called.
+        With as_array the values come back as a NumPy array rather than a list.
+        Rows finer than consolidate seconds are consolidated to that step the way rrdtool graph
+        does it (see reduce_rows and read_steps).
+        '''
+        args = [path, cf_dict[consol_funct], '--start', str(start_time), '--end', str(end_time)]
+        if resolution:
+            args.extend(['--resolution', str(resolution)])
+
+        if path != self.fetch_path:
+            self.fetch_path = path
+            self.fetch_cache = {}
+
+        key = tuple(args)
+        if key not in self.fetch_cache:
+            if self.debug:
+                sys.stderr.write('fetch {}\n'.format(' '.join(args)))
+            self.fetch_cache[key] = self.executor.fetch(args)
+
+        ((start, end, step), ds_names, rows) = self.fetch_cache[key]
+
+        if ds_num not in ds_names:
+            raise RRDQueryError('No data source {} in {}'.format(ds_num, path))
+        column = ds_names.index(ds_num)
+
+        # The mmap executor already hands back a NumPy array with NaNs
+        if hasattr(rows, 'shape'):
+            values = rows[:, column]
+        else:
+            values = []
+            for row in rows:
+                value = row[column]
+                if value is None:
+                    value = float('nan')
+                values.append(value)
+
+        if consolidate and step < consolidate:
+            (start, step, values) = reduce_rows(start, step, values, consolidate)
+
+        if as_array:
+            import numpy
+            values = numpy.asarray(values, dtype=float)
+        elif hasattr(values, 'tolist'):
+            values = values.tolist()
+
+        return (start, step, values)
+
     def merge_queries(self, other_query):
         '''
         merge_queries will extend the command list of the query with the command list of the other_query
@@ -178,36 +851,155 @@ class RRDQuery:
         
     def run_query(self, header=None):
         '''
-        run_query puts together the rrd query and then runs it in a subprocess
+        run_query puts together the rrd query and then hands it to the executor
         Optional header parameter allows a custom header to be used in cases
         where the same query gets run over and over with different parameters
         (i.e map2sets.py)
         '''
         if header:
             rrd_header = header
+            header_args = shlex.split(header)
+            # The executor supplies 'rrdtool graph' itself
+            if header_args[:2] == ['rrdtool', 'graph']:
+                header_args = header_args[2:]
         else:
             rrd_header = self.header
+            header_args = self.header_args
         
         if self.debug:
             sys.stderr.write('{}\n'.format(rrd_header))
             for item in self.command_list:
                 sys.stderr.write('{}\n'.format(item))
                 
-        # Create a single command string
-        rrd_tool_cmd = rrd_header + ' ' + ' '.join(self.command_list)
-        
         if self.debug:
+            # Create a single command string
+            rrd_tool_cmd = rrd_header + ' ' + ' '.join([quote(item) for item in self.command_list])
             sys.stderr.write('{}'.format(rrd_tool_cmd))
         
-        # Run the command and store the output in a list
-        # This runs as a subprocess because the python rrd module doesn't seem to work
-        output = subprocess.Popen(rrd_tool_cmd, stdout=subprocess.PIPE, shell=True).stdout.read().split('\n')
-        
-        # Pop the first and last items on output - they are useless
-        output.pop(0)
-        output.pop()
-        
-        # Return the list
-        return output
+        # Run the query and return the list of PRINT lines
+        return self.executor.graph(header_args + self.command_list)
     
+    def query_values(self, header=None):
+        '''
+        query_values runs the query and returns the PRINT output as a dict that maps
+        each printed vdef name to its value as a float.
+        '''
+        return self.parse_values(self.run_query(header))
     
+    def parse_values(self, output):
+        '''
+        parse_values turns the PRINT lines returned by run_query into a dict that maps
+        each printed vdef name to its value as a float.
+        '''
+        values = {}
+        output_parser = re.compile(r'^\s*(\S+) = (.*)')
+        for line in output:
+            match = output_parser.match(line)
+            if match:
+                values[match.group(1)] = float(match.group(2))
+        
+        return values
+
+class QueryCompiler:
+    '''
+    QueryCompiler packs the graph queries of many checks into as few rrdtool runs as possible.
+    Each check is added with a function that defines its statements and a function that picks its
+    results back out. Both get a prefix that namespaces the check's tokens, so checks with the same
+    metric names don't collide. Data sources shared between checks are only read once.
+    A query is closed off when it would grow past max_command_length characters or past max_memory
+    bytes of estimated rrdtool memory (one graph_width row of doubles per DEF and CDEF).
+    '''
+
+    def __init__(self, query_factory, max_command_length=131072, max_memory=256 * 1024 * 1024, debug=0):
+        '''
+        query_factory is called without arguments to get a new, empty RRDQuery.
+        '''
+        self.query_factory      = query_factory
+        self.max_command_length = max_command_length
+        self.max_memory         = max_memory
+        self.debug              = debug
+        self.units              = []
+
+    def add(self, key, define, parse):
+        '''
+        add queues a check. define(query, prefix) adds its statements to query, parse(values, prefix)
+        turns the dict of printed values into the check's results.
+        '''
+        self.units.append((key, 'q{}_'.format(len(self.units)), define, parse))
+
+    def over_limit(self, query):
+        '''
+        over_limit tells whether query has grown past the command length or memory limits.
+        '''
+        command_length = len(' '.join(query.header_args + query.command_list))
+        arrays = len([item for item in query.command_list if item.startswith(('DEF:', 'CDEF:'))])
+        return (command_length > self.max_command_length
+                or arrays * query.graph_width * 8 > self.max_memory)
+
+    def compile(self):
+        '''
+        compile returns a list of (query, units) tuples, with the units whose statements each query holds.
+        A check that is over the limits all by itself still gets a query of its own.
+        '''
+        batches = []
+        query = self.query_factory()
+        units = []
+
+        for unit in self.units:
+            (key, prefix, define, parse) = unit
+            command_count = len(query.command_list)
+            datasets = dict(query.datasets)
+            define(query, prefix)
+
+            if units and self.over_limit(query):
+                # Take the check back out and start it off in a new query
+                del query.command_list[command_count:]
+                query.datasets = datasets
+                batches.append((query, units))
+                query = self.query_factory()
+                units = []
+                define(query, prefix)
+            units.append(unit)
+
+        if units:
+            batches.append((query, units))
+
+        return batches
+
+    def run(self):
+        '''
+        run evaluates the queued checks and returns a dict that maps each key to the check's results.
+        If a merged query fails, its checks are run one at a time, so that one broken rrd file only
+        fails its own check. The results of a check that fails on its own are the RRDQueryError.
+        '''
+        results = {}
+
+        for (query, units) in self.compile():
+            if self.debug:
+                sys.stderr.write('Running {} checks in one query\n'.format(len(units)))
+            try:
+                values = query.query_values()
+            except RRDQueryError as err:
+                if len(units) == 1:
+                    results[units[0][0]] = err
+                    continue
+                for unit in units:
+                    results.update(self.run_single(unit))
+                continue
+
+            for (key, prefix, define, parse) in units:
+                results[key] = parse(values, prefix)
+
+        return results
+
+    def run_single(self, unit):
+        '''
+        run_single evaluates one check in a query of its own.
+        '''
+        (key, prefix, define, parse) = unit
+        query = self.query_factory()
+        define(query, prefix)
+        try:
+            return {key: parse(query.query_values(), prefix)}
+        except RRDQueryError as err:
+            return {key: err}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# rrdcached.py - Just enough of the rrdcached protocol to flush files before reading them
+# Retooled for OMD/check-mk 2020
+#
+# When updates go through rrdcached, the rrd files on disk lag behind by up to the daemon's write
+# delay. Reading them directly (which is what every executor here does) would miss the newest
+# values, so the files a check is about to read get flushed first. All of the files go out in a
+# single BATCH, so it costs one connection and one round trip no matter how many files there are.
+#
+# The address can be unix:/path/to/socket, a bare /path/to/socket, or host[:port].
+
+import socket
+
+DEFAULT_PORT = 42217
+
+class RRDCachedError (Exception):
+    '''
+    Standard class exception.
+    '''
+    pass
+
+def connect(address, timeout=10):
+    '''
+    connect opens a connection to rrdcached at address and returns a file-like object for it.
+    '''
+    if address.startswith('unix:'):
+        address = address[len('unix:'):]
+
+    try:
+        if address.startswith('/'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(address)
+        else:
+            (host, _, port) = address.rpartition(':')
+            if not host or not port.isdigit():
+                (host, port) = (address, DEFAULT_PORT)
+            sock = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, EnvironmentError) as err:
+        raise RRDCachedError('Cannot connect to rrdcached at {}: {}'.format(address, err))
+
+    connection = sock.makefile('rw')
+    sock.close()
+    return connection
+
+def read_response(connection):
+    '''
+    read_response reads one response. The first line starts with a status: negative is an error,
+    otherwise it is the number of lines that follow. It returns (status, message, lines).
+    '''
+    line = connection.readline()
+    if not line:
+        raise RRDCachedError('rrdcached closed the connection')
+
+    (status, _, message) = line.strip().partition(' ')
+    status = int(status)
+    lines = []
+    if status > 0:
+        for index in range(status):
+            lines.append(connection.readline().strip())
+
+    return (status, message, lines)
+
+def flush(address, paths, timeout=10):
+    '''
+    flush asks rrdcached to write out any pending updates for paths and waits until it has.
+    Files the daemon has nothing queued for are fine. A list of (file, message) tuples is
+    returned for any files that failed.
+    '''
+    paths = list(paths)
+    if not paths:
+        return []
+
+    connection = connect(address, timeout)
+    try:
+        connection.write('BATCH\n')
+        connection.flush()
+        (status, message, lines) = read_response(connection)
+        if status < 0:
+            raise RRDCachedError('rrdcached refused BATCH: {}'.format(message))
+
+        for path in paths:
+            connection.write('FLUSH {}\n'.format(path))
+        connection.write('.\n')
+        connection.flush()
+
+        # The batch response counts errors, each error line starts with the command number
+        (status, message, lines) = read_response(connection)
+        if status < 0:
+            raise RRDCachedError('rrdcached batch failed: {}'.format(message))
+
+        errors = []
+        for line in lines:
+            (number, _, error) = line.partition(' ')
+            errors.append((paths[int(number) - 1], error))
+
+        connection.write('QUIT\n')
+        connection.flush()
+    except (socket.error, EnvironmentError, ValueError) as err:
+        raise RRDCachedError('rrdcached flush failed: {}'.format(err))
+    finally:
+        connection.close()
+
+    return errors
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# service_index.py - Cached index of the pnp4nagios service XML metadata
+# Retooled for OMD/check-mk 2020
+#
+# Every check used to parse <host>/<service>.xml to find out which rrd file and data source each
+# metric lives in, even though the file hardly ever changes. ServiceIndex keeps the resulting
+# label dicts in a JSON file per host, keyed on service, along with the mtime and size of the XML
+# file they came from. A lookup is a stat and the read of one host's file, however many hosts there
+# are, and the XML is only parsed again when the file has changed. refresh() brings the whole tree
+# up to date in one pass.
+
+import os
+import re
+import json
+import fcntl
+from urllib.parse import quote
+
+# The XML parser is imported where it is used, so filter_labels stays cheap to import
+
+def read_label_dict(xml_path):
+    '''
+    read_label_dict parses a service XML file and returns a dict that maps each metric label
+    to a tuple of (RRDFILE, DS).
+    '''
+    import xml.etree.ElementTree as ET
+
+    label_dict = {}
+
+    for datasource in ET.parse(xml_path).getroot().findall('DATASOURCE'):
+        ds_num = datasource.find('DS').text
+        name = datasource.find('NAME').text
+        path = datasource.find('RRDFILE').text
+        label_dict[name] = (path, ds_num)
+
+    return label_dict
+
+def filter_labels(label_dict, ds_match=None):
+    '''
+    filter_labels returns the part of label_dict whose metric labels match the ds_match regex.
+    With no ds_match everything is returned.
+    '''
+    if not ds_match:
+        return label_dict
+
+    return dict([(metric, label_dict[metric]) for metric in label_dict.keys() if re.search(ds_match, metric)])
+
+class ServiceIndex:
+    '''
+    ServiceIndex maps host/service to the label dict of the service.
+    index_path is the directory to keep the index in, perfdata_path the pnp4nagios perfdata directory.
+    Each host file is replaced in one rename, so readers never see half of one and don't lock.
+    Writers take a lock, so checks running in parallel don't lose each other's updates.
+    '''
+
+    def __init__(self, index_path, perfdata_path):
+        self.index_path     = index_path
+        self.perfdata_path  = perfdata_path
+
+        if not os.path.isdir(index_path):
+            os.makedirs(index_path)
+
+    def xml_path(self, host, service_name):
+        return '{}/{}/{}.xml'.format(self.perfdata_path, host, service_name)
+
+    def host_path(self, host):
+        return os.path.join(self.index_path, quote(host, safe='') + '.json')
+
+    def read_host(self, host):
+        '''
+        read_host returns the index entries of host as a dict that maps each service to
+        (mtime, size, label dict). A host that isn't indexed yet has none.
+        '''
+        try:
+            with open(self.host_path(host)) as host_file:
+                entries = json.load(host_file)
+        except (OSError, ValueError):
+            return {}
+
+        # JSON has no tuples
+        return dict([(service_name, (mtime, size, dict([(metric, tuple(label)) for (metric, label) in labels.items()])))
+                     for (service_name, (mtime, size, labels)) in entries.items()])
+
+    def write_host(self, host, entries):
+        '''
+        write_host replaces the index entries of host (see read_host), or removes the file if there are none.
+        The caller should hold the lock (see locked).
+        '''
+        path = self.host_path(host)
+        if not entries:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        with open(path + '.tmp', 'w') as host_file:
+            json.dump(entries, host_file)
+        os.replace(path + '.tmp', path)
+
+    def locked(self):
+        '''
+        locked takes the writer lock and returns the lock file. Close it to let go.
+        '''
+        lock_file = open(os.path.join(self.index_path, '.lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def lookup(self, host, service_name, ds_match=None):
+        '''
+        lookup returns the label dict for host/service, filtered by ds_match.
+        The XML file is only parsed if it changed since it was indexed.
+        '''
+        stat = os.stat(self.xml_path(host, service_name))
+
+        entry = self.read_host(host).get(service_name)
+        if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+            entry = (stat.st_mtime, stat.st_size, read_label_dict(self.xml_path(host, service_name)))
+            with self.locked():
+                # Read it again under the lock, another check may have just updated the host
+                entries = self.read_host(host)
+                entries[service_name] = entry
+                self.write_host(host, entries)
+
+        return filter_labels(entry[2], ds_match)
+
+    def refresh(self):
+        '''
+        refresh walks the perfdata tree, indexes new or changed service XML files and drops
+        services (and hosts) that are gone. Only the files of hosts with changes are written.
+        It returns a sorted list of all (host, service) tuples.
+        '''
+        import xml.etree.ElementTree as ET
+
+        services = []
+
+        with self.locked():
+            seen = set()
+            for host in sorted(os.listdir(self.perfdata_path)):
+                host_path = os.path.join(self.perfdata_path, host)
+                if not os.path.isdir(host_path):
+                    continue
+
+                entries = self.read_host(host)
+                changed = False
+                host_services = set()
+                for file_name in sorted(os.listdir(host_path)):
+                    if not file_name.endswith('.xml'):
+                        continue
+                    service_name = file_name[:-len('.xml')]
+                    xml_path = os.path.join(host_path, file_name)
+                    stat = os.stat(xml_path)
+
+                    entry = entries.get(service_name)
+                    if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+                        try:
+                            entries[service_name] = (stat.st_mtime, stat.st_size, read_label_dict(xml_path))
+                        except ET.ParseError:
+                            # Probably being written by pnp4nagios right now. Catch it next time.
+                            continue
+                        changed = True
+
+                    host_services.add(service_name)
+                    services.append((host, service_name))
+
+                for service_name in list(entries.keys()):
+                    if service_name not in host_services:
+                        del entries[service_name]
+                        changed = True
+
+                if changed:
+                    self.write_host(host, entries)
+                seen.add(os.path.basename(self.host_path(host)))
+
+            for file_name in os.listdir(self.index_path):
+                if file_name.endswith('.json') and file_name not in seen:
+                    os.remove(os.path.join(self.index_path, file_name))
+
+        return services
+
+class MemoryIndex:
+    '''
+    MemoryIndex is the in-memory counterpart of ServiceIndex for long running processes (see check_server.py).
+    It keeps the label dict of every service it has been asked about, keyed on the XML file path,
+    and parses the XML again only if its mtime or size changed.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, perfdata_path, host, service_name, ds_match=None):
+        '''
+        lookup returns the label dict for host/service under perfdata_path, filtered by ds_match.
+        '''
+        xml_path = '{}/{}/{}.xml'.format(perfdata_path, host, service_name)
+        stat = os.stat(xml_path)
+
+        entry = self.entries.get(xml_path)
+        if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+            entry = (stat.st_mtime, stat.st_size, read_label_dict(xml_path))
+            self.entries[xml_path] = entry
+
+        return filter_labels(entry[2], ds_match)
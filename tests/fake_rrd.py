@@ -0,0 +1,378 @@
+import math
+import random
+import re
+import subprocess
+import rrd_query
+import check_predicted
+
+nan = float('nan')
+units = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_time(value, now, reference=None):
+    '''
+    parse_time understands the times check_predicted.py hands rrdtool: epoch seconds, 'now' and
+    'end-<count><unit>' relative to reference.
+    '''
+    if value == 'now':
+        return now
+    match = re.match(r'^end-(\d+)(s|min|h|d|w)$', value)
+    if match:
+        return reference - int(match.group(1)) * units[match.group(2)]
+    return int(value)
+
+class FakeExecutor:
+    '''
+    FakeExecutor serves 'rrdtool fetch' from a dict of position (timestamp / step) to value for a
+    single data source named '1', rounding start and end the way rrd_fetch does. It records the
+    fetches it was asked for. It has no info, so the archives of its files can't be looked at.
+    '''
+
+    def __init__(self, values, step=60, now=0):
+        self.values     = values
+        self.step       = step
+        self.now        = now
+        self.fetches    = []
+
+    def fetch(self, args):
+        self.fetches.append(args)
+        options = dict(zip(args[2::2], args[3::2]))
+        end = parse_time(options['--end'], self.now)
+        start = parse_time(options['--start'], self.now, end)
+
+        step = self.step
+        start -= start % step
+        end += step - end % step
+        rows = [(self.values.get(pos),) for pos in range(start // step + 1, end // step + 1)]
+
+        return ((start, end, step), ('1',), rows)
+
+    def graph(self, args):
+        return run_graph(self, args)
+
+class ArchiveExecutor:
+    '''
+    ArchiveExecutor serves 'rrdtool fetch' and 'rrdtool info' for one data source named '1' from several
+    AVERAGE archives, given as a dict of step to (rows, dict of position to value). It picks the archive
+    the way rrd_fetch does: of those reaching back to start, the one with the step closest to the
+    resolution asked for, otherwise the one covering the most.
+    '''
+
+    def __init__(self, archives, now):
+        self.archives   = archives
+        self.now        = now
+        self.fetches    = []
+
+    def choose(self, start, end, resolution):
+        full = []
+        partial = []
+        for (step, (rows, values)) in sorted(self.archives.items()):
+            cal_end = self.now - self.now % step
+            cal_start = cal_end - step * rows
+            if cal_start <= start:
+                full.append((abs(resolution - step), step))
+            else:
+                partial.append((cal_start - end, abs(resolution - step), step))
+        if full:
+            return min(full)[-1]
+        return min(partial)[-1]
+
+    def fetch(self, args):
+        self.fetches.append(args)
+        options = dict(zip(args[2::2], args[3::2]))
+        end = parse_time(options['--end'], self.now)
+        start = parse_time(options['--start'], self.now, end)
+
+        step = self.choose(start, end, int(options.get('--resolution', 1)))
+        (rows, values) = self.archives[step]
+        start -= start % step
+        end += step - end % step
+        newest = (self.now - self.now % step) // step
+        fetched = []
+        for pos in range(start // step + 1, end // step + 1):
+            fetched.append((values.get(pos) if newest - rows < pos <= newest else None,))
+
+        return ((start, end, step), ('1',), fetched)
+
+    def info(self, args):
+        return {'step': min(self.archives.keys()),
+                'last_update': self.now,
+                'rras': [('AVERAGE', step, rows) for (step, (rows, values)) in sorted(self.archives.items())]}
+
+    def graph(self, args):
+        return run_graph(self, args)
+
+class FileExecutor:
+    '''
+    FileExecutor serves fetch, info and graph for several files, each from an executor of its own
+    (ArchiveExecutor) in a dict of path to executor. It records the graphs it was asked for. Reading
+    a file in broken raises an RRDQueryError, like rrdtool does on a file it can't read.
+    '''
+
+    def __init__(self, executors, now, broken=()):
+        self.executors  = executors
+        self.now        = now
+        self.broken     = set(broken)
+        self.graphs     = []
+
+    def executor(self, path):
+        if path in self.broken:
+            raise rrd_query.RRDQueryError('opening {}: No such file or directory'.format(path))
+        return self.executors[path]
+
+    def fetch(self, args):
+        return self.executor(args[0]).fetch(args)
+
+    def info(self, args):
+        return self.executor(args[0]).info(args)
+
+    def graph(self, args):
+        self.graphs.append(args)
+        return run_graph(self, args)
+
+def seasonal_values(now, rows, gap=13, seed=7):
+    '''
+    seasonal_values returns rows 60s values up to now as a dict of position to value: a daily cycle with
+    noise, and every gap-th one unknown.
+    '''
+    generator = random.Random(seed)
+    last_pos = now // 60
+    values = {}
+    for pos in range(last_pos - rows + 1, last_pos + 1):
+        if pos % gap:
+            values[pos] = 100 + 40 * math.sin(2 * math.pi * pos / 1440.0) + generator.gauss(0, 5)
+    return values
+
+def seasonal_archives(now, steps=(60,), rows=1500, coarse_rows=600, values=None):
+    '''
+    seasonal_archives returns AVERAGE archives for ArchiveExecutor, each step in steps a multiple of 60.
+    The 60s rows are values (seasonal_values by default) and the coarser ones their averages, unknown
+    when more than half of the 60s rows are (xff 0.5).
+    '''
+    fine = values if values is not None else seasonal_values(now, rows)
+    archives = {}
+    for step in steps:
+        factor = step // 60
+        if factor == 1:
+            archives[step] = (rows, fine)
+            continue
+        coarse = {}
+        for pos in range((now // 60 - rows) // factor + 1, now // step + 1):
+            known = [fine[fine_pos] for fine_pos in range((pos - 1) * factor + 1, pos * factor + 1) if fine_pos in fine]
+            if len(known) * 2 >= factor:
+                coarse[pos] = sum(known) / len(known)
+        archives[step] = (coarse_rows, coarse)
+    return archives
+
+def create_rrd(path, now, steps=(60,), rows=1500, coarse_rows=600, values=None):
+    '''
+    create_rrd writes the 60s rows of seasonal_archives to an rrd file at path with rrdtool, with
+    an AVERAGE archive for each step in steps. The last update is at now.
+    '''
+    if values is None:
+        values = seasonal_values(now, rows)
+    last_pos = now // 60
+    first_pos = last_pos - rows + 1
+    archives = ['RRA:AVERAGE:0.5:{}:{}'.format(step // 60, rows if step == 60 else coarse_rows) for step in steps]
+    subprocess.check_call(['rrdtool', 'create', path, '--start', str((first_pos - 1) * 60), '--step', '60',
+                           'DS:1:GAUGE:120:U:U'] + archives)
+
+    updates = ['{}:{}'.format(pos * 60, values.get(pos, 'U')) for pos in range(first_pos, last_pos + 1)]
+    if now % 60:
+        updates.append('{}:U'.format(now))
+    for index in range(0, len(updates), 500):
+        subprocess.check_call(['rrdtool', 'update', path] + updates[index:index + 500])
+
+# A day over 288 pixels has the rpn graph read at 300s, hourly windows of 600s
+now = 1000 * 86400 + 30
+compare_params = {'interval': 3600, 'count': -3, 'window': 600}
+
+def compare_check(executor, path, sample_time, mode, out_file='foo', **kwargs):
+    '''
+    compare_check returns a check of data source '1' of path with compare_params, whose graph would read at 300s.
+    '''
+    query = rrd_query.RRDQuery(executor=executor, start_time='end-1d', end_time=str(sample_time), graph_width=288,
+                               out_file=out_file)
+    return check_predicted.MetricPredict(query, 'host', '/nonexistent', 'service', None,
+                                         sample_time=str(sample_time), mode=mode, flush=False,
+                                         label_dict={'m': (path, '1')}, **dict(compare_params, **kwargs))
+
+def assert_matches_rpn(output, rpn):
+    # The rpn values are printed with two decimals
+    assert sorted(output.keys()) == sorted(rpn.keys())
+    for name in rpn.keys():
+        if math.isnan(rpn[name]):
+            assert math.isnan(output[name]), name
+        else:
+            assert abs(output[name] - rpn[name]) <= 0.005 + 1e-9, name
+
+def unknown_recently(values):
+    # The last 20 minutes unknown, LAST falls back to older values
+    return dict([(pos, value) for (pos, value) in values.items() if pos <= now // 60 - 20])
+
+def constant(values):
+    # sigma is 0, so is diff
+    return dict([(pos, 5.0) for pos in values.keys()])
+
+def unknown(values):
+    return {}
+
+def consolidate(start, end, step, values, wanted):
+    '''
+    consolidate turns rows fetched at step into rows of wanted seconds (rounded up to a multiple of step)
+    the way reduce_data in rrd_graph.c does. It returns (start, end, step, values).
+    '''
+    factor = -(-wanted // step)
+    new_step = factor * step
+    values = list(values)
+    reduced = []
+
+    start_offset = start % new_step
+    if start_offset:
+        start -= start_offset
+        values = values[factor - start_offset // step:]
+        reduced.append(nan)
+    end_offset = end % new_step
+    if end_offset:
+        end += new_step - end_offset
+        values = values[:len(values) - end_offset // step]
+
+    for index in range(0, len(values) - factor + 1, factor):
+        known = [value for value in values[index:index + factor] if not math.isnan(value)]
+        reduced.append(sum(known) / len(known) if known else nan)
+    if end_offset:
+        reduced.append(nan)
+
+    return (start, end, new_step, reduced)
+
+def divide(top, bottom):
+    if bottom == 0:
+        if top == 0 or math.isnan(top):
+            return nan
+        return math.copysign(float('inf'), top)
+    return top / bottom
+
+def run_graph(executor, args):
+    '''
+    run_graph evaluates the part of 'rrdtool graph' the queries of check_predicted.py use, with
+    fetches from executor, and returns the PRINT lines. DEFs ask for the pixel step (or their own
+    step if that is coarser) and finer rows are consolidated. PREDICT, PREDICTSIGMA and TRENDNAN
+    follow rrd_rpncalc.c, down to PREDICT leaving out the first row of the data.
+    '''
+    options = {}
+    index = 1
+    while args[index].startswith('--'):
+        options[args[index]] = args[index + 1]
+        index += 2
+    end = parse_time(options['--end'], executor.now)
+    start = parse_time(options['--start'], executor.now, end)
+    pixel = max(int(options['--step']), (end - start) // int(options['--width']))
+
+    # name -> (step, values) of every DEF and CDEF, and name -> value of every VDEF
+    series = {}
+    vdefs = {}
+    prints = []
+
+    for item in args[index:]:
+        (kind, rest) = item.split(':', 1)
+        if kind == 'DEF':
+            (name, rest) = rest.split('=', 1)
+            parts = rest.split(':')
+            step = pixel
+            for option in parts[3:]:
+                if option.startswith('step='):
+                    step = max(pixel, int(option[len('step='):]))
+            ((fetch_start, fetch_end, fetch_step), ds_names, rows) = executor.fetch(
+                [parts[0], parts[2], '--start', str(start), '--end', str(end), '--resolution', str(step)])
+            column = ds_names.index(parts[1])
+            values = [nan if row[column] is None else row[column] for row in rows]
+            if fetch_step < step:
+                (fetch_start, fetch_end, fetch_step, values) = consolidate(fetch_start, fetch_end, fetch_step,
+                                                                           values, step)
+            series[name] = (fetch_step, values)
+        elif kind == 'CDEF':
+            (name, rpn) = rest.split('=', 1)
+            series[name] = run_rpn(rpn.split(','), series)
+        elif kind == 'VDEF':
+            (name, rpn) = rest.split('=', 1)
+            (source, function) = rpn.split(',')
+            assert function == 'LAST'
+            known = [value for value in series[source][1] if not math.isnan(value) and not math.isinf(value)]
+            vdefs[name] = known[-1] if known else nan
+        elif kind == 'PRINT':
+            (name, format_str) = rest.split(':', 1)
+            prints.append(format_str.replace('%6.2lf', '%6.2f') % vdefs[name])
+
+    return prints
+
+def run_rpn(tokens, series):
+    '''
+    run_rpn evaluates a CDEF over every row of the series it uses, which have to line up.
+    '''
+    names = [token for token in tokens if token in series]
+    (step, length) = (series[names[0]][0], len(series[names[0]][1]))
+    assert all([(series[name][0], len(series[name][1])) == (step, length) for name in names])
+
+    result = []
+    for row in range(length):
+        stack = []
+        for (position, token) in enumerate(tokens):
+            if token in series:
+                stack.append(series[token][1][row])
+            elif token in ('PREDICT', 'PREDICTSIGMA'):
+                data = series[tokens[position - 1]][1]
+                stack.pop()
+                window = stack.pop()
+                count = int(stack.pop())
+                shift = stack.pop()
+                locstep = int(math.ceil(window / step))
+                known = []
+                for loop in range(abs(count)):
+                    shiftstep = int(math.ceil(loop * shift / step))
+                    for offset in range(shiftstep, shiftstep + locstep + 1):
+                        if 0 <= offset < row and not math.isnan(data[row - offset]):
+                            known.append(data[row - offset])
+                value = nan
+                if token == 'PREDICT' and known:
+                    value = sum(known) / len(known)
+                if token == 'PREDICTSIGMA' and len(known) > 1:
+                    mean = sum(known) / len(known)
+                    value = math.sqrt(sum([(item - mean) ** 2 for item in known]) / (len(known) - 1))
+                stack.append(value)
+            elif token == 'TRENDNAN':
+                data = series[tokens[position - 2]][1]
+                seconds = stack.pop()
+                stack.pop()
+                value = nan
+                if row + 1 >= math.ceil(seconds / step):
+                    known = []
+                    offset = 0
+                    while seconds > 0:
+                        if not math.isnan(data[row - offset]):
+                            known.append(data[row - offset])
+                        offset += 1
+                        seconds -= step
+                    if known:
+                        value = sum(known) / len(known)
+                stack.append(value)
+            elif token == 'EQ':
+                (first, second) = (stack.pop(-2), stack.pop())
+                stack.append(nan if math.isnan(first) or math.isnan(second) else float(first == second))
+            elif token == 'IF':
+                (condition, then, otherwise) = (stack.pop(-3), stack.pop(-2), stack.pop())
+                stack.append(otherwise if math.isnan(condition) or condition == 0 else then)
+            elif token == 'ABS':
+                stack.append(abs(stack.pop()))
+            elif token in ('+', '-', '/'):
+                (first, second) = (stack.pop(-2), stack.pop())
+                if token == '+':
+                    stack.append(first + second)
+                elif token == '-':
+                    stack.append(first - second)
+                else:
+                    stack.append(divide(first, second))
+            else:
+                stack.append(float(token))
+        assert len(stack) == 1, tokens
+        result.append(stack[0])
+
+    return (step, result)
@@ -0,0 +1,6 @@
+import check_client
+
+def test_parse_timeout():
+    assert check_client.parse_timeout(['--host', 'h', '--servicename', 's']) == 40
+    assert check_client.parse_timeout(['--host', 'h', '--timeout', '12']) == 12
+    assert check_client.parse_timeout(['--timeout=7', '--host', 'h']) == 7
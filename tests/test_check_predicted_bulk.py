@@ -0,0 +1,132 @@
+import time
+import pytest
+import rrd_query
+import check_predicted
+import check_predicted_bulk
+import fake_rrd
+from fake_rrd import now
+
+# host -> service -> metrics, each metric in a file of its own
+tree = {'core-1': {'Interface_1': ['in', 'out'], 'Interface_2': ['in', 'out'], 'CPU_load': ['load1']},
+        'core-2': {'Interface_1': ['in', 'out'], 'Broken': ['in']}}
+
+def rrd_path(host, service_name, metric):
+    return '/rrd/{}/{}_{}.rrd'.format(host, service_name, metric)
+
+def perfdata(tmp_path):
+    '''
+    perfdata writes the service XML files of tree under tmp_path and returns a FileExecutor with
+    seasonal data of its own in every rrd file, constant for the CPU_load service and none for the
+    Broken service.
+    '''
+    executors = {}
+    for host in tree.keys():
+        host_dir = tmp_path / 'perfdata' / host
+        host_dir.mkdir(parents=True)
+        for (service_name, metrics) in tree[host].items():
+            datasources = ''
+            for metric in metrics:
+                path = rrd_path(host, service_name, metric)
+                datasources += '<DATASOURCE><DS>1</DS><NAME>{}</NAME><RRDFILE>{}</RRDFILE></DATASOURCE>'.format(metric, path)
+                values = fake_rrd.seasonal_values(now, 1500, seed=len(executors))
+                if service_name == 'CPU_load':
+                    values = fake_rrd.constant(values)
+                executors[path] = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, values=values), now)
+            (host_dir / (service_name + '.xml')).write_text('<NAGIOS>{}</NAGIOS>'.format(datasources))
+
+    return fake_rrd.FileExecutor(executors, now, broken=[rrd_path('core-2', 'Broken', 'in')])
+
+def bulk_args(tmp_path, *extra):
+    return check_predicted_bulk.build_parser().parse_args(
+        ['--path', str(tmp_path / 'perfdata'), '--sampleinterval', '3600', '--samplecount', '-3',
+         '--samplewindow', '600', '-w', '1.26', '-c', '1.32'] + list(extra))
+
+def single_result(args, host, service_name, executor):
+    '''
+    single_result runs one check on its own, like check_predicted.py does, and returns the
+    (exitcode, status, perfdata) check_services reports for it.
+    '''
+    check = check_predicted.build_check(args, host, service_name, flush=False, executor=executor)
+    try:
+        (exitcode, output) = check_predicted.run_check(check, timeout=args.timeout)
+    except Exception as err:
+        return check_predicted_bulk.unknown_result(host, service_name, err)[2:]
+    return (exitcode, output.split('\n')[0].split(' | ')[0], check.perfdata)
+
+def run_bulk(args, executor, monkeypatch):
+    monkeypatch.setattr(rrd_query, 'get_executor', lambda name: executor)
+    services = check_predicted_bulk.find_services(args.path, args.host_match, args.service_match)
+    results = []
+    for batch in check_predicted_bulk.batch_services(services, args.batch_size):
+        results.extend(check_predicted_bulk.check_services((args, batch)))
+    return results
+
+@pytest.mark.parametrize('mode', ['rpn', 'numpy'])
+def test_spool_matches_single_checks(tmp_path, monkeypatch, mode):
+    executor = perfdata(tmp_path)
+    args = bulk_args(tmp_path, '--mode', mode, '--batchsize', '2')
+    spool_file = str(tmp_path / 'spool')
+
+    results = run_bulk(args, executor, monkeypatch)
+    check_predicted_bulk.write_spool(results, spool_file, args.service_prefix)
+
+    expected = {}
+    for host in tree.keys():
+        for service_name in tree[host].keys():
+            (exitcode, status, perfdata_list) = single_result(args, host, service_name, executor)
+            expected[(host, service_name)] = '{} Predicted_{} {} {}'.format(exitcode, service_name,
+                                                                          '|'.join(perfdata_list) or '-', status)
+
+    with open(spool_file) as spool:
+        lines = spool.read().split('\n')
+    sections = {}
+    host = None
+    for line in lines:
+        if line.startswith('<<<<') and line != '<<<<>>>>':
+            host = line[4:-4]
+        elif line and not line.startswith('<<<'):
+            service_name = line.split(' ')[1][len('Predicted_'):]
+            sections[(host, service_name)] = line
+
+    assert sections == expected
+    # Not all the same, the warn/crit levels sort the services out
+    assert set([int(line.split(' ')[0]) for line in sections.values()]) == set([0, 1, 2, 3])
+
+def test_passive_lines(tmp_path, monkeypatch):
+    executor = perfdata(tmp_path)
+    args = bulk_args(tmp_path)
+    cmd_file = str(tmp_path / 'nagios.cmd')
+
+    results = run_bulk(args, executor, monkeypatch)
+    check_predicted_bulk.write_passive(results, cmd_file, args.service_prefix)
+
+    with open(cmd_file) as cmd_pipe:
+        lines = cmd_pipe.read().splitlines()
+    assert len(lines) == len(results)
+    for (line, (host, service_name, exitcode, status, perfdata_list)) in zip(lines, results):
+        command = line.split('] ', 1)[1]
+        output = status + (' | ' + ' '.join(perfdata_list) if perfdata_list else '')
+        assert command == 'PROCESS_SERVICE_CHECK_RESULT;{};Predicted_{};{};{}'.format(host, service_name, exitcode, output)
+
+def test_batches_stay_on_one_host():
+    services = [('b', 's1'), ('a', 's1'), ('b', 's2'), ('b', 's3'), ('a', 's2')]
+
+    assert check_predicted_bulk.batch_services(services, 2) == [[('a', 's1'), ('a', 's2')],
+                                                                [('b', 's1'), ('b', 's2')],
+                                                                [('b', 's3')]]
+
+def test_compiled_queries_time_out(tmp_path, monkeypatch):
+    executor = perfdata(tmp_path)
+    graph = executor.graph
+    def slow_graph(args):
+        time.sleep(3)
+        return graph(args)
+    executor.graph = slow_graph
+    args = bulk_args(tmp_path, '--timeout', '1', '--hosts', '^core-1$')
+
+    started = time.time()
+    results = run_bulk(args, executor, monkeypatch)
+
+    assert time.time() - started < 3
+    assert [(host, exitcode, status) for (host, service_name, exitcode, status, perfdata_list) in results] == \
+        [('core-1', 3, 'UNKNOWN - Timeout: check execution aborted after 1s')] * 3
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import pytest
+import nagiosplugin
+import check_server
+import check_client
+import check_predicted
+import fake_rrd
+from fake_rrd import now
+
+def write_xml(perfdata, host, service_name, metrics):
+    host_dir = perfdata / host
+    host_dir.mkdir(parents=True, exist_ok=True)
+    datasources = ''.join(['<DATASOURCE><DS>1</DS><NAME>{0}</NAME><RRDFILE>/rrd/{1}/{2}_{0}.rrd</RRDFILE></DATASOURCE>'.format(
+        metric, host, service_name) for metric in metrics])
+    (host_dir / (service_name + '.xml')).write_text('<NAGIOS>{}</NAGIOS>'.format(datasources))
+
+def files(broken=()):
+    executors = {}
+    for (seed, metric) in enumerate(['in', 'out']):
+        values = fake_rrd.seasonal_values(now, 1500, seed=seed)
+        executors['/rrd/web/if_{}.rrd'.format(metric)] = fake_rrd.ArchiveExecutor(
+            fake_rrd.seasonal_archives(now, values=values), now)
+    return fake_rrd.FileExecutor(executors, now, broken)
+
+@pytest.fixture
+def server(tmp_path):
+    '''
+    server runs a check server on a socket under tmp_path, with fake executors in its pool,
+    and points check_client at it.
+    '''
+    socket_path = str(tmp_path / 'check.sock')
+    check_server_ = check_server.CheckServer(socket_path, workers=2)
+    check_server_.executors.get().close()
+    check_server_.executors.get().close()
+    check_server_.executors.put(files())
+    check_server_.executors.put(files(broken=['/rrd/web/if_out.rrd']))
+
+    thread = threading.Thread(target=check_server_.serve_forever)
+    thread.start()
+    os.environ['CHECK_PREDICTED_SOCKET'] = socket_path
+    try:
+        yield check_server_
+    finally:
+        del os.environ['CHECK_PREDICTED_SOCKET']
+        check_server_.shutdown()
+        thread.join()
+        # The fakes have no coprocess to close
+        while not check_server_.executors.empty():
+            check_server_.executors.get()
+        check_server_.server_close()
+
+def client(monkeypatch, capsys, argv):
+    '''
+    client runs check_client.py with argv and returns its (exit code, stdout).
+    '''
+    monkeypatch.setattr(sys, 'argv', ['check_client.py'] + argv)
+    with pytest.raises(SystemExit) as exit_info:
+        check_client.main()
+    return (exit_info.value.code, capsys.readouterr().out)
+
+def direct(capsys, argv, executor):
+    '''
+    direct runs the check the way check_predicted.py does, through nagiosplugin's Check.main,
+    and returns its (exit code, stdout).
+    '''
+    @nagiosplugin.guarded
+    def main():
+        args = check_predicted.build_parser().parse_args(argv)
+        check = check_predicted.build_check(args, args.host, args.service_name, executor=executor)
+        check.main(args.debug, args.timeout)
+
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    return (exit_info.value.code, capsys.readouterr().out)
+
+def check_argv(tmp_path, *extra):
+    write_xml(tmp_path / 'perfdata', 'web', 'if', ['in', 'out'])
+    return (['--host', 'web', '--servicename', 'if', '--path', str(tmp_path / 'perfdata'),
+             '--sampleinterval', '3600', '--samplecount', '-3', '--samplewindow', '600'] + list(extra))
+
+@pytest.mark.parametrize('extra', [[], ['-w', '0.1', '-c', '0.2'], ['-w', '0.1', '-c', '50']])
+def test_round_trip(tmp_path, monkeypatch, capsys, server, extra):
+    argv = check_argv(tmp_path, *extra)
+
+    # Both executors of the pool take a turn
+    for executor in [files(), files(broken=['/rrd/web/if_out.rrd'])]:
+        (exitcode, output) = client(monkeypatch, capsys, argv)
+        assert (exitcode, output) == direct(capsys, argv, executor)
+
+    assert server.executors.qsize() == 2
+
+def test_round_trip_outcomes(tmp_path, monkeypatch, capsys, server):
+    # An alert and a check that fails on a broken rrd file come through with their own exit codes
+    argv = check_argv(tmp_path, '-w', '0.1', '-c', '0.2')
+    outcomes = set()
+    for index in range(2):
+        outcomes.add(client(monkeypatch, capsys, argv)[0])
+
+    assert outcomes == set([2, 3])
+
+def test_bad_requests(tmp_path, monkeypatch, capsys, server):
+    (exitcode, output) = client(monkeypatch, capsys, ['--samplecount', 'many'])
+    assert exitcode == 3
+    assert output.startswith('UNKNOWN: Invalid arguments: ')
+
+    (exitcode, output) = client(monkeypatch, capsys, check_argv(tmp_path)[:-6] + ['--servicename', 'nothing'])
+    assert exitcode == 3
+    assert output.startswith('UNKNOWN: FileNotFoundError: ')
+
+    assert server.executors.qsize() == 2
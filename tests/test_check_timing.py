@@ -0,0 +1,23 @@
+import os
+import check_timing
+
+def test_prom_label_escapes():
+    assert check_timing.prom_label('Interface_1') == 'Interface_1'
+    assert check_timing.prom_label('a "b" c') == 'a \\"b\\" c'
+    assert check_timing.prom_label('C:\\temp') == 'C:\\\\temp'
+    assert check_timing.prom_label('two\nlines') == 'two\\nlines'
+
+def test_write_prom_escapes_labels(tmp_path):
+    timer = check_timing.PhaseTimer(prom_dir=str(tmp_path))
+    timer.add('query', 0.5)
+    timer.count('cdefs', 4)
+    timer.write('host', 'Disk "C:\\"\nfree', 'rpn')
+
+    (file_name,) = os.listdir(str(tmp_path))
+    with open(os.path.join(str(tmp_path), file_name)) as prom:
+        lines = prom.read().splitlines()
+
+    assert 'check_predicted_phase_seconds{host="host",service="Disk \\"C:\\\\\\"\\nfree",mode="rpn",phase="query"} 0.5' in lines
+    assert 'check_predicted_cdefs{host="host",service="Disk \\"C:\\\\\\"\\nfree",mode="rpn"} 4' in lines
+    # Every sample is on a line of its own
+    assert len(lines) == 5
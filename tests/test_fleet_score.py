@@ -0,0 +1,105 @@
+import math
+import numpy
+import pytest
+import rrd_query
+import fleet_score
+import predict_numpy
+import fake_rrd
+from fake_rrd import compare_check, assert_matches_rpn, now, compare_params, unknown_recently, constant, unknown
+
+changes = {'seasonal': None, 'recent': unknown_recently, 'constant': constant, 'unknown': unknown}
+
+def fleet(steps=(60,)):
+    executors = {}
+    for (name, change) in changes.items():
+        values = fake_rrd.seasonal_values(now, 1500, seed=len(name))
+        if change:
+            values = change(values)
+        executors['/{}.rrd'.format(name)] = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, steps, values=values), now)
+    return fake_rrd.FileExecutor(executors, now)
+
+def fleet_query(executor, sample_time):
+    # The same graph as compare_check, so the check reads at 300s
+    return rrd_query.RRDQuery(executor=executor, start_time='end-1d', end_time=str(sample_time), graph_width=288,
+                              out_file='foo')
+
+def score(host, diff):
+    return (host, 'service', 'in', 1.0, 1.0, 1.0, diff)
+
+def test_summarize_shares():
+    scores = [score('a', 0.5), score('b', 2.5), score('c', 3.5), score('d', math.nan), score('e', 3.0)]
+    summary = fleet_score.summarize(scores, 2.5, 3.0)
+
+    assert summary['series'] == 5
+    assert summary['known'] == 4
+    # Above means strictly above, like the check's thresholds
+    assert summary['above_warn'] == 2
+    assert summary['above_crit'] == 1
+    assert summary['share_above_warn'] == 0.5
+    assert summary['share_above_crit'] == 0.25
+
+def test_summarize_nothing_known():
+    summary = fleet_score.summarize([score('a', math.nan)], 2.5, 3.0)
+
+    assert summary['known'] == 0
+    assert summary['share_above_warn'] is None
+    assert summary['share_above_crit'] is None
+    assert summary['top'] == []
+
+def test_summarize_top():
+    scores = [score('a', 1.0), score('b', math.nan), score('c', 4.0), score('d', 2.0), score('e', 4.0), score('f', 0.0)]
+    summary = fleet_score.summarize(scores, 2.5, 3.0, top=3)
+
+    # Highest first, ties in the order the series came in, unknowns left out
+    assert [record['host'] for record in summary['top']] == ['c', 'e', 'd']
+    assert [record['diff'] for record in summary['top']] == [4.0, 4.0, 2.0]
+    assert len(fleet_score.summarize(scores, 2.5, 3.0, top=10)['top']) == 5
+
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 30000])
+def test_score_series_matches_single_series(steps, sample_time):
+    executor = fleet(steps)
+    series = [('host', name, 'm', '/{}.rrd'.format(name), '1') for name in changes.keys()]
+    query = fleet_query(executor, sample_time)
+
+    # The last read of every series
+    fetched = {}
+    fetch = query.fetch
+    def record(path, *args, **kwargs):
+        fetched[path] = fetch(path, *args, **kwargs)
+        return fetched[path]
+    query.fetch = record
+
+    scores = fleet_score.score_series(query, series, str(sample_time), **compare_params)
+
+    assert sorted([item[1] for item in scores]) == sorted(changes.keys())
+    for (host, name, metric, smooth, pred, sigma, diff) in scores:
+        # Scored on its own, the series comes out the same as stacked with the others
+        (start, step, values) = fetched['/{}.rrd'.format(name)]
+        expected = predict_numpy.score_samples(*predict_numpy.end_samples(values, step, **compare_params))
+        for (actual, wanted) in zip((smooth, pred, sigma, diff), expected):
+            if math.isnan(wanted):
+                assert math.isnan(actual), name
+            else:
+                assert actual == float(wanted), name
+
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 30000])
+def test_score_series_matches_rpn(steps, sample_time):
+    executor = fleet(steps)
+    series = [('host', name, 'm', '/{}.rrd'.format(name), '1') for name in changes.keys()]
+    scores = fleet_score.score_series(fleet_query(executor, sample_time), series, str(sample_time), **compare_params)
+
+    for (host, name, metric, smooth, pred, sigma, diff) in scores:
+        rpn = compare_check(executor, '/{}.rrd'.format(name), sample_time, 'rpn').query()
+        output = {'mavg_smooth': smooth, 'mavg_pred': pred, 'mavg_sigma': sigma, 'mavg_diff': diff}
+        assert_matches_rpn(output, rpn)
+
+def test_score_series_unreadable():
+    executor = fleet()
+    executor.broken.add('/recent.rrd')
+    series = [('host', name, 'm', '/{}.rrd'.format(name), '1') for name in ['seasonal', 'recent']]
+    scores = fleet_score.score_series(fleet_query(executor, now), series, str(now), **compare_params)
+
+    assert numpy.isnan(dict((item[1], item[6]) for item in scores)['recent'])
+    assert not numpy.isnan(dict((item[1], item[6]) for item in scores)['seasonal'])
@@ -0,0 +1,116 @@
+import math
+import shutil
+import pytest
+import rrd_query
+import check_predicted
+import fake_rrd
+from fake_rrd import FakeExecutor, compare_check, assert_matches_rpn, now, unknown_recently, constant, unknown
+
+# 60s steps, windows of 120s (3 steps) 600s (10 steps) apart, 2 of them
+step = 60
+params = {'interval': 600, 'count': -2, 'window': 120}
+
+def points_check(values, sample_time, **kwargs):
+    executor = FakeExecutor(values, step=step)
+    # A day over 1440 pixels, so the rpn graph reads at 60s too
+    query = rrd_query.RRDQuery(executor=executor, start_time='end-1d', graph_width=1440)
+    check = check_predicted.MetricPredict(query, 'host', '/nonexistent', 'service', None,
+                                          sample_time=str(sample_time), mode='points', flush=False,
+                                          label_dict={'m': ('/nonexistent/m.rrd', '1')}, **dict(params, **kwargs))
+    return (check, executor)
+
+def test_predict_points_windows():
+    # The check at 6030 ends at position 101, the step still being filled in
+    values = {100: 10, 99: 12, 98: 14,
+              91: 8, 90: 6, 89: 4, 88: 2,
+              # Just outside the windows and the shifts
+              97: 1000, 87: 1000, 81: 1000, 80: 1000}
+    (check, executor) = points_check(values, 6030)
+
+    (smooth, pred, sigma, diff) = check.predict_points('/nonexistent/m.rrd', '1')
+
+    # PREDICT at 101 covers 99..101 and 89..91
+    assert pred == 8
+    assert math.isclose(sigma, math.sqrt(10))
+    # TRENDNAN over 30s (1 step) is unknown at 101, so smooth and diff are those at 100,
+    # where PREDICT covers 98..100 and 88..90
+    assert smooth == 10
+    assert math.isclose(diff, 2 / math.sqrt(22.4))
+
+def test_predict_points_one_value():
+    (check, executor) = points_check({100: 5}, 6030)
+    (smooth, pred, sigma, diff) = check.predict_points('/nonexistent/m.rrd', '1')
+
+    assert pred == 5
+    assert math.isnan(sigma)
+    assert smooth == 5
+    assert math.isnan(diff)
+
+def test_predict_points_no_data():
+    (check, executor) = points_check({}, 6030)
+    (smooth, pred, sigma, diff) = check.predict_points('/nonexistent/m.rrd', '1')
+
+    assert math.isnan(pred)
+    assert math.isnan(sigma)
+    assert math.isnan(smooth)
+    assert math.isnan(diff)
+
+def test_query_points_matches_numpy():
+    values = dict([(pos, 100 + 10 * math.sin(pos / 7.0) + (pos % 5)) for pos in range(1, 140) if pos % 11])
+    (check, executor) = points_check(values, 8000, window=300)
+    points = check.query_points()
+    check.mode = 'numpy'
+    numpy_output = check.query_numpy()
+
+    assert sorted(points.keys()) == sorted(numpy_output.keys())
+    for name in points.keys():
+        assert math.isclose(points[name], numpy_output[name], rel_tol=1e-9), name
+
+def test_query_points_only_fetches_windows():
+    (check, executor) = points_check(dict([(pos, float(pos % 7)) for pos in range(1, 102)]), 6030)
+    check.query_points()
+
+    # One fetch per window, there is no info to look for a coarser archive in
+    assert len(executor.fetches) == abs(params['count'])
+
+def changed_values(change):
+    values = fake_rrd.seasonal_values(now, 1500)
+    if change:
+        values = change(values)
+    return values
+
+@pytest.mark.parametrize('change', [None, unknown_recently, constant, unknown])
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 4000, now - 30000])
+def test_query_points_matches_rpn(change, steps, sample_time):
+    # 60s rows get consolidated to the pixel step, the 300s archive is read as it is, and
+    # 30000s back the 60s archive no longer covers the graph
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, steps, values=changed_values(change)), now)
+    points = compare_check(executor, '/m.rrd', sample_time, 'points').query()
+    rpn = compare_check(executor, '/m.rrd', sample_time, 'rpn').query()
+
+    assert_matches_rpn(points, rpn)
+
+def test_query_points_reads_graph_only_when_unknown():
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now), now)
+    compare_check(executor, '/m.rrd', now, 'points').query()
+    assert all([fetch[3] != 'end-86400s' for fetch in executor.fetches])
+
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, values=changed_values(unknown_recently)), now)
+    compare_check(executor, '/m.rrd', now, 'points').query()
+    assert executor.fetches[-1][3] == 'end-86400s'
+
+@pytest.mark.skipif(shutil.which('rrdtool') is None, reason='rrdtool is not installed')
+@pytest.mark.parametrize('change', [None, unknown_recently, constant, unknown])
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 4000, now - 30000])
+def test_query_points_matches_rrdtool(tmp_path, change, steps, sample_time):
+    path = str(tmp_path / 'm.rrd')
+    fake_rrd.create_rrd(path, now, steps, values=changed_values(change))
+    executor = rrd_query.SubprocessExecutor()
+    out_file = str(tmp_path / 'graph.png')
+
+    points = compare_check(executor, path, sample_time, 'points', out_file).query()
+    rpn = compare_check(executor, path, sample_time, 'rpn', out_file).query()
+
+    assert_matches_rpn(points, rpn)
@@ -0,0 +1,44 @@
+import math
+import predict_math
+
+def test_steps_rounds_up():
+    assert predict_math.steps(1800, 300) == 6
+    assert predict_math.steps(1801, 300) == 7
+    assert predict_math.steps(60, 300) == 1
+    assert predict_math.steps(900.0, 60) == 15
+
+def test_predict():
+    values = [10, 12, 8, 6, 4]
+    (pred, sigma) = predict_math.predict(sum(values), sum([value * value for value in values]), len(values))
+    assert pred == 8
+    # Sample standard deviation, like PREDICTSIGMA: squared deviations 40 over n - 1
+    assert math.isclose(sigma, math.sqrt(10))
+
+def test_predict_one_value_has_no_sigma():
+    (pred, sigma) = predict_math.predict(5.0, 25.0, 1)
+    assert pred == 5.0
+    assert math.isnan(sigma)
+
+def test_predict_no_values():
+    (pred, sigma) = predict_math.predict(0.0, 0.0, 0)
+    assert math.isnan(pred)
+    assert math.isnan(sigma)
+
+def test_predict_constant_values():
+    (pred, sigma) = predict_math.predict(9.0, 27.0, 3)
+    assert pred == 3.0
+    assert sigma == 0.0
+
+def test_trend_nan():
+    nan = predict_math.nan
+    assert predict_math.trend_nan([1, 2, 3, 4], 2) == 3.5
+    # Unknown values are skipped, only the last count values count
+    assert predict_math.trend_nan([100, nan, 4, nan], 3) == 4
+    assert math.isnan(predict_math.trend_nan([1, nan, nan], 2))
+
+def test_difference():
+    assert predict_math.difference(14.0, 8.0, 2.0) == 3.0
+    assert predict_math.difference(2.0, 8.0, 2.0) == 3.0
+    assert predict_math.difference(14.0, 8.0, 0.0) == 0.0
+    assert math.isnan(predict_math.difference(14.0, 8.0, predict_math.nan))
+    assert math.isnan(predict_math.difference(predict_math.nan, 8.0, 2.0))
@@ -0,0 +1,176 @@
+import math
+import shutil
+import numpy
+import pytest
+import predict_math
+import predict_numpy
+import rrd_query
+import fake_rrd
+from fake_rrd import compare_check, assert_matches_rpn, now, unknown_recently, constant, unknown
+
+def random_series(rows, length, seed=1):
+    random = numpy.random.RandomState(seed)
+    data = 1000 + 100 * random.standard_normal((rows, length))
+    data[random.random_sample((rows, length)) < 0.2] = numpy.nan
+    # A gap longer than a window
+    data[0, 30:45] = numpy.nan
+    return data
+
+def reference_predict(series, pos, step, interval, count, window):
+    '''
+    reference_predict works out PREDICT and PREDICTSIGMA at pos one value at a time.
+    '''
+    locstep = predict_math.steps(window, step)
+    shiftstep = predict_math.steps(interval, step)
+    total = 0.0
+    total2 = 0.0
+    known = 0
+    for loop in range(abs(count)):
+        for offset in range(locstep + 1):
+            index = pos - loop * shiftstep - offset
+            if index >= 0 and not predict_math.isnan(series[index]):
+                total += series[index]
+                total2 += series[index] * series[index]
+                known += 1
+    return predict_math.predict(total, total2, known)
+
+def assert_same(actual, expected):
+    if predict_math.isnan(expected):
+        assert math.isnan(actual)
+    else:
+        assert math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9)
+
+def test_predict_series_matches_predict_math():
+    (step, interval, count, window) = (60, 1200, -3, 300)
+    data = random_series(3, 80)
+    (pred, sigma) = predict_numpy.predict_series(data, step, interval, count, window)
+
+    for row in range(data.shape[0]):
+        for pos in range(data.shape[1]):
+            (expected_pred, expected_sigma) = reference_predict(data[row], pos, step, interval, count, window)
+            assert_same(pred[row, pos], expected_pred)
+            assert_same(sigma[row, pos], expected_sigma)
+
+def test_trend_nan_series_matches_predict_math():
+    data = random_series(3, 80)
+    smooth = predict_numpy.trend_nan_series(data, 60, 240)
+
+    for row in range(data.shape[0]):
+        for pos in range(data.shape[1]):
+            if pos < 3:
+                # Not a full window of history yet
+                assert math.isnan(smooth[row, pos])
+            else:
+                assert_same(smooth[row, pos], predict_math.trend_nan(list(data[row, :pos + 1]), 4))
+
+def test_last_valid():
+    nan = numpy.nan
+    data = numpy.array([[1.0, 2.0, nan], [nan, nan, nan], [4.0, nan, 5.0]])
+    assert_same(predict_numpy.last_valid(data)[0], 2.0)
+    assert math.isnan(predict_numpy.last_valid(data)[1])
+    assert_same(predict_numpy.last_valid(data)[2], 5.0)
+
+def test_window_sums_shorter_than_window():
+    data = numpy.array([[1.0, numpy.nan, 3.0]])
+    (total, total2, known) = predict_numpy.window_sums(data, 10)
+
+    assert total.tolist() == [[1.0, 1.0, 4.0]]
+    assert total2.tolist() == [[1.0, 1.0, 10.0]]
+    assert known.tolist() == [[1, 1, 2]]
+
+def test_window_sums_empty():
+    (total, total2, known) = predict_numpy.window_sums(numpy.zeros((2, 0)), 5)
+    assert total.shape == (2, 0)
+
+def test_predict_last_short_series():
+    # Less data than one window: PREDICT still works, TRENDNAN has no full window
+    data = numpy.array([[5.0, 7.0]])
+    (smooth, pred, sigma, diff) = predict_numpy.predict_last(data, 60, interval=600, count=-2, window=600)
+
+    assert_same(pred[0], 6.0)
+    assert_same(sigma[0], math.sqrt(2))
+    assert math.isnan(smooth[0])
+    assert math.isnan(diff[0])
+
+def test_score_samples_matches_predict_last():
+    (step, interval, count) = (300, 3600, -4)
+    data = random_series(6, 60, seed=3)
+    # The step rrd_fetch returns while it is still being filled in
+    data[:, -1] = numpy.nan
+    # A series whose newest values are all missing, and one without any
+    data[2, -6:] = numpy.nan
+    data[5, :] = numpy.nan
+
+    for window in [300, 600, 1800]:
+        columns = [predict_numpy.end_samples(data[row], step, interval, count, window) for row in range(data.shape[0])]
+        stacked = [numpy.array([column[part] for column in columns]) for part in range(3)]
+        scores = predict_numpy.score_samples(*stacked)
+        expected = predict_numpy.predict_last(data, step, interval, count, window)
+
+        for row in range(data.shape[0]):
+            for (actual, wanted) in zip(scores, expected):
+                assert_same(actual[row], wanted[row])
+
+def rpn_series(data, step, interval, count, window):
+    '''
+    rpn_series evaluates the CDEFs check_predicted.py defines (see MetricPredict.define_query) over data
+    with the fake rrdtool, and returns the (smooth, pred, sigma, diff) series.
+    '''
+    series = {'ds': (step, list(data))}
+    basis = '{},{},{},ds'.format(interval, count, window)
+    rpn = [('pred', basis + ',PREDICT'), ('sigma', basis + ',PREDICTSIGMA'),
+           ('smooth', 'ds,{},TRENDNAN'.format(window / 2)), ('diff', 'sigma,0,EQ,0,smooth,pred,-,ABS,sigma,/,IF')]
+    for (name, rdef) in rpn:
+        series[name] = fake_rrd.run_rpn(rdef.split(','), series)
+    return [series[name][1] for name in ['smooth', 'pred', 'sigma', 'diff']]
+
+def test_series_match_rpn():
+    (step, interval, count) = (60, 1200, -3)
+    data = random_series(3, 120, seed=5)
+    # A stretch with the same value all over, where sigma is 0
+    data[1, 50:90] = 7.0
+    # PREDICT never uses the first row of the data (rrd_rpncalc.c)
+    data[:, 0] = numpy.nan
+
+    for window in [60, 300, 420]:
+        (pred, sigma) = predict_numpy.predict_series(data, step, interval, count, window)
+        smooth = predict_numpy.trend_nan_series(data, step, window / 2)
+        diff = predict_numpy.difference_series(smooth, pred, sigma)
+
+        for row in range(data.shape[0]):
+            expected = rpn_series(data[row], step, interval, count, window)
+            for (actual, wanted) in zip([smooth[row], pred[row], sigma[row], diff[row]], expected):
+                for pos in range(data.shape[1]):
+                    assert_same(actual[pos], wanted[pos])
+
+@pytest.mark.parametrize('change', [None, unknown_recently, constant, unknown])
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 30000])
+def test_query_numpy_matches_rpn(change, steps, sample_time):
+    values = fake_rrd.seasonal_values(now, 1500)
+    if change:
+        values = change(values)
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, steps, values=values), now)
+
+    output = compare_check(executor, '/m.rrd', sample_time, 'numpy').query()
+    rpn = compare_check(executor, '/m.rrd', sample_time, 'rpn').query()
+
+    assert_matches_rpn(output, rpn)
+
+@pytest.mark.skipif(shutil.which('rrdtool') is None, reason='rrdtool is not installed')
+@pytest.mark.parametrize('change', [None, unknown_recently, constant, unknown])
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+@pytest.mark.parametrize('sample_time', [now, now - 30000])
+def test_query_numpy_matches_rrdtool(tmp_path, change, steps, sample_time):
+    path = str(tmp_path / 'm.rrd')
+    values = fake_rrd.seasonal_values(now, 1500)
+    if change:
+        values = change(values)
+    fake_rrd.create_rrd(path, now, steps, values=values)
+    executor = rrd_query.SubprocessExecutor()
+    out_file = str(tmp_path / 'graph.png')
+
+    output = compare_check(executor, path, sample_time, 'numpy', out_file).query()
+    rpn = compare_check(executor, path, sample_time, 'rpn', out_file).query()
+
+    assert_matches_rpn(output, rpn)
@@ -0,0 +1,70 @@
+import math
+import numpy
+import pytest
+import predict_scan
+import fake_rrd
+from fake_rrd import compare_check, now
+
+def assert_same(actual, expected, name):
+    if math.isnan(expected):
+        assert math.isnan(actual), name
+    else:
+        assert math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9), name
+
+def scan_rows(executor, start, end, chunk):
+    check = compare_check(executor, '/m.rrd', end, 'numpy')
+    return list(predict_scan.scan(check, start, end, chunk))
+
+def gap(values):
+    # Unknown for half an hour, across the chunk boundary at now - 10000 of a 2500s chunk scan
+    return dict([(pos, value) for (pos, value) in values.items() if not now // 60 - 180 < pos <= now // 60 - 150])
+
+@pytest.mark.parametrize('change', [None, gap])
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+def test_scan_matches_check_at_the_same_time(change, steps):
+    values = fake_rrd.seasonal_values(now, 1500)
+    if change:
+        values = change(values)
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, steps, values=values), now)
+    (start, end) = (now - 15000, now - 5000)
+    rows = scan_rows(executor, start, end, 2500)
+
+    # A row for every 300s step boundary after start up to end
+    assert [row[0] for row in rows] == list(range(start - start % 300 + 300, end - end % 300 + 1, 300))
+    for (timestamp, metric, smooth, pred, sigma, diff) in rows[::3]:
+        expected = compare_check(executor, '/m.rrd', timestamp, 'numpy').query()
+        assert_same(smooth, expected['mavg_smooth'], (timestamp, 'smooth'))
+        assert_same(pred, expected['mavg_pred'], (timestamp, 'pred'))
+        assert_same(sigma, expected['mavg_sigma'], (timestamp, 'sigma'))
+        assert_same(diff, expected['mavg_diff'], (timestamp, 'diff'))
+
+@pytest.mark.parametrize('steps', [(60,), (60, 300)])
+def test_scan_carries_over_chunk_boundaries(steps):
+    values = gap(fake_rrd.seasonal_values(now, 1500))
+    executor = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, steps, values=values), now)
+    (start, end) = (now - 15000, now - 5000)
+
+    whole = scan_rows(executor, start, end, 100000)
+    for chunk in [300, 700, 2500]:
+        executor.fetches = []
+        rows = scan_rows(executor, start, end, chunk)
+        assert [row[:2] for row in rows] == [row[:2] for row in whole]
+        for (row, expected) in zip(rows, whole):
+            for index in range(2, 6):
+                assert_same(row[index], expected[index], (row[0], index))
+
+        # Each chunk after the first only fetches its new steps
+        new_fetches = [fetch for fetch in executor.fetches if fetch[3].startswith('end-')]
+        assert len(executor.fetches) - len(new_fetches) > 1
+        starts = [int(fetch[3]) for fetch in executor.fetches if not fetch[3].startswith('end-')]
+        assert len([first for first in starts if first < start]) == 1
+
+def test_alert_counter():
+    counter = predict_scan.AlertCounter([1.0, 2.0])
+    nan = float('nan')
+    for (metric, diff) in [('a', 0.5), ('a', 1.5), ('a', 2.5), ('a', 1.5), ('a', nan), ('a', 1.5),
+                           ('b', 3.0), ('b', 3.0), ('b', 0.0), ('b', 2.0)]:
+        counter.add(metric, diff)
+
+    assert counter.summary() == [{'threshold': 1.0, 'steps_above': 7, 'alerts': 4},
+                                 {'threshold': 2.0, 'steps_above': 3, 'alerts': 2}]
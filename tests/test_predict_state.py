@@ -0,0 +1,75 @@
+import os
+import math
+import rrd_query
+import predict_state
+import check_predicted
+from fake_rrd import FakeExecutor
+
+# 60s steps, windows of 120s 600s apart, 3 of them
+params = {'interval': 600, 'count': -3, 'window': 120}
+
+def values_until(pos):
+    return dict([(p, 50 + 10 * math.sin(p / 5.0) + (p % 3)) for p in range(1, pos + 1) if p % 17])
+
+def run(executor, tmp_path, mode):
+    query = rrd_query.RRDQuery(executor=executor, start_time='end-1d', graph_width=1440)
+    check = check_predicted.MetricPredict(query, 'host', '/nonexistent', 'service', None, mode=mode, flush=False,
+                                          state_dir=str(tmp_path / 'state'),
+                                          label_dict={'m': (str(tmp_path / 'm.rrd'), '1')}, **params)
+    return check.query()
+
+def test_successive_runs_absorb_into_the_ring(tmp_path):
+    (tmp_path / 'm.rrd').write_bytes(b'')
+    executor = FakeExecutor(values_until(100), now=100 * 60 + 30)
+    run(executor, tmp_path, 'incremental')
+    ring = str(tmp_path / 'state' / 'host' / 'service.rings' / 'm')
+    inode = os.stat(ring).st_ino
+
+    for pos in range(101, 140, 7):
+        executor.values = values_until(pos)
+        executor.now = pos * 60 + 30
+        executor.fetches = []
+        output = run(executor, tmp_path, 'incremental')
+
+        # Only the steps since the last run (and the trailing window) were fetched
+        assert len(executor.fetches) == 1
+        assert not executor.fetches[0][3].startswith('end-')
+        # The ring was written in place
+        assert os.stat(ring).st_ino == inode
+
+        expected = run(executor, tmp_path, 'points')
+        for name in expected.keys():
+            assert math.isclose(output[name], expected[name], rel_tol=1e-9), name
+
+def test_ring_kept_out_of_the_shelve(tmp_path):
+    with predict_state.StateStore(str(tmp_path), 'host', 'service') as store:
+        state = predict_state.PredictState(('key',), 60, 604800, -5)
+        state.absorb(0, 60, [1.0, 2.0, float('nan'), 4.0])
+        store.put('m/in', state)
+
+    with predict_state.StateStore(str(tmp_path), 'host', 'service') as store:
+        state = store.get('m/in', ('key',))
+        assert state.last_pos == 4
+        state.absorb(4 * 60, 60, [5.0])
+        store.put('m/in', state)
+        assert store.get('m/in', ('other',)) is None
+
+    ring = tmp_path / 'host' / 'service.rings' / 'm%2Fin'
+    assert ring.stat().st_size == state.ring_size()
+    # The header alone is pickled
+    assert sum([path.stat().st_size for path in tmp_path.glob('host/service*') if path.is_file()]) < 4096
+
+    with predict_state.StateStore(str(tmp_path), 'host', 'service') as store:
+        state = store.get('m/in', ('key',))
+        assert [state.value(pos) for pos in [1, 2, 4, 5]] == [1.0, 2.0, 4.0, 5.0]
+        assert math.isnan(state.value(3))
+        (pred, sigma) = state.predict(300)
+        assert pred == 3.0
+
+def test_missing_ring_rebuilds(tmp_path):
+    with predict_state.StateStore(str(tmp_path), 'host', 'service') as store:
+        store.put('m', predict_state.PredictState(('key',), 60, 600, -2))
+    os.remove(str(tmp_path / 'host' / 'service.rings' / 'm'))
+
+    with predict_state.StateStore(str(tmp_path), 'host', 'service') as store:
+        assert store.get('m', ('key',)) is None
@@ -0,0 +1,54 @@
+import math
+import pytest
+import rrd_query
+import check_predicted
+import predict_profile
+from fake_rrd import FakeExecutor
+
+step = 300
+interval = 86400
+build_time = 50 * interval
+
+@pytest.fixture
+def series():
+    # Three days of 300s data with the odd gap, the last row still being filled in
+    values = dict([(pos, 100 + 20 * math.sin(pos / 30.0) + (pos % 7)) for pos in range(1, build_time // step + 300)
+                   if pos % 13])
+    return values
+
+def make_check(tmp_path, values, sample_time, window, mode):
+    rrd_file = tmp_path / 'm.rrd'
+    rrd_file.write_bytes(b'')
+    query = rrd_query.RRDQuery(executor=FakeExecutor(values, step=step))
+    return check_predicted.MetricPredict(query, 'host', str(tmp_path), 'Disk C:', None, sample_time=str(sample_time),
+                                         interval=interval, count=-3, window=window, mode=mode, flush=False,
+                                         label_dict={'m': (str(rrd_file), '1')}, profile_dir=str(tmp_path / 'profiles'))
+
+@pytest.mark.parametrize('window', [300, 600, 1800])
+def test_profile_matches_points(tmp_path, series, window):
+    check = make_check(tmp_path, series, build_time, window, 'profile')
+    assert predict_profile.build_profile(check, check.profile_dir) == 1
+
+    for offset in [0, 150, 3600, 40000]:
+        sample_time = build_time + offset
+        values = dict([(pos, value) for (pos, value) in series.items() if pos * step <= sample_time])
+        check = make_check(tmp_path, values, sample_time, window, 'profile')
+        profile_output = check.query_profile()
+        points_output = check.query_points()
+
+        for name in points_output.keys():
+            assert not math.isnan(points_output[name]), name
+            assert math.isclose(profile_output[name], points_output[name], rel_tol=1e-9), name
+
+def test_rebuild_clears_old_arrays(tmp_path, series):
+    check = make_check(tmp_path, series, build_time, 1800, 'profile')
+    predict_profile.build_profile(check, check.profile_dir)
+    stale = tmp_path / 'profiles' / 'host' / 'Disk C:.1.npy'
+    stale.write_bytes(b'')
+    other = tmp_path / 'profiles' / 'host' / 'Disk C:.other.npy'
+    other.write_bytes(b'')
+    predict_profile.build_profile(check, check.profile_dir)
+
+    assert not stale.exists()
+    assert other.exists()
+    assert predict_profile.load_profile(check.profile_dir, 'host', 'Disk C:') is not None
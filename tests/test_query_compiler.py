@@ -0,0 +1,133 @@
+import math
+import rrd_query
+import check_predicted
+import fake_rrd
+from fake_rrd import now, compare_params
+
+def files(*paths):
+    '''
+    files returns a FileExecutor with seasonal data of its own in each of paths.
+    '''
+    executors = {}
+    for (seed, path) in enumerate(paths):
+        values = fake_rrd.seasonal_values(now, 1500, seed=seed)
+        executors[path] = fake_rrd.ArchiveExecutor(fake_rrd.seasonal_archives(now, values=values), now)
+    return fake_rrd.FileExecutor(executors, now)
+
+def new_query(executor):
+    return rrd_query.RRDQuery(executor=executor, start_time='end-1d', graph_width=288, out_file='foo')
+
+def check(executor, service_name, label_dict):
+    return check_predicted.MetricPredict(new_query(executor), 'host', '/nonexistent', service_name, None,
+                                         mode='rpn', flush=False, label_dict=label_dict, **compare_params)
+
+def compiler(executor, checks, **kwargs):
+    query_compiler = rrd_query.QueryCompiler(lambda: new_query(executor), **kwargs)
+    for resource in checks:
+        query_compiler.add(resource, resource.define_query, resource.parse_output)
+    return query_compiler
+
+def single(executor, resource):
+    '''
+    single runs the check in a query of its own, without the compiler.
+    '''
+    result = resource.query()
+    del executor.graphs[:]
+    return result
+
+def defs(args):
+    return [item for item in args if item.startswith('DEF:')]
+
+def test_prefix_routing():
+    # Two services with an 'in' metric each, on different files
+    executor = files('/a.rrd', '/b.rrd')
+    first = check(executor, 'Interface_1', {'in': ('/a.rrd', '1')})
+    second = check(executor, 'Interface_2', {'in': ('/b.rrd', '1'), 'out': ('/a.rrd', '1')})
+    expected = dict([(resource, single(executor, resource)) for resource in [first, second]])
+
+    results = compiler(executor, [first, second]).run()
+
+    assert len(executor.graphs) == 1
+    assert len(defs(executor.graphs[0])) == 2
+    # Each check gets its own values back, under its own metric names
+    assert sorted(results[first].keys()) == sorted(expected[first].keys())
+    assert results[first] == expected[first]
+    assert results[second] == expected[second]
+    assert results[first]['inavg_pred'] != results[second]['inavg_pred']
+    assert results[second]['outavg_pred'] == results[first]['inavg_pred']
+
+def test_same_file_read_once():
+    # Two services with an 'in' metric each, on the same file
+    executor = files('/a.rrd')
+    first = check(executor, 'Interface_1', {'in': ('/a.rrd', '1')})
+    second = check(executor, 'Interface_1_copy', {'in': ('/a.rrd', '1')})
+    expected = single(executor, first)
+
+    results = compiler(executor, [first, second]).run()
+
+    assert len(executor.graphs) == 1
+    assert defs(executor.graphs[0]) == ['DEF:q0_dsinavg=/a.rrd:1:AVERAGE']
+    assert results[first] == expected
+    assert results[second] == expected
+
+def test_rollback_over_limit():
+    executor = files('/a.rrd', '/b.rrd', '/c.rrd')
+    checks = [check(executor, 'Interface_{}'.format(index), {'in': (path, '1')})
+              for (index, path) in enumerate(['/a.rrd', '/b.rrd', '/c.rrd'])]
+    expected = dict([(resource, single(executor, resource)) for resource in checks])
+
+    # Room for the statements of two checks, not three
+    two = new_query(executor)
+    for (index, resource) in enumerate(checks[:2]):
+        resource.define_query(two, 'q{}_'.format(index))
+    limit = len(' '.join(two.header_args + two.command_list))
+    query_compiler = compiler(executor, checks, max_command_length=limit)
+
+    batches = query_compiler.compile()
+    assert [len(units) for (query, units) in batches] == [2, 1]
+    # The third check was taken back out of the first query, statements and data sources
+    assert batches[0][0].command_list == two.command_list
+    assert sorted(batches[0][0].datasets.keys()) == sorted(two.datasets.keys())
+    assert defs(batches[1][0].command_list) == ['DEF:q2_dsinavg=/c.rrd:1:AVERAGE']
+
+    results = query_compiler.run()
+    assert len(executor.graphs) == 2
+    for resource in checks:
+        assert results[resource] == expected[resource]
+
+def test_over_limit_alone():
+    # A check over the limit all by itself still gets a query of its own
+    executor = files('/a.rrd', '/b.rrd')
+    checks = [check(executor, 'Interface_1', {'in': ('/a.rrd', '1')}),
+              check(executor, 'Interface_2', {'in': ('/b.rrd', '1')})]
+    batches = compiler(executor, checks, max_command_length=10).compile()
+
+    assert [len(units) for (query, units) in batches] == [1, 1]
+
+def test_run_single_fallback():
+    executor = files('/a.rrd', '/b.rrd', '/c.rrd')
+    checks = [check(executor, 'Interface_{}'.format(index), {'in': (path, '1')})
+              for (index, path) in enumerate(['/a.rrd', '/b.rrd', '/c.rrd'])]
+    expected = dict([(resource, single(executor, resource)) for resource in checks])
+    executor.broken.add('/b.rrd')
+
+    results = compiler(executor, checks).run()
+
+    # The merged query failed, then each check ran on its own
+    assert len(executor.graphs) == 4
+    assert results[checks[0]] == expected[checks[0]]
+    assert isinstance(results[checks[1]], rrd_query.RRDQueryError)
+    assert results[checks[2]] == expected[checks[2]]
+
+def test_failing_query_of_one():
+    executor = files('/a.rrd', '/b.rrd')
+    checks = [check(executor, 'Interface_1', {'in': ('/a.rrd', '1')}),
+              check(executor, 'Interface_2', {'in': ('/b.rrd', '1')})]
+    executor.broken.add('/b.rrd')
+
+    results = compiler(executor, checks, max_command_length=10).run()
+
+    # Alone in its query already, so it isn't run again
+    assert len(executor.graphs) == 2
+    assert isinstance(results[checks[1]], rrd_query.RRDQueryError)
+    assert not math.isnan(results[checks[0]]['inavg_pred'])
@@ -0,0 +1,120 @@
+import math
+import random
+import shutil
+import pytest
+import rrd_query
+import check_predicted
+import fake_rrd
+from fake_rrd import ArchiveExecutor, assert_matches_rpn, compare_check
+
+week = 604800
+now = 1000 * week + 30
+
+def archives(noise, gap=0):
+    '''
+    archives holds five weeks and a bit of 60s data with daily and weekly seasonality, every gap-th row
+    unknown, plus a 300s archive of its averages the way rrdtool consolidates them (xff 0.5).
+    '''
+    generator = random.Random(4)
+    last_pos = now // 60
+    fine = {}
+    for pos in range(last_pos - 5 * week // 60 - 200, last_pos + 1):
+        when = pos * 60
+        value = (100 + 40 * math.sin(2 * math.pi * when / 86400) + 20 * math.sin(2 * math.pi * when / week) +
+                 generator.gauss(0, noise))
+        if not gap or pos % gap:
+            fine[pos] = value
+    coarse = {}
+    for pos in range((last_pos - 5 * week // 60) // 5, last_pos // 5 + 1):
+        values = [fine[fine_pos] for fine_pos in range(pos * 5 - 4, pos * 5 + 1) if fine_pos in fine]
+        if len(values) >= 3:
+            coarse[pos] = sum(values) / len(values)
+    return {60: (5 * week // 60 + 201, fine), 300: (5 * week // 300 + 1, coarse)}
+
+def run(executor, min_rows, mode, state_dir=None, sample_time='now'):
+    query = rrd_query.RRDQuery(executor=executor, end_time=sample_time, min_rows=min_rows)
+    check = check_predicted.MetricPredict(query, 'host', '/nonexistent', 'service', None, sample_time=sample_time,
+                                          mode=mode, flush=False, state_dir=state_dir,
+                                          label_dict={'m': (state_dir and state_dir + '/m.rrd' or '/m.rrd', '1')})
+    return (query, check.query())
+
+def fetched_resolution(fetch):
+    return fetch[fetch.index('--resolution') + 1]
+
+def test_choose_resolution():
+    query = rrd_query.RRDQuery(executor=ArchiveExecutor(archives(8), now), min_rows=6)
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600) == 300
+    # Too few rows per window
+    assert query.choose_resolution('/m.rrd', 1200, week, 4 * week + 3600) is None
+    # Doesn't reach back far enough
+    assert query.choose_resolution('/m.rrd', 1800, week, 6 * week) is None
+    # Its rows have to average to the ones the graph reads
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600, limit=300) == 300
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600, limit=900) == 300
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600, limit=240) is None
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600, limit=420) is None
+    query.min_rows = 0
+    assert query.choose_resolution('/m.rrd', 1800, week, 4 * week + 3600) is None
+
+def test_rpn_ignores_min_rows():
+    executor = ArchiveExecutor(archives(8), now)
+    (query, fine) = run(executor, 0, 'rpn')
+    (query, coarse) = run(executor, 6, 'rpn')
+
+    assert coarse == fine
+    assert not any(':step=' in item for item in query.command_list)
+
+@pytest.mark.parametrize('noise', [0.5, 20])
+@pytest.mark.parametrize('gap', [0, 7])
+def test_coarse_archive_matches_rpn(noise, gap):
+    # The tolerance --minrows states: as long as no more than the xff of the rows in a 300s step are
+    # unknown, the coarse archive gives what the rpn query prints
+    executor = ArchiveExecutor(archives(noise, gap), now)
+    # The sample times and whether the 300s archive gives the newest row of the graph. In the past,
+    # it only does when the graph's rows cover the whole of its newest step.
+    for (sample_time, coarse_read) in [(now, True), (now - 3060, True), (now - 100260, True),
+                                       (now - 4000, False), (now - 30000, False)]:
+        (query, rpn) = run(executor, 0, 'rpn', sample_time=str(sample_time))
+
+        for mode in ['numpy', 'points']:
+            # Neither archive reaches back six weeks, so the rpn graph reads the one that covers the most
+            # and consolidates it to its 300s pixels. So do the fetches without --minrows.
+            (query, fine) = run(executor, 0, mode, sample_time=str(sample_time))
+            assert fetched_resolution(executor.fetches[-1]) == '60'
+
+            del executor.fetches[:]
+            (query, coarse) = run(executor, 6, mode, sample_time=str(sample_time))
+            # Besides finding out where the graph ends
+            reads = [fetched_resolution(fetch) for fetch in executor.fetches if fetch[3] != 'end-300s']
+            assert set(reads) == set(['300' if coarse_read else '60'])
+
+            assert_matches_rpn(fine, rpn)
+            assert_matches_rpn(coarse, rpn)
+            assert not math.isnan(coarse['mavg_diff'])
+
+def test_state_rebuilt_when_min_rows_changes(tmp_path):
+    executor = ArchiveExecutor(archives(8), now)
+    (tmp_path / 'm.rrd').write_bytes(b'')
+    state_dir = str(tmp_path)
+
+    (query, coarse) = run(executor, 6, 'incremental', state_dir)
+    (query, fine) = run(executor, 0, 'incremental', state_dir)
+    (query, fresh) = run(executor, 0, 'numpy', state_dir)
+
+    for name in fresh.keys():
+        assert math.isclose(fine[name], fresh[name], rel_tol=1e-9), name
+
+@pytest.mark.skipif(shutil.which('rrdtool') is None, reason='rrdtool is not installed')
+@pytest.mark.parametrize('sample_time', [fake_rrd.now, fake_rrd.now - 3060, fake_rrd.now - 4000])
+def test_coarse_archive_matches_rrdtool(tmp_path, sample_time):
+    # The 300s archive doesn't reach back a day, so the graph reads the 60s one and consolidates it
+    path = str(tmp_path / 'm.rrd')
+    fake_rrd.create_rrd(path, fake_rrd.now, (60, 300), coarse_rows=200)
+    executor = rrd_query.SubprocessExecutor()
+    out_file = str(tmp_path / 'graph.png')
+
+    rpn = compare_check(executor, path, sample_time, 'rpn', out_file).query()
+    for mode in ['numpy', 'points']:
+        check = compare_check(executor, path, sample_time, mode, out_file)
+        check.rrd_query.min_rows = 2
+        assert_matches_rpn(check.query(), rpn)
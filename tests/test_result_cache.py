@@ -0,0 +1,56 @@
+import os
+import json
+import time
+import result_cache
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def created(cache, key):
+    with open(cache.entry_path(key)) as entry_file:
+        return json.load(entry_file)['created']
+
+def test_hits_dont_keep_an_entry_alive(tmp_path, monkeypatch):
+    clock = Clock(time.time())
+    monkeypatch.setattr(result_cache.time, 'time', clock)
+    cache = result_cache.ResultCache(str(tmp_path), ttl=60)
+    cache.put('key', {'mavg_diff': 1.5})
+
+    for offset in [10, 30, 50, 59]:
+        clock.now = created(cache, 'key') + offset
+        assert cache.get('key') == {'mavg_diff': 1.5}
+
+    # Polled more often than the ttl, it still expires a ttl after it was written
+    clock.now = created(cache, 'key') + 61
+    assert cache.get('key') is None
+
+def test_miss(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path))
+    assert cache.get('nothing') is None
+
+def test_key_follows_the_rrd_files(tmp_path):
+    rrd_file = tmp_path / 'm.rrd'
+    rrd_file.write_bytes(b'')
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'))
+    key = cache.key('host', 'service', ['rpn'], [str(rrd_file)])
+    assert cache.key('host', 'service', ['rpn'], [str(rrd_file)]) == key
+
+    os.utime(str(rrd_file), (1000, 1000))
+    assert cache.key('host', 'service', ['rpn'], [str(rrd_file)]) != key
+    assert cache.key('host', 'service', ['numpy'], [str(rrd_file)]) != key
+
+def test_prune_drops_least_recently_used(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path), ttl=3600, max_entries=2)
+    now = time.time()
+    for (key, accessed) in [('a', now - 30), ('b', now - 90), ('c', now - 60)]:
+        cache.put(key, {})
+        os.utime(cache.entry_path(key), (accessed, now))
+
+    os.remove(os.path.join(str(tmp_path), '.pruned'))
+    cache.prune()
+
+    assert sorted(os.listdir(str(tmp_path))) == ['.lock', '.pruned', 'a.json', 'c.json']
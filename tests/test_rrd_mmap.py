@@ -0,0 +1,92 @@
+import os
+import math
+import shutil
+import pytest
+import rrd_mmap
+import rrd_query
+
+# small.rrd: 60s steps, data sources '1' and '2' (the negative of '1'), last update 1000000050.
+# AVERAGE 20 x 60s rows hold 0..19 up to 1000000020, except 1000000020 - 300 which is unknown.
+# AVERAGE and MAX 12 x 300s rows hold 100..111 and 200..211 up to 999999900.
+fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'small.rrd')
+newest = 1000000020
+coarse_newest = 999999900
+nan = float('nan')
+
+def fine_value(when):
+    if when == newest - 300 or not newest - 19 * 60 <= when <= newest:
+        return nan
+    return float((when - (newest - 19 * 60)) // 60)
+
+def coarse_value(when, base):
+    if not coarse_newest - 11 * 300 <= when <= coarse_newest:
+        return nan
+    return float(base + (when - (coarse_newest - 11 * 300)) // 300)
+
+def same(actual, expected):
+    return len(actual) == len(expected) and all([(a == e) or (a != a and e != e) for (a, e) in zip(actual, expected)])
+
+def fetch(start, end, cf='AVERAGE', resolution=1):
+    ((fetch_start, fetch_end, step), ds_names, rows) = rrd_mmap.open_rrd(fixture).fetch(cf, start, end, resolution)
+    return (fetch_start, fetch_end, step, ds_names, rows)
+
+def test_header():
+    rrd = rrd_mmap.open_rrd(fixture)
+    assert rrd.step == 60
+    assert list(rrd.ds_names) == ['1', '2']
+    assert [(rra.cf, rra.step, rra.row_cnt) for rra in rrd.rras] == [('AVERAGE', 60, 20), ('AVERAGE', 300, 12),
+                                                                     ('MAX', 300, 12)]
+    assert rrd.last_update() == 1000000050
+
+@pytest.mark.parametrize('end', [newest, newest + 10, newest + 59])
+def test_fetch_rounds_end_like_rrd_fetch(end):
+    (start, fetch_end, step, ds_names, rows) = fetch(newest - 330, end)
+
+    # end always moves on to the next step, even from a step boundary
+    assert (start, fetch_end, step) == (newest - 360, newest + 60, 60)
+    times = range(start + step, fetch_end + step, step)
+    assert same(rows[:, 0].tolist(), [fine_value(when) for when in times])
+    assert same(rows[:, 1].tolist(), [-fine_value(when) for when in times])
+    assert math.isnan(rows[-1, 0])
+
+def test_fetch_coarse_archive():
+    (start, end, step, ds_names, rows) = fetch(coarse_newest - 3000, coarse_newest, resolution=300)
+    assert (start, end, step) == (coarse_newest - 3000, coarse_newest + 300, 300)
+    times = range(start + step, end + step, step)
+    assert same(rows[:, 0].tolist(), [coarse_value(when, 100) for when in times])
+
+def test_fetch_falls_back_to_archive_reaching_start():
+    # The 60s archive doesn't reach back an hour
+    (start, end, step, ds_names, rows) = fetch(newest - 3600, newest)
+    assert step == 300
+
+def test_choose_partial_archive_like_rrd_fetch():
+    # Neither archive reaches back to start. rrd_fetch reads the one reaching back furthest, even though
+    # it ends most of an hour earlier.
+    rrd = rrd_mmap.RRDFile(fixture)
+    rrd.rras = [rrd_mmap.RRA(0, 'AVERAGE', 646, 1, 60, None), rrd_mmap.RRA(1, 'AVERAGE', 10, 60, 3600, None)]
+    assert rrd.choose_rra('AVERAGE', 999961000, newest).step == 3600
+
+    info = {'step': 60, 'last_update': rrd.last_update(), 'rras': [('AVERAGE', 60, 646), ('AVERAGE', 3600, 10)]}
+    assert rrd_query.choose_archive(info, 'AVERAGE', 999961000, newest, 1) == 3600
+
+def test_fetch_max():
+    (start, end, step, ds_names, rows) = fetch(coarse_newest - 600, coarse_newest, cf='MAX')
+    assert step == 300
+    assert same(rows[:, 0].tolist(), [coarse_value(when, 200) for when in range(start + step, end + step, step)])
+
+@pytest.mark.skipif(shutil.which('rrdtool') is None, reason='rrdtool is not installed')
+@pytest.mark.parametrize('args', [['--start', str(newest - 330), '--end', str(newest)],
+                                  ['--start', str(newest - 330), '--end', str(newest + 10)],
+                                  ['--start', str(newest - 3600), '--end', str(newest)],
+                                  ['--start', str(coarse_newest - 3000), '--end', str(coarse_newest),
+                                   '--resolution', '300']])
+def test_fetch_matches_rrdtool(args):
+    ((start, end, step), ds_names, rows) = rrd_query.MmapExecutor().fetch([fixture, 'AVERAGE'] + args)
+    ((rrd_start, rrd_end, rrd_step), rrd_ds_names, rrd_rows) = rrd_query.SubprocessExecutor().fetch([fixture, 'AVERAGE'] + args)
+
+    assert (start, end, step) == (rrd_start, rrd_end, rrd_step)
+    assert list(ds_names) == list(rrd_ds_names)
+    assert len(rows) == len(rrd_rows)
+    for (row, rrd_row) in zip(rows.tolist(), rrd_rows):
+        assert same(row, [nan if value is None else value for value in rrd_row])
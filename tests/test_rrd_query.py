@@ -0,0 +1,62 @@
+import pytest
+import rrd_query
+import check_predicted
+from fake_rrd import FakeExecutor
+
+def test_fetch_shares_rows_of_a_file():
+    executor = FakeExecutor({99: 1.0, 100: 2.0}, now=6000)
+    query = rrd_query.RRDQuery(executor=executor)
+
+    first = query.fetch('/rrd/a.rrd', '1', 'end-120s', 'now')
+    second = query.fetch('/rrd/a.rrd', '1', 'end-120s', 'now')
+    assert repr(first) == repr(second)
+    assert len(executor.fetches) == 1
+
+    query.fetch('/rrd/b.rrd', '1', 'end-120s', 'now')
+    query.fetch('/rrd/a.rrd', '1', 'end-120s', 'now')
+    # Only the most recently read file is kept
+    assert len(executor.fetches) == 3
+
+def test_forget_fetches():
+    executor = FakeExecutor({99: 1.0, 100: 2.0}, now=6000)
+    query = rrd_query.RRDQuery(executor=executor)
+    query.fetch('/rrd/a.rrd', '1', 'end-120s', 'now')
+
+    executor.values[101] = 3.0
+    executor.now = 6060
+    query.forget_fetches()
+    (start, step, values) = query.fetch('/rrd/a.rrd', '1', 'end-120s', 'now')
+
+    assert values[-2] == 3.0
+    assert len(executor.fetches) == 2
+
+def test_query_refetches_between_checks():
+    executor = FakeExecutor(dict([(pos, float(pos)) for pos in range(1, 101)]), now=6000)
+    query = rrd_query.RRDQuery(executor=executor, start_time='end-1d', graph_width=1440)
+    check = check_predicted.MetricPredict(query, 'host', '/nonexistent', 'service', None, mode='points',
+                                          interval=600, count=-2, window=120, flush=False,
+                                          label_dict={'m': ('/nonexistent/m.rrd', '1')})
+    first = check.query()
+
+    executor.values[101] = 1000.0
+    executor.now = 6060
+    second = check.query()
+
+    assert second['mavg_smooth'] == 1000.0
+    assert second['mavg_smooth'] != first['mavg_smooth']
+
+def test_parse_fetch_output():
+    lines = ['                 1', '', '1000000020: 1.0000000000e+00', '1000000080: -nan', '']
+    assert rrd_query.parse_fetch_output(lines) == ((999999960, 1000000080, 60), ('1',), [(1.0,), (None,)])
+
+def test_parse_fetch_output_single_row_takes_resolution():
+    lines = ['                 1', '', '1000000200: 2.0000000000e+00', '']
+    args = ['/m.rrd', 'AVERAGE', '--start', '1000000000', '--end', '1000000100', '--resolution', '300']
+    assert rrd_query.parse_fetch_output(lines, rrd_query.fetch_resolution(args)) == \
+        ((999999900, 1000000200, 300), ('1',), [(2.0,)])
+
+    # Without a resolution, or with one the row isn't on, there is no telling
+    with pytest.raises(rrd_query.RRDQueryError):
+        rrd_query.parse_fetch_output(lines)
+    with pytest.raises(rrd_query.RRDQueryError):
+        rrd_query.parse_fetch_output(lines, 3600)
@@ -0,0 +1,87 @@
+import socket
+import threading
+import pytest
+import rrdcached
+
+class FakeDaemon(threading.Thread):
+    '''
+    FakeDaemon answers one rrdcached connection on a unix socket. BATCH is accepted, and the
+    batch response reports an error for every FLUSH of a path in errors. It records the lines it got.
+    '''
+
+    def __init__(self, socket_path, errors=(), refuse_batch=False):
+        threading.Thread.__init__(self)
+        self.daemon         = True
+        self.errors         = errors
+        self.refuse_batch   = refuse_batch
+        self.lines          = []
+        self.server         = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(1)
+
+    def run(self):
+        (sock, address) = self.server.accept()
+        connection = sock.makefile('rw')
+        commands = []
+        in_batch = False
+        for line in connection:
+            line = line.rstrip('\n')
+            self.lines.append(line)
+            if line == 'BATCH':
+                if self.refuse_batch:
+                    connection.write('-1 No batches today\n')
+                else:
+                    connection.write('0 Go ahead.  End with dot \'.\' on its own line.\n')
+                    in_batch = True
+            elif in_batch and line == '.':
+                in_batch = False
+                failed = [(number, command) for (number, command) in enumerate(commands, 1)
+                          if command.split(' ', 1)[1] in self.errors]
+                connection.write('{} errors\n'.format(len(failed)))
+                for (number, command) in failed:
+                    connection.write('{} No such file: {}\n'.format(number, command.split(' ', 1)[1]))
+            elif in_batch:
+                commands.append(line)
+            elif line == 'QUIT':
+                break
+            connection.flush()
+        connection.close()
+        sock.close()
+        self.server.close()
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / 'rrdcached.sock')
+
+def test_flush_batch(socket_path):
+    daemon = FakeDaemon(socket_path)
+    daemon.start()
+
+    errors = rrdcached.flush('unix:' + socket_path, ['/rrd/a.rrd', '/rrd/b.rrd'])
+    daemon.join(5)
+
+    assert errors == []
+    assert daemon.lines == ['BATCH', 'FLUSH /rrd/a.rrd', 'FLUSH /rrd/b.rrd', '.', 'QUIT']
+
+def test_flush_maps_errors_to_paths(socket_path):
+    daemon = FakeDaemon(socket_path, errors=('/rrd/b.rrd', '/rrd/d.rrd'))
+    daemon.start()
+
+    errors = rrdcached.flush(socket_path, ['/rrd/a.rrd', '/rrd/b.rrd', '/rrd/c.rrd', '/rrd/d.rrd'])
+    daemon.join(5)
+
+    assert errors == [('/rrd/b.rrd', 'No such file: /rrd/b.rrd'), ('/rrd/d.rrd', 'No such file: /rrd/d.rrd')]
+
+def test_flush_refused_batch(socket_path):
+    daemon = FakeDaemon(socket_path, refuse_batch=True)
+    daemon.start()
+
+    with pytest.raises(rrdcached.RRDCachedError):
+        rrdcached.flush(socket_path, ['/rrd/a.rrd'])
+
+def test_flush_nothing_doesnt_connect(socket_path):
+    assert rrdcached.flush(socket_path, []) == []
+
+def test_flush_no_daemon(socket_path):
+    with pytest.raises(rrdcached.RRDCachedError):
+        rrdcached.flush(socket_path, ['/rrd/a.rrd'])
@@ -0,0 +1,79 @@
+import os
+import service_index
+
+def write_xml(perfdata, host, service_name, metrics):
+    host_dir = perfdata / host
+    host_dir.mkdir(parents=True, exist_ok=True)
+    datasources = ''.join(['<DATASOURCE><DS>{}</DS><NAME>{}</NAME><RRDFILE>/rrd/{}/{}.rrd</RRDFILE></DATASOURCE>'.format(
+        ds_num + 1, metric, host, service_name) for (ds_num, metric) in enumerate(metrics)])
+    path = host_dir / (service_name + '.xml')
+    path.write_text('<NAGIOS>{}</NAGIOS>'.format(datasources))
+    return path
+
+def counting(monkeypatch):
+    parsed = []
+    read_label_dict = service_index.read_label_dict
+    def read(xml_path):
+        parsed.append(os.path.basename(xml_path))
+        return read_label_dict(xml_path)
+    monkeypatch.setattr(service_index, 'read_label_dict', read)
+    return parsed
+
+def test_lookup_parses_again_when_xml_changes(tmp_path, monkeypatch):
+    parsed = counting(monkeypatch)
+    path = write_xml(tmp_path / 'perfdata', 'web', 'if', ['in', 'out'])
+    index = service_index.ServiceIndex(str(tmp_path / 'index'), str(tmp_path / 'perfdata'))
+
+    assert index.lookup('web', 'if') == {'in': ('/rrd/web/if.rrd', '1'), 'out': ('/rrd/web/if.rrd', '2')}
+    assert index.lookup('web', 'if') == {'in': ('/rrd/web/if.rrd', '1'), 'out': ('/rrd/web/if.rrd', '2')}
+    assert parsed == ['if.xml']
+
+    # Another size
+    write_xml(tmp_path / 'perfdata', 'web', 'if', ['in', 'out', 'errors'])
+    assert sorted(index.lookup('web', 'if').keys()) == ['errors', 'in', 'out']
+    assert len(parsed) == 2
+
+    # The same size, another mtime
+    write_xml(tmp_path / 'perfdata', 'web', 'if', ['in', 'out', 'drops1'])
+    stat = os.stat(str(path))
+    os.utime(str(path), (stat.st_atime, stat.st_mtime + 10))
+    assert sorted(index.lookup('web', 'if').keys()) == ['drops1', 'in', 'out']
+    assert len(parsed) == 3
+
+def test_lookup_filters_on_ds_match(tmp_path):
+    write_xml(tmp_path / 'perfdata', 'web', 'if', ['in', 'out', 'in_errors'])
+    index = service_index.ServiceIndex(str(tmp_path / 'index'), str(tmp_path / 'perfdata'))
+
+    assert sorted(index.lookup('web', 'if', '^in').keys()) == ['in', 'in_errors']
+    assert sorted(index.lookup('web', 'if', 'out').keys()) == ['out']
+    assert index.lookup('web', 'if', 'nothing') == {}
+    assert sorted(index.lookup('web', 'if').keys()) == ['in', 'in_errors', 'out']
+
+def test_refresh_only_rebuilds_changed_entries(tmp_path, monkeypatch):
+    perfdata = tmp_path / 'perfdata'
+    write_xml(perfdata, 'web', 'if', ['in', 'out'])
+    write_xml(perfdata, 'web', 'cpu', ['user'])
+    write_xml(perfdata, 'db', 'disk', ['read'])
+    write_xml(perfdata, 'old', 'disk', ['read'])
+    index = service_index.ServiceIndex(str(tmp_path / 'index'), str(perfdata))
+
+    assert index.refresh() == [('db', 'disk'), ('old', 'disk'), ('web', 'cpu'), ('web', 'if')]
+    db_stat = os.stat(index.host_path('db'))
+
+    parsed = counting(monkeypatch)
+    write_xml(perfdata, 'web', 'if', ['in', 'out', 'errors'])
+    os.remove(str(perfdata / 'web' / 'cpu.xml'))
+    os.remove(str(perfdata / 'old' / 'disk.xml'))
+    os.rmdir(str(perfdata / 'old'))
+
+    assert index.refresh() == [('db', 'disk'), ('web', 'if')]
+    assert parsed == ['if.xml']
+    # Hosts without changes aren't written, hosts that are gone are dropped
+    assert os.stat(index.host_path('db')).st_mtime_ns == db_stat.st_mtime_ns
+    assert not os.path.exists(index.host_path('old'))
+    assert sorted(index.read_host('web').keys()) == ['if']
+
+    # The lookups are hits
+    assert sorted(index.lookup('web', 'if').keys()) == ['errors', 'in', 'out']
+    assert index.lookup('db', 'disk') == {'read': ('/rrd/db/disk.rrd', '1')}
+    assert parsed == ['if.xml']
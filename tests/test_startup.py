@@ -0,0 +1,73 @@
+# Start up is a good part of what a check costs, and it creeps up one innocent import at a time.
+# These tests import the check in fresh interpreters, from the source tree and from a zipapp built by
+# build_zipapp.py, and fail when it takes longer or loads more modules than the budget, or when a
+# module only some code paths need gets imported on start up.
+
+import os
+import sys
+import json
+import time
+import subprocess
+import pytest
+import build_zipapp
+
+# Interpreter start up plus importing the check, best of RUNS, in milliseconds
+STARTUP_BUDGET_MS = 100
+# Modules loaded once the check is imported
+MODULE_BUDGET = 130
+RUNS = 5
+
+# Modules that only some code paths need. Importing the check module should not pull them in.
+lazy_modules = ['subprocess', 'socket', 'shelve', 'datetime', 'xml.etree.ElementTree', 'numpy', 'rrdtool',
+                'rrdcached', 'predict_state', 'predict_numpy', 'rrd_mmap', 'result_cache', 'hashlib']
+
+source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+probe_template = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+import {entry}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'modules': sorted(sys.modules.keys())}}))
+'''
+
+def measure(path, entry='check_predicted'):
+    '''
+    measure imports entry from path (a directory or zipapp) in a fresh interpreter and returns
+    (seconds, modules). The time covers the interpreter start up as well.
+    '''
+    code = probe_template.format(path=os.path.abspath(path), entry=entry)
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, universal_newlines=True)
+    total = time.perf_counter() - start
+    return (total, json.loads(output)['modules'])
+
+def check_budget(path):
+    runs = [measure(path) for run in range(RUNS)]
+    milliseconds = min([total for (total, modules) in runs]) * 1000
+    modules = runs[0][1]
+
+    assert [name for name in lazy_modules if name in modules] == []
+    assert len(modules) <= MODULE_BUDGET
+    assert milliseconds <= STARTUP_BUDGET_MS
+
+def test_source_startup():
+    check_budget(source_dir)
+
+@pytest.fixture(scope='module')
+def zipapp_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('zipapp') / 'check_predicted.pyz')
+    build_zipapp.build(path)
+    return path
+
+def test_zipapp_startup(zipapp_path):
+    check_budget(zipapp_path)
+
+def test_zipapp_runs(zipapp_path):
+    output = subprocess.run([sys.executable, zipapp_path, '--help'], stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    assert output.returncode == 0
+    assert '--samplewindow' in output.stdout